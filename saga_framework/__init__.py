@@ -1,6 +1,70 @@
+import importlib
+
 from .base_saga import *
 from .async_saga import *
+from .archive import *
+from .batching import *
+from .context import *
+from .dead_letters import *
+from .events import *
+from .idempotency import *
+from .locking import *
+from .memoization import *
+from .outbox import *
+from .payloads import *
+from .priority import *
+from .profiling import *
+from .sharding import *
 from .stateful_saga import *
+from .sqlite_repository import *
 from .utils import *
 from .saga_handlers import *
-from .celery_utils import *
+
+from . import base_saga, async_saga, archive, batching, context, dead_letters, events, \
+    idempotency, locking, memoization, outbox, payloads, priority, profiling, sharding, \
+    stateful_saga, sqlite_repository, utils, saga_handlers
+
+# Modules that import optional heavy dependencies (Celery, AsyncAPI, numpy)
+#  at import time are loaded only when one of their names is accessed.
+#  Names are listed here to not import modules to read their __all__
+#  (tests check they match). They aren't in __all__, so `from saga_framework import *`
+#  doesn't load these modules, except for names it exported before they became lazy
+_LAZY_MODULES = {
+    'analytics': ['LatencyStats', 'StepStats', 'SagaClassStats', 'SlowSaga', 'SagaAnalytics',
+                  'analyze_repository', 'analyze_archive'],
+    'celery_utils': ['auto_retry_then_reraise',
+                     'close_sqlalchemy_db_connection_after_celery_task_ends',
+                     'rebalance_worker_queues', 'close_batchers_on_worker_shutdown',
+                     'add_consumed_priority_lanes'],
+    'transports': ['SentMessage', 'AbstractTransport', 'CeleryTransport',
+                   'ThreadedTransport', 'AsyncioTransport'],
+    'simulation': ['StepProfile', 'ResourceStats', 'SimulationResult', 'SagaSimulator',
+                   'constant', 'exponential', 'lognormal', 'uniform'],
+}
+_LAZY_NAMES = {name: module
+               for module, names in _LAZY_MODULES.items()
+               for name in names}
+# star-importable for backward compatibility (loads Celery)
+_STAR_EXPORTED_LAZY_NAMES = ['auto_retry_then_reraise',
+                             'close_sqlalchemy_db_connection_after_celery_task_ends']
+
+__all__ = base_saga.__all__ + async_saga.__all__ + archive.__all__ + batching.__all__ + \
+          context.__all__ + dead_letters.__all__ + events.__all__ + idempotency.__all__ + \
+          locking.__all__ + memoization.__all__ + outbox.__all__ + payloads.__all__ + \
+          priority.__all__ + profiling.__all__ + sharding.__all__ + stateful_saga.__all__ + \
+          sqlite_repository.__all__ + utils.__all__ + saga_handlers.__all__ + \
+          _STAR_EXPORTED_LAZY_NAMES
+
+
+def __getattr__(name: str):
+    module_name = _LAZY_NAMES.get(name)
+    if module_name is None:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+    value = getattr(importlib.import_module(f'.{module_name}', __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_NAMES))
@@ -0,0 +1,415 @@
+"""
+This module contains offline analytics of saga transition history.
+
+Requires numpy (pip install saga_framework[simulation]).
+
+SagaAnalytics takes transition history (see AbstractSagaStateRepository.update_step_status)
+ chunk by chunk and computes per saga class and per step:
+ * number of sagas, succeeded, failed and compensated ones, saga duration
+ * step runs and failures, time in step (from step start to its next transition,
+   e.g. to response of async step)
+ * compensations and their time
+ * the slowest sagas with time spent in each step
+
+Chunks are processed with vectorized numpy operations, and durations are kept
+ in log-scale histograms (percentiles are precise to about 2%), so memory use
+ doesn't depend on history size:
+
+    analytics = analyze_repository(repository, chunk_size=100000)
+    print(analytics.format_report())
+
+History exported with SagaArchiver can be analyzed the same way with analyze_archive.
+"""
+
+__all__ = ['LatencyStats', 'StepStats', 'SagaClassStats', 'SlowSaga', 'SagaAnalytics',
+           'analyze_repository', 'analyze_archive']
+
+import heapq
+import math
+import operator
+import typing
+from dataclasses import dataclass, field
+
+import numpy
+
+from .stateful_saga import AbstractSagaStateRepository, SagaPhase
+
+if typing.TYPE_CHECKING:
+    from .archive import AbstractSagaArchive
+
+_PHASES = list(SagaPhase)
+_RUNNING = _PHASES.index(SagaPhase.RUNNING)
+_SUCCEEDED = _PHASES.index(SagaPhase.SUCCEEDED)
+_FAILED = _PHASES.index(SagaPhase.FAILED)
+_COMPENSATING = _PHASES.index(SagaPhase.COMPENSATING)
+# rows may contain phase values or SagaPhase members
+_PHASE_CODES = {**{phase.value: code for code, phase in enumerate(_PHASES)},
+                **{phase: code for code, phase in enumerate(_PHASES)}}
+
+# histogram bins cover 1 microsecond .. 10^6 seconds
+_MIN_EXPONENT = -6
+_MAX_EXPONENT = 6
+
+
+class _Codes(dict):
+    """
+    Maps values (like step names) to consecutive integer codes
+    """
+    def __missing__(self, value):
+        code = self[value] = len(self)
+        return code
+
+    def encode(self, values: typing.Sequence) -> numpy.ndarray:
+        return numpy.fromiter(map(self.__getitem__, values), numpy.int64, len(values))
+
+
+@dataclass
+class LatencyStats:
+    count: int = 0
+    mean: float = 0.0  # seconds
+    max: float = 0.0
+    percentiles: typing.Dict[float, float] = field(default_factory=dict)
+
+
+@dataclass
+class StepStats:
+    runs: int = 0
+    failures: int = 0
+    compensations: int = 0
+    time_in_step: LatencyStats = field(default_factory=LatencyStats)
+    compensation_time: LatencyStats = field(default_factory=LatencyStats)
+
+    @property
+    def failure_rate(self) -> float:
+        return self.failures / self.runs if self.runs else 0.0
+
+
+@dataclass
+class SagaClassStats:
+    sagas: int = 0
+    succeeded: int = 0
+    failed: int = 0
+    compensated: int = 0
+    duration: LatencyStats = field(default_factory=LatencyStats)  # of finished sagas
+    steps: typing.Dict[str, StepStats] = field(default_factory=dict)
+
+    @property
+    def compensation_rate(self) -> float:
+        return self.compensated / self.sagas if self.sagas else 0.0
+
+
+@dataclass
+class SlowSaga:
+    saga_id: int
+    saga_class: str
+    duration: float
+    breakdown: typing.Dict[str, float]  # seconds per step (and per step compensation)
+
+
+class _Histogram:
+    __slots__ = ('count', 'total', 'max', 'counts')
+
+    def __init__(self, bins: int):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.counts = numpy.zeros(bins, numpy.int64)
+
+    def to_stats(self, percentiles: typing.Iterable[float], bins_per_decade: int) -> LatencyStats:
+        if not self.count:
+            return LatencyStats()
+
+        cumulative = numpy.cumsum(self.counts)
+        result = {}
+        for percentile in percentiles:
+            bin_ = int(numpy.searchsorted(cumulative, percentile / 100 * self.count))
+            # geometric middle of bin
+            value = 10 ** (_MIN_EXPONENT + (bin_ + 0.5) / bins_per_decade)
+            result[percentile] = min(value, self.max)
+
+        return LatencyStats(count=self.count, mean=self.total / self.count,
+                            max=self.max, percentiles=result)
+
+
+class SagaAnalytics:
+    def __init__(self, percentiles: typing.Iterable[float] = (50, 90, 99),
+                 bins_per_decade: int = 50,
+                 slowest: int = 10):
+        self.percentiles = tuple(percentiles)
+        self.bins_per_decade = bins_per_decade
+        self.bins = (_MAX_EXPONENT - _MIN_EXPONENT) * bins_per_decade
+        self.slowest = slowest
+
+        self._classes = _Codes()
+        self._steps = _Codes({None: 0})
+        # (saga class, step name or None, phase) -> transitions count / durations
+        self._transitions = {}  # type: typing.Dict[tuple, int]
+        self._histograms = {}  # type: typing.Dict[tuple, _Histogram]
+        self._sagas = {}  # type: typing.Dict[str, int]
+        self._compensated = {}  # type: typing.Dict[str, int]
+        self._slowest = []  # heap of (duration, saga_id, SlowSaga)
+        # rows of the last saga of a chunk: it may continue in the next chunk
+        self._pending_rows = []  # type: typing.List[tuple]
+
+    def add_chunk(self, rows: typing.List[tuple]):
+        """
+        Adds (saga_id, saga_class, step_name, phase, at) rows
+         ordered by saga_id and then by time
+        """
+        rows = self._pending_rows + list(rows)
+        if not rows:
+            return
+
+        split = len(rows) - 1
+        last_saga_id = rows[-1][0]
+        while split > 0 and rows[split - 1][0] == last_saga_id:
+            split -= 1
+
+        self._pending_rows = rows[split:]
+        if split:
+            self._process(rows[:split])
+
+    def finish(self):
+        """
+        Processes the rest of rows, call it after the last chunk
+        """
+        rows, self._pending_rows = self._pending_rows, []
+        if rows:
+            self._process(rows)
+
+    def _decode(self, key: int) -> tuple:
+        class_code, rest = divmod(key, len(self._steps) * len(_PHASES))
+        step_code, phase_code = divmod(rest, len(_PHASES))
+        return (self._class_names[class_code], self._step_names[step_code],
+                _PHASES[phase_code])
+
+    def _process(self, rows: typing.List[tuple]):
+        saga_ids, saga_classes, step_names, phases, ats = (
+            list(map(operator.itemgetter(column), rows)) for column in range(5))
+        saga = numpy.array(saga_ids, numpy.int64)
+        saga_class = self._classes.encode(saga_classes)
+        step = self._steps.encode(step_names)
+        phase = numpy.fromiter(map(_PHASE_CODES.__getitem__, phases), numpy.int64, len(rows))
+        at = numpy.array(ats, numpy.float64)
+        self._class_names = list(self._classes)
+        self._step_names = list(self._steps)
+
+        keys = (saga_class * len(self._steps) + step) * len(_PHASES) + phase
+        unique_keys, counts = numpy.unique(keys, return_counts=True)
+        for key, count in zip(unique_keys.tolist(), counts.tolist()):
+            key = self._decode(key)
+            self._transitions[key] = self._transitions.get(key, 0) + count
+
+        # sagas are contiguous: find their first and last rows
+        is_first = numpy.empty(len(rows), bool)
+        is_first[0] = True
+        numpy.not_equal(saga[1:], saga[:-1], out=is_first[1:])
+        firsts = numpy.flatnonzero(is_first)
+        lasts = numpy.append(firsts[1:] - 1, len(rows) - 1)
+
+        # time from transition to the next transition of the same saga
+        durations = numpy.full(len(rows), numpy.nan)
+        continues = ~is_first[1:]
+        durations[:-1][continues] = (at[1:] - at[:-1])[continues]
+
+        timed = ((phase == _RUNNING) | (phase == _COMPENSATING)) & ~numpy.isnan(durations)
+        self._add_durations(keys[timed], durations[timed])
+
+        # saga is finished when it succeeds or fails as a whole
+        #  (retriable steps may still complete after that)
+        finishes = (step == 0) & ((phase == _SUCCEEDED) | (phase == _FAILED))
+        finished_at = numpy.maximum.reduceat(numpy.where(finishes, at, -numpy.inf), firsts)
+        outcome = numpy.maximum.reduceat(numpy.where(finishes, phase, -1), firsts)
+        finished = outcome >= 0
+        saga_duration = finished_at - at[firsts]
+        first_class = saga_class[firsts]
+
+        self._add_durations(
+            (first_class[finished] * len(self._steps)) * len(_PHASES) + outcome[finished],
+            saga_duration[finished])
+
+        compensated = numpy.logical_or.reduceat(phase == _COMPENSATING, firsts)
+        for counter, mask in ((self._sagas, slice(None)), (self._compensated, compensated)):
+            class_codes, counts = numpy.unique(first_class[mask], return_counts=True)
+            for class_code, count in zip(class_codes.tolist(), counts.tolist()):
+                name = self._class_names[class_code]
+                counter[name] = counter.get(name, 0) + count
+
+        self._add_slowest(numpy.flatnonzero(finished), saga_duration, saga, firsts, lasts,
+                          step, phase, durations, first_class)
+
+    def _add_durations(self, keys: numpy.ndarray, durations: numpy.ndarray):
+        if not len(keys):
+            return
+
+        with numpy.errstate(divide='ignore'):
+            bins = numpy.floor((numpy.log10(durations) - _MIN_EXPONENT) * self.bins_per_decade)
+        bins = numpy.clip(bins, 0, self.bins - 1).astype(numpy.int64)
+
+        unique_keys, inverse = numpy.unique(keys, return_inverse=True)
+        inverse = inverse.ravel()
+        counts = numpy.bincount(inverse * self.bins + bins,
+                                minlength=len(unique_keys) * self.bins
+                                ).reshape(len(unique_keys), self.bins)
+        totals = numpy.bincount(inverse, weights=durations, minlength=len(unique_keys))
+        maxes = numpy.full(len(unique_keys), -numpy.inf)
+        numpy.maximum.at(maxes, inverse, durations)
+
+        for i, key in enumerate(unique_keys.tolist()):
+            key = self._decode(key)
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram(self.bins)
+            histogram.counts += counts[i]
+            histogram.count += int(counts[i].sum())
+            histogram.total += float(totals[i])
+            histogram.max = max(histogram.max, float(maxes[i]))
+
+    def _add_slowest(self, candidates: numpy.ndarray, saga_duration: numpy.ndarray,
+                     saga: numpy.ndarray, firsts: numpy.ndarray, lasts: numpy.ndarray,
+                     step: numpy.ndarray, phase: numpy.ndarray, durations: numpy.ndarray,
+                     first_class: numpy.ndarray):
+        if not self.slowest or not len(candidates):
+            return
+
+        if len(candidates) > self.slowest:
+            top = numpy.argpartition(saga_duration[candidates], -self.slowest)[-self.slowest:]
+            candidates = candidates[top]
+
+        for index in candidates.tolist():
+            duration = float(saga_duration[index])
+            if len(self._slowest) == self.slowest and duration <= self._slowest[0][0]:
+                continue
+
+            breakdown = {}
+            for row in range(firsts[index], lasts[index] + 1):
+                if math.isnan(durations[row]) or phase[row] not in (_RUNNING, _COMPENSATING):
+                    continue
+                name = self._step_names[step[row]]
+                if phase[row] == _COMPENSATING:
+                    name = f'{name} (compensation)'
+                breakdown[name] = breakdown.get(name, 0.0) + float(durations[row])
+
+            slow_saga = SlowSaga(saga_id=int(saga[firsts[index]]),
+                                 saga_class=self._class_names[first_class[index]],
+                                 duration=duration, breakdown=breakdown)
+            item = (duration, slow_saga.saga_id, slow_saga)
+            if len(self._slowest) < self.slowest:
+                heapq.heappush(self._slowest, item)
+            else:
+                heapq.heapreplace(self._slowest, item)
+
+    def _latency(self, key: tuple) -> LatencyStats:
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            return LatencyStats()
+        return histogram.to_stats(self.percentiles, self.bins_per_decade)
+
+    def report(self) -> typing.Dict[str, SagaClassStats]:
+        report = {}
+        for saga_class, sagas in self._sagas.items():
+            durations = [self._histograms[key] for key in
+                         ((saga_class, None, SagaPhase.SUCCEEDED),
+                          (saga_class, None, SagaPhase.FAILED))
+                         if key in self._histograms]
+            duration = _Histogram(self.bins)
+            for histogram in durations:
+                duration.counts += histogram.counts
+                duration.count += histogram.count
+                duration.total += histogram.total
+                duration.max = max(duration.max, histogram.max)
+
+            report[saga_class] = SagaClassStats(
+                sagas=sagas,
+                succeeded=self._transitions.get((saga_class, None, SagaPhase.SUCCEEDED), 0),
+                failed=self._transitions.get((saga_class, None, SagaPhase.FAILED), 0),
+                compensated=self._compensated.get(saga_class, 0),
+                duration=duration.to_stats(self.percentiles, self.bins_per_decade),
+            )
+
+        for (saga_class, step_name, phase), count in self._transitions.items():
+            if step_name is None:
+                continue
+
+            steps = report[saga_class].steps
+            stats = steps.get(step_name)
+            if stats is None:
+                stats = steps[step_name] = StepStats(
+                    time_in_step=self._latency((saga_class, step_name, SagaPhase.RUNNING)),
+                    compensation_time=self._latency(
+                        (saga_class, step_name, SagaPhase.COMPENSATING)))
+
+            if phase == SagaPhase.RUNNING:
+                stats.runs += count
+            elif phase == SagaPhase.FAILED:
+                stats.failures += count
+            elif phase == SagaPhase.COMPENSATING:
+                stats.compensations += count
+
+        return report
+
+    def slowest_sagas(self) -> typing.List[SlowSaga]:
+        return [slow_saga for _, _, slow_saga in sorted(self._slowest, reverse=True)]
+
+    def format_report(self) -> str:
+        def format_latency(stats: LatencyStats) -> str:
+            return ''.join(f'{stats.percentiles.get(percentile, 0) * 1000:>12.1f}'
+                           for percentile in self.percentiles)
+
+        percentiles_header = ''.join(f'{f"p{percentile:g}, ms":>12}'
+                                     for percentile in self.percentiles)
+        lines = []
+        for saga_class, stats in self.report().items():
+            lines.append(f'{saga_class}: {stats.sagas} sagas, {stats.succeeded} succeeded, '
+                         f'{stats.failed} failed, '
+                         f'{stats.compensation_rate:.2%} compensated')
+            lines.append(f'  {"step":<32}{"runs":>10}{"failed":>8}{percentiles_header}'
+                         f'{"comp.":>8}{"comp. p99, ms":>15}')
+            lines.append(f'  {"(whole saga)":<32}{stats.sagas:>10}{stats.failed:>8}'
+                         f'{format_latency(stats.duration)}')
+            for step_name, step_stats in stats.steps.items():
+                compensation_p99 = max(step_stats.compensation_time.percentiles.values(),
+                                       default=0.0)
+                lines.append(f'  {step_name:<32}{step_stats.runs:>10}{step_stats.failures:>8}'
+                             f'{format_latency(step_stats.time_in_step)}'
+                             f'{step_stats.compensations:>8}{compensation_p99 * 1000:>15.1f}')
+
+        slowest = self.slowest_sagas()
+        if slowest:
+            lines.append('Slowest sagas:')
+        for slow_saga in slowest:
+            breakdown = sorted(slow_saga.breakdown.items(), key=lambda item: item[1],
+                               reverse=True)
+            lines.append(f'  {slow_saga.saga_class} {slow_saga.saga_id}: '
+                         f'{slow_saga.duration * 1000:.1f} ms (' +
+                         ', '.join(f'{name} {seconds * 1000:.1f} ms'
+                                   for name, seconds in breakdown[:3]) + ')')
+
+        return '\n'.join(lines)
+
+
+def analyze_repository(repository: AbstractSagaStateRepository,
+                       chunk_size: int = 100000, **kwargs) -> SagaAnalytics:
+    analytics = SagaAnalytics(**kwargs)
+    for rows in repository.iter_transition_chunks(chunk_size):
+        analytics.add_chunk(rows)
+    analytics.finish()
+    return analytics
+
+
+def analyze_archive(archive: 'AbstractSagaArchive',
+                    chunk_size: int = 100000, **kwargs) -> SagaAnalytics:
+    analytics = SagaAnalytics(**kwargs)
+    rows = []
+    for record in archive.iter_records():
+        saga_class = record['state'].get('saga_class')
+        rows += [(record['saga_id'], saga_class, transition['step_name'],
+                  transition['phase'], transition['at'])
+                 for transition in record['transitions']]
+        if len(rows) >= chunk_size:
+            analytics.add_chunk(rows)
+            rows = []
+
+    analytics.add_chunk(rows)
+    analytics.finish()
+    return analytics
@@ -0,0 +1,177 @@
+"""
+This module contains archival of finished sagas.
+
+Saga state tables are written on every saga transition, so they (and their indexes)
+ should contain only sagas that can still change. SagaArchiver periodically
+ moves sagas that succeeded or failed more than retention ago
+ from saga state repository to archive, in batches:
+ each batch is exported (state, transitions and context of every saga),
+ appended to archive and only then deleted from repository.
+
+If archiver dies between these steps, the batch is archived again next time,
+ and archive returns (and iterates over) the latest copy of a saga only.
+
+Note: retriable steps complete after saga is succeeded,
+ so retention should be longer than they can take.
+
+JSONLSagaArchive keeps every batch in a gzip-compressed JSON Lines segment file
+ and indexes saga ids in a small SQLite file, so archived saga can be looked up
+ by id reading one segment only.
+"""
+
+__all__ = ['AbstractSagaArchive', 'JSONLSagaArchive', 'SagaArchiver']
+
+import abc
+import datetime
+import gzip
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import threading
+import typing
+
+from .stateful_saga import AbstractSagaStateRepository
+
+logger = logging.getLogger(__name__)
+
+_segment_numbers = itertools.count()
+
+
+class AbstractSagaArchive(abc.ABC):
+    @abc.abstractmethod
+    def add(self, records: typing.List[dict]):
+        """
+        Durably saves saga records (see AbstractSagaStateRepository.export_sagas)
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get(self, saga_id: int) -> typing.Optional[dict]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def iter_records(self) -> typing.Iterator[dict]:
+        """
+        Yields the latest copy of every archived saga (like get does),
+         even if saga was archived several times
+        """
+        raise NotImplementedError
+
+
+class JSONLSagaArchive(AbstractSagaArchive):
+    def __init__(self, directory: str, compress_level: int = 6):
+        self.directory = directory
+        self.compress_level = compress_level
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._index = sqlite3.connect(os.path.join(directory, 'index.sqlite3'),
+                                      check_same_thread=False)
+        self._index.execute('''
+            CREATE TABLE IF NOT EXISTS saga_index (
+                saga_id INTEGER PRIMARY KEY,
+                segment TEXT NOT NULL,
+                line INTEGER NOT NULL
+            ) WITHOUT ROWID
+        ''')
+        # to skip superseded copies in iter_records
+        self._index.execute('''
+            CREATE INDEX IF NOT EXISTS ix_saga_index_segment
+            ON saga_index (segment, line)
+        ''')
+        self._index.commit()
+
+    def _segment_names(self) -> typing.List[str]:
+        return sorted(name for name in os.listdir(self.directory)
+                      if name.endswith('.jsonl.gz'))
+
+    def add(self, records: typing.List[dict]):
+        if not records:
+            return
+
+        segment = f'{datetime.datetime.utcnow():%Y%m%d%H%M%S%f}-{os.getpid()}-' \
+                  f'{next(_segment_numbers)}.jsonl.gz'
+        path = os.path.join(self.directory, segment)
+
+        # write to temporary file first, so segment is either complete or absent
+        with open(path + '.tmp', 'wb') as raw_file:
+            with gzip.open(raw_file, 'wt', encoding='utf-8',
+                           compresslevel=self.compress_level) as file:
+                for record in records:
+                    file.write(json.dumps(record, separators=(',', ':')))
+                    file.write('\n')
+            raw_file.flush()
+            os.fsync(raw_file.fileno())
+        os.replace(path + '.tmp', path)
+
+        with self._lock:
+            self._index.executemany(
+                'INSERT OR REPLACE INTO saga_index (saga_id, segment, line) VALUES (?, ?, ?)',
+                [(record['saga_id'], segment, line) for line, record in enumerate(records)]
+            )
+            self._index.commit()
+
+    def get(self, saga_id: int) -> typing.Optional[dict]:
+        with self._lock:
+            row = self._index.execute('SELECT segment, line FROM saga_index WHERE saga_id = ?',
+                                      (saga_id,)).fetchone()
+        if row is None:
+            return None
+
+        segment, line = row
+        with gzip.open(os.path.join(self.directory, segment), 'rt', encoding='utf-8') as file:
+            return json.loads(next(itertools.islice(file, line, None)))
+
+    def iter_records(self) -> typing.Iterator[dict]:
+        """
+        Yields archived records, segment by segment.
+        Copies of sagas archived again later are skipped:
+         index points to the latest copy of every saga
+        """
+        for segment in self._segment_names():
+            with self._lock:
+                latest_lines = {line for line, in self._index.execute(
+                    'SELECT line FROM saga_index WHERE segment = ?', (segment,))}
+            if not latest_lines:
+                continue
+
+            with gzip.open(os.path.join(self.directory, segment), 'rt',
+                           encoding='utf-8') as file:
+                for line, record in enumerate(file):
+                    if line in latest_lines:
+                        yield json.loads(record)
+
+
+class SagaArchiver:
+    def __init__(self, repository: AbstractSagaStateRepository,
+                 archive: AbstractSagaArchive,
+                 retention: datetime.timedelta,
+                 batch_size: int = 1000):
+        self.repository = repository
+        self.archive = archive
+        self.retention = retention
+        self.batch_size = batch_size
+
+    def run(self, now: datetime.datetime = None, max_batches: int = None) -> int:
+        """
+        Archives sagas finished more than retention ago,
+         returns number of archived sagas
+        """
+        finished_before = (now or datetime.datetime.utcnow()) - self.retention
+        archived = 0
+
+        for _ in itertools.count() if max_batches is None else range(max_batches):
+            saga_ids = self.repository.find_finished_saga_ids(finished_before,
+                                                              limit=self.batch_size)
+            if not saga_ids:
+                break
+
+            self.archive.add(self.repository.export_sagas(saga_ids))
+            with self.repository.transaction():
+                self.repository.delete_sagas(saga_ids)
+
+            archived += len(saga_ids)
+            logger.info('Archived %s sagas so far', archived)
+
+        return archived
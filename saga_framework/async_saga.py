@@ -16,64 +16,381 @@ See AsyncSaga.register_async_step_handlers for more details.
 
 """
 
-__all__ = ['AsyncSaga', 'AsyncStep']
+__all__ = ['AsyncSaga', 'AsyncStep', 'RemoteCompensationError']
 
+import functools
 import logging
 import typing
-
-from celery import Celery, Task
-
-from .base_saga import BaseSaga, BaseStep
-from .utils import success_task_name, failure_task_name, NO_ACTION
+from dataclasses import asdict
+
+if typing.TYPE_CHECKING:
+    from celery import Celery, Task
+
+from .base_saga import BaseSaga, BaseStep, StepKind
+from .batching import CommandBatcher
+from .dead_letters import AbstractDeadLetterStore, DeadLetter
+from .events import SagaEventType, emit_saga_event
+from .locking import StripedLock
+from .memoization import MemoizationPolicy, ResponseCache
+from .outbox import AbstractOutbox
+from .payloads import PayloadRegistry
+from .priority import PriorityLanes
+from .sharding import ConsistentHashRing
+from .utils import success_task_name, failure_task_name, \
+    batch_response_task_name, fused_task_name, fused_response_task_name, \
+    shard_queue_name, compensation_task_name, compensation_retry_task_name, \
+    serialize_saga_error, NO_ACTION
 
 
 logger = logging.getLogger(__name__)
 
+_NOT_CACHED = object()
+
 
 class AsyncStep(BaseStep):
+    __slots__ = ('base_task_name', 'queue', 'on_success', 'on_failure',
+                 'batched', 'fuse_with_next', 'memoize', 'remote_compensation')
+
     def __init__(self,
                  base_task_name: str,
                  queue: str,
                  on_success: typing.Callable = NO_ACTION,
                  on_failure: typing.Callable = NO_ACTION,
-                 *args, **kwargs
+                 *args,
+                 batched: bool = False,
+                 fuse_with_next: bool = False,
+                 memoize: MemoizationPolicy = None,
+                 remote_compensation: bool = False,
+                 **kwargs
                  ):
         self.base_task_name = base_task_name
         self.queue = queue
         self.on_success = on_success
         self.on_failure = on_failure
+        # if True and saga has command_batcher, commands for this step
+        #  are coalesced with other sagas' commands into one batch task
+        self.batched = batched
+        # if True and next step is AsyncStep with the same queue,
+        #  commands for both steps are sent as one fused command
+        #  (see AsyncSaga.get_fused_steps)
+        self.fuse_with_next = fuse_with_next
+        # if set and saga has response_cache, success responses are cached
+        #  and commands with the same payload aren't sent (see memoization.py)
+        self.memoize = memoize
+        # if True, compensation sends '{base_task_name}.compensation' command
+        #  (see AsyncSaga.send_compensation_command) and saga goes on compensating
+        #  previous steps only when its response comes
+        self.remote_compensation = remote_compensation
 
         super().__init__(*args, **kwargs)
 
 
+class RemoteCompensationError(Exception):
+    """
+    Passed to on_compensation_failure when Saga Handler service
+     responded with failure to compensation command
+    """
+    def __init__(self, step_name: str, payload: dict):
+        message = payload.get('message') if isinstance(payload, dict) else payload
+        super().__init__(f'remote compensation of step "{step_name}" failed: {message}')
+        self.payload = payload
+
+
 class AsyncSaga(BaseSaga):
     """
-    Saga that has integration with Celery
+    Saga that has integration with Celery.
+    Instead of Celery app, any transport can be used (see transports.py)
     """
-    celery_app: Celery = None
+    __slots__ = ('celery_app', '_fused_commands')
+
+    command_batcher: CommandBatcher = None
+
+    # if outbox is set, commands are written to it instead of sending them
+    #  directly (see outbox.py)
+    outbox: AbstractOutbox = None
 
-    def __init__(self, celery_app: Celery, *args, **kwargs):
+    # if shard_ring is set, Saga Handler services are asked to respond
+    #  to '{response_queue}.shard.{shard}' queue where shard is chosen by saga_id
+    #  (see sharding.py)
+    response_queue: str = None
+    shard_ring: ConsistentHashRing = None
+
+    # saga priority is propagated to all commands and responses as broker priority;
+    #  if priority_lanes are set, commands and responses are also routed
+    #  to priority lane queues (see priority.py)
+    priority: int = None
+    priority_lanes: PriorityLanes = None
+
+    # if payload_registry is set, on_success/on_failure step callbacks
+    #  receive response payloads decoded to dataclasses (see payloads.py)
+    payload_registry: PayloadRegistry = None
+
+    # messages of one saga are handled one by one within process
+    #  (matters for threads and gevent Celery pools, see locking.py)
+    saga_locks: StripedLock = StripedLock()
+
+    # if dead_letter_store is set, responses that Orchestrator failed to handle
+    #  are saved to it, so they can be replayed later (see dead_letters.py)
+    dead_letter_store: AbstractDeadLetterStore = None
+
+    # if response_cache is set, success responses of steps with memoize policy
+    #  are cached (see memoization.py)
+    response_cache: ResponseCache = None
+
+    def __init__(self, celery_app: 'Celery', *args, **kwargs):
         self.celery_app = celery_app
+        # commands collected while running fused steps
+        self._fused_commands = None  # type: typing.Optional[typing.List[list]]
         super().__init__(*args, **kwargs)
 
+    def handle_message(self, handler: typing.Callable, *args):
+        """
+        Entrypoint for handling every incoming message (response) of a saga:
+         response handlers registered by register_async_step_handlers
+         call handler (like on_async_step_success) through this method.
+        Override it to wrap message handling, e.g. into DB transaction.
+
+        Messages of the same saga are handled under lock,
+         so saga transitions are serialized (see locking.py)
+        """
+        with self.saga_locks.lock_for(self.saga_id):
+            return handler(*args)
+
     def on_async_step_success(self, step: AsyncStep, payload: dict):
-        logger.info(f'Saga {self.saga_id}: '
-                    f'running on_success for "{step.name}" step')
+        with self.profile_phase('on_async_step_success'):
+            with self.profile_phase('logging'):
+                self.emit_event(logging.INFO, SagaEventType.STEP_SUCCEEDED, step)
+
+            if step.memoize and self.response_cache is not None:
+                memo_key = self.response_cache.pop_pending(self.saga_id, step.name)
+                if memo_key is not None:
+                    self.response_cache.put(memo_key, payload, step.memoize.ttl)
+
+            with self.profile_phase('callback'):
+                self.call_step_callable(step.on_success, step, self.decode_response_payload(
+                    success_task_name(step.base_task_name), payload))
+
+            # saga didn't wait for retriable step, so nothing to continue
+            if step.kind == StepKind.RETRIABLE:
+                self.on_retriable_step_success(step, payload)
+            elif self.step_is_last(step):
+                self.on_saga_success()
+            else:
+                next_step = self._get_next_step(step)
+                self.execute(next_step)
+
+    def on_fused_step_success(self, step: AsyncStep, payload: dict):
+        """
+        Runs for every successful step of fused steps group except last one.
+        Unlike on_async_step_success, doesn't launch next step
+         because it was already sent within fused command.
+        """
+        with self.profile_phase('logging'):
+            self.emit_event(logging.INFO, SagaEventType.STEP_SUCCEEDED, step, fused=True)
 
-        step.on_success(step, payload)
+        with self.profile_phase('callback'):
+            self.call_step_callable(step.on_success, step, self.decode_response_payload(
+                success_task_name(step.base_task_name), payload))
 
-        if self.step_is_last(step):
-            self.on_saga_success()
-        else:
-            next_step = self._get_next_step(step)
-            self.execute(next_step)
+    def on_fused_steps_response(self, outcomes: typing.List[list]):
+        """
+        Handles combined response for fused steps.
+        outcomes is a list of [response_task_name, payload] items,
+         one per handled step, in the order steps were handled.
+        Handler stops on first failure, so only last outcome can be a failure.
+        """
+        for i, (response_task_name, payload) in enumerate(outcomes):
+            its_last_outcome = (i == len(outcomes) - 1)
+
+            try:
+                step = self.get_async_step_by_success_task_name(response_task_name)
+            except KeyError:
+                step = self.get_async_step_by_failure_task_name(response_task_name)
+                self.on_async_step_failure(step, payload)
+                return
+
+            if its_last_outcome:
+                self.on_async_step_success(step, payload)
+            else:
+                self.on_fused_step_success(step, payload)
 
     def on_async_step_failure(self, step: AsyncStep, payload: dict):
-        logger.info(f'Saga {self.saga_id}: '
-                    f'running on_failure for "{step.name}" step')
+        with self.profile_phase('on_async_step_failure'):
+            with self.profile_phase('logging'):
+                self.emit_event(logging.INFO, SagaEventType.STEP_FAILED, step)
+
+            if step.memoize and self.response_cache is not None:
+                self.response_cache.pop_pending(self.saga_id, step.name)
+
+            with self.profile_phase('callback'):
+                self.call_step_callable(step.on_failure, step, self.decode_response_payload(
+                    failure_task_name(step.base_task_name), payload))
 
-        step.on_failure(step, payload)
-        self.compensate(step, payload)
+            if step.kind == StepKind.RETRIABLE:
+                self.on_retriable_step_failure(step, payload)
+            else:
+                self.compensate(step, payload)
+
+    def compensation_is_remote(self, step: BaseStep) -> bool:
+        return getattr(step, 'remote_compensation', False)
+
+    def validate_steps(self):
+        super().validate_steps()
+        for step in self.async_steps:
+            if step.remote_compensation and step.compensation is NO_ACTION:
+                raise ValueError(f'step "{step.name}" has remote compensation, '
+                                 f'but no compensation that sends its command')
+        if self.response_queue is None and \
+                any(step.compensation_retry_policy for step in self.steps):
+            # compensation retries are scheduled as messages to saga response queue
+            raise ValueError('saga has steps with compensation retry policy, '
+                             'but no response queue to schedule retries to')
+        if self.response_queue is None and self.response_cache is not None and \
+                any(step.memoize for step in self.async_steps):
+            # cached responses are sent to saga response queue
+            raise ValueError('saga has memoized steps, '
+                             'but no response queue to send cached responses to')
+
+    def get_initial_failure(self) -> typing.Tuple[typing.Optional[BaseStep],
+                                                   typing.Optional[dict]]:
+        """
+        Returns initially failed step and failure payload,
+         so compensation can be continued when remote compensation response comes.
+        Saga that doesn't keep its state can't know them, so (None, None) is returned
+        """
+        return None, None
+
+    def on_async_compensation_success(self, step: AsyncStep, payload: dict):
+        with self.profile_phase('on_async_compensation_success'):
+            failed_step, initial_failure_payload = self.get_initial_failure()
+            with self.profile_phase('compensate'):
+                self._compensate(failed_step, initial_failure_payload, compensated_step=step)
+
+    def on_async_compensation_failure(self, step: AsyncStep, payload: dict):
+        with self.profile_phase('on_async_compensation_failure'):
+            failed_step, initial_failure_payload = self.get_initial_failure()
+            self.on_compensation_failure(
+                initially_failed_step=failed_step,
+                initial_failure_payload=initial_failure_payload,
+                compensation_failed_step=step,
+                compensation_exception=RemoteCompensationError(step.name, payload)
+            )
+
+    def schedule_compensation_retry(self, failed_step: typing.Optional[BaseStep],
+                                    initial_failure_payload: typing.Optional[dict],
+                                    step: BaseStep, retry_number: int, delay: float) -> bool:
+        """
+        Sends '{saga module}.{saga class}.compensation.retry' message to saga response queue
+         with countdown, so worker isn't blocked while waiting for retry.
+        Its handler (see register_async_step_handlers) continues compensation
+        """
+        options = {'countdown': delay}
+        priority = self.get_priority()
+        if priority is not None:
+            options['priority'] = priority
+
+        self._send_command(
+            self.get_compensation_retry_task_name(),
+            args=[
+                self.saga_id,
+                {
+                    'step': step.name,
+                    'retry_number': retry_number,
+                    'failed_step': failed_step.name if failed_step else None,
+                    'initial_failure_payload': initial_failure_payload,
+                }
+            ],
+            queue=self.get_response_queue() or self.response_queue,
+            **options
+        )
+        return True
+
+    @classmethod
+    def get_compensation_retry_task_name(cls) -> str:
+        # class qualname alone can be the same for sagas from different modules
+        return compensation_retry_task_name(f'{cls.__module__}.{cls.__qualname__}')
+
+    def on_compensation_retry(self, payload: dict):
+        failed_step = payload['failed_step'] and self.get_step_by_name(payload['failed_step'])
+        self.retry_compensation(failed_step, payload['initial_failure_payload'],
+                                self.get_step_by_name(payload['step']),
+                                payload['retry_number'])
+
+    def decode_response_payload(self, response_task_name: str, payload):
+        if self.payload_registry is None:
+            return payload
+
+        return self.payload_registry.decode(response_task_name, payload)
+
+    def on_retriable_step_success(self, step: AsyncStep, payload: dict):
+        """
+        This method runs when retriable step (which saga didn't wait for)
+         completes with success
+        """
+        self.emit_event(logging.INFO, SagaEventType.RETRIABLE_STEP_SUCCEEDED, step)
+
+    def get_fused_steps(self, step: BaseStep) -> typing.List[AsyncStep]:
+        """
+        Returns group of consecutive AsyncSteps (starting from given one)
+         that are fused with each other, i.e. have fuse_with_next=True
+         and are sent to the same queue.
+        For not fused step, returns list with single step
+        """
+        fused_steps = [step]
+        while getattr(step, 'fuse_with_next', False):
+            next_step = self._get_next_step(step)
+            # retriable steps aren't awaited, so there's nothing to fuse
+            if not isinstance(next_step, AsyncStep) \
+                    or next_step.queue != fused_steps[0].queue \
+                    or StepKind.RETRIABLE in (step.kind, next_step.kind):
+                break
+
+            fused_steps.append(next_step)
+            step = next_step
+
+        return fused_steps
+
+    def run_step(self, step: BaseStep):
+        # we're already collecting commands of fused steps
+        if self._fused_commands is not None:
+            return super().run_step(step)
+
+        fused_steps = self.get_fused_steps(step)
+        if len(fused_steps) == 1:
+            return super().run_step(step)
+
+        # run actions of all fused steps, but instead of sending commands
+        #  one by one, collect them (see send_message_to_other_service)
+        #  and send as one fused command
+        self._fused_commands = []
+        running_step = step
+        try:
+            super().run_step(step)
+            for running_step in fused_steps[1:]:
+                self.run_step(running_step)
+            fused_commands = self._fused_commands
+        except BaseException as exc:
+            if running_step is step:
+                raise
+            # action of later fused step failed: no command of fused steps was sent,
+            #  so saga fails on the first fused step (steps before it are compensated)
+            #  and the payload names the step which action failed
+            self.compensate(step, dict(asdict(serialize_saga_error(exc)),
+                                       failed_step=running_step.name))
+            return
+        finally:
+            self._fused_commands = None
+
+        queue = self.get_command_queue(step)
+        self._send_command(
+            fused_task_name(queue),
+            args=[
+                self.saga_id,
+                fused_commands
+            ],
+            queue=queue,
+            **self._command_options()
+        )
 
     @property
     def async_steps(self) -> typing.List[AsyncStep]:
@@ -93,53 +410,493 @@ class AsyncSaga(BaseSaga):
 
         raise KeyError(f'no step found with failure task name {failure_task_name_}')
 
+    def get_async_step_by_compensation_response_task_name(self, response_task_name: str) \
+            -> typing.Tuple[AsyncStep, bool]:
+        """
+        Returns step and whether response is a success
+        """
+        for step in self.async_steps:
+            task_name = compensation_task_name(step.base_task_name)
+            if success_task_name(task_name) == response_task_name:
+                return step, True
+            if failure_task_name(task_name) == response_task_name:
+                return step, False
+
+        raise KeyError(f'no step found with compensation response task name '
+                       f'{response_task_name}')
+
+    def on_async_compensation_response(self, response_task_name: str, payload: dict):
+        step, succeeded = self.get_async_step_by_compensation_response_task_name(
+            response_task_name)
+        if succeeded:
+            return self.on_async_compensation_success(step, payload)
+        return self.on_async_compensation_failure(step, payload)
+
+    def on_async_step_response(self, response_task_name: str, payload: dict):
+        """
+        Runs on_async_step_success or on_async_step_failure
+         depending on response task name
+        """
+        for step in self.async_steps:
+            if success_task_name(step.base_task_name) == response_task_name:
+                return self.on_async_step_success(step, payload)
+            if failure_task_name(step.base_task_name) == response_task_name:
+                return self.on_async_step_failure(step, payload)
+            if fused_response_task_name(step.base_task_name) == response_task_name:
+                return self.on_fused_steps_response(payload)
+            if step.remote_compensation and response_task_name in \
+                    _compensation_response_task_names(step):
+                return self.on_async_compensation_response(response_task_name, payload)
+
+        raise KeyError(f'no step found with response task name {response_task_name}')
+
     @classmethod
-    def register_async_step_handlers(cls, celery_app: Celery):
+    def register_async_step_handlers(cls, celery_app: 'Celery', shards: typing.Iterable = None):
+        """
+        If shards are given, worker will consume response queues of these shards
+         (and their priority lanes, if saga has them) in addition to queues
+         it already consumes (see add_consumed_response_queues)
+        """
+        if shards is not None or cls.priority_lanes:
+            cls.add_consumed_response_queues(celery_app, shards)
+
         # noinspection PyTypeChecker
         dummy_saga_instance = cls(None, None)
+        dummy_saga_instance.validate_steps()
+        cls.declare_command_lane_queues(
+            celery_app, [step.queue for step in dummy_saga_instance.async_steps])
 
         for step in dummy_saga_instance.async_steps:
             cls.register_success_handler_for_step(celery_app, step)
             cls.register_failure_handler_for_step(celery_app, step)
 
+            if len(dummy_saga_instance.get_fused_steps(step)) > 1:
+                cls.register_fused_response_handler_for_step(celery_app, step)
+
+            if step.remote_compensation:
+                cls.register_compensation_response_handlers_for_step(celery_app, step)
+
+        if any(step.compensation_retry_policy for step in dummy_saga_instance.steps):
+            cls.register_compensation_retry_handler(celery_app)
+
+        if cls.response_queue is not None:
+            cls.register_batch_response_handler(celery_app)
+
+    @classmethod
+    def add_consumed_response_queues(cls, celery_app: 'Celery',
+                                     shards: typing.Iterable = None) -> typing.List[str]:
+        """
+        Adds response queues of given shards to queues consumed by worker,
+         so several saga classes can share one Celery app.
+        Returns added queues: if worker is started with -Q option, include them there
+        """
+        queues = cls.response_queues(shards)
+        # lane queues support priorities (see priority.py)
+        queue_arguments = cls.priority_lanes.queue_arguments if cls.priority_lanes else None
+        add_consumed_queues = getattr(celery_app, 'add_consumed_queues', None)
+        if add_consumed_queues is not None:  # transport (see transports.py)
+            add_consumed_queues(queues, queue_arguments=queue_arguments)
+        else:
+            for queue in queues:
+                celery_app.amqp.queues.select_add(queue, queue_arguments=queue_arguments)
+
+        return queues
+
+    @classmethod
+    def declare_command_lane_queues(cls, celery_app: 'Celery',
+                                    command_queues: typing.Iterable[str]) -> typing.List[str]:
+        """
+        Declares priority lanes of queues saga sends commands to
+         with priority support (see priority.py), without consuming them:
+         Celery declares queue when it sends message to it,
+         and declarations must match ones of Saga Handler services.
+        In-process transports have no queues to declare
+        """
+        amqp = getattr(celery_app, 'amqp', None)
+        if amqp is None or not cls.priority_lanes:
+            return []
+
+        queues = []
+        for command_queue in command_queues:
+            for queue in cls.priority_lanes.queues(command_queue):
+                if queue not in queues:
+                    amqp.queues.add(queue, queue_arguments=cls.priority_lanes.queue_arguments)
+                    queues.append(queue)
+
+        return queues
+
+    @classmethod
+    def wrap_response_handler(cls, handler: typing.Callable, step_name: str = None,
+                              capture_dead_letters: bool = True) -> typing.Callable:
+        """
+        Wraps Celery task handler of responses:
+         measures its time (see profiling.py) and captures failed responses
+         to dead_letter_store (see dead_letters.py)
+        """
+        @functools.wraps(handler)
+        def wrapper(celery_task: 'Task', *args, **kwargs):
+            with cls.profile_phase('handler'):
+                try:
+                    return handler(celery_task, *args, **kwargs)
+                except Exception as exc:
+                    if capture_dead_letters and cls.dead_letter_store is not None:
+                        cls.capture_dead_letter(celery_task, celery_task.name, list(args),
+                                                exc, step_name)
+                    raise
+
+        return wrapper
+
+    @classmethod
+    def capture_dead_letter(cls, celery_task: 'Task', task_name: str, args: list,
+                            exc: BaseException, step_name: str = None,
+                            message_id: str = None):
+        request = getattr(celery_task, 'request', None)
+        # task will be retried, so it's not dead yet
+        if request is not None and getattr(celery_task, 'autoretry_for', ()) \
+                and request.retries < (celery_task.max_retries or 0):
+            return
+
+        delivery_info = getattr(request, 'delivery_info', None) or {}
+        dead_letter = DeadLetter(
+            saga_class=cls.__qualname__,
+            task_name=task_name,
+            saga_id=args[0] if args else None,
+            args=args,
+            queue=delivery_info.get('routing_key'),
+            headers=dict(getattr(request, 'headers', None) or {}),
+            error=asdict(serialize_saga_error(exc)),
+            step_name=step_name,
+            message_id=message_id or getattr(request, 'id', None),
+        )
+        try:
+            cls.dead_letter_store.add(dead_letter)
+        except Exception as store_exc:
+            logger.exception(store_exc)
+
     @classmethod
-    def register_success_handler_for_step(cls, celery_app: Celery, step: AsyncStep):
-        def on_success_handler(celery_task: Task, saga_id: int, payload: dict):
-            saga = cls(celery_app=celery_app, saga_id=saga_id)
+    def register_success_handler_for_step(cls, celery_app: 'Celery', step: AsyncStep):
+        def on_success_handler(celery_task: 'Task', saga_id: int, payload: dict):
+            with cls.profile_phase('construction'):
+                saga = cls(celery_app=celery_app, saga_id=saga_id)
 
-            step_ = saga.get_async_step_by_success_task_name(celery_task.name)
-            saga.on_async_step_success(step_, payload)
+            with cls.profile_phase('step_lookup'):
+                step_ = saga.get_async_step_by_success_task_name(celery_task.name)
+            saga.handle_message(saga.on_async_step_success, step_, payload)
 
         celery_app.task(
             name=success_task_name(step.base_task_name),
             bind=True
-        )(on_success_handler)
+        )(cls.wrap_response_handler(on_success_handler, step.name))
 
     @classmethod
-    def register_failure_handler_for_step(cls, celery_app: Celery, step: AsyncStep):
+    def register_failure_handler_for_step(cls, celery_app: 'Celery', step: AsyncStep):
 
-        def on_failure_handler(celery_task: Task, saga_id: int, payload: dict):
-            saga = cls(celery_app, saga_id)
+        def on_failure_handler(celery_task: 'Task', saga_id: int, payload: dict):
+            with cls.profile_phase('construction'):
+                saga = cls(celery_app, saga_id)
 
-            step_ = saga.get_async_step_by_failure_task_name(celery_task.name)
-            saga.on_async_step_failure(step_, payload)
+            with cls.profile_phase('step_lookup'):
+                step_ = saga.get_async_step_by_failure_task_name(celery_task.name)
+            saga.handle_message(saga.on_async_step_failure, step_, payload)
 
         celery_app.task(
             name=failure_task_name(step.base_task_name),
             bind=True
-        )(on_failure_handler)
+        )(cls.wrap_response_handler(on_failure_handler, step.name))
+
+    @classmethod
+    def register_fused_response_handler_for_step(cls, celery_app: 'Celery', step: AsyncStep):
+        def on_fused_response_handler(celery_task: 'Task', saga_id: int, outcomes: list):
+            with cls.profile_phase('construction'):
+                saga = cls(celery_app, saga_id)
+            saga.handle_message(saga.on_fused_steps_response, outcomes)
+
+        celery_app.task(
+            name=fused_response_task_name(step.base_task_name),
+            bind=True
+        )(cls.wrap_response_handler(on_fused_response_handler, step.name))
+
+    @classmethod
+    def register_compensation_response_handlers_for_step(cls, celery_app: 'Celery',
+                                                         step: AsyncStep):
+        def on_compensation_response_handler(celery_task: 'Task', saga_id: int, payload: dict):
+            with cls.profile_phase('construction'):
+                saga = cls(celery_app, saga_id)
+            saga.handle_message(saga.on_async_compensation_response, celery_task.name, payload)
+
+        for response_task_name in _compensation_response_task_names(step):
+            celery_app.task(
+                name=response_task_name,
+                bind=True
+            )(cls.wrap_response_handler(on_compensation_response_handler, step.name))
+
+    @classmethod
+    def register_compensation_retry_handler(cls, celery_app: 'Celery'):
+        def on_compensation_retry_handler(celery_task: 'Task', saga_id: int, payload: dict):
+            with cls.profile_phase('construction'):
+                saga = cls(celery_app, saga_id)
+            saga.handle_message(saga.on_compensation_retry, payload)
+
+        celery_app.task(
+            name=cls.get_compensation_retry_task_name(),
+            bind=True
+        )(cls.wrap_response_handler(on_compensation_retry_handler))
+
+    @classmethod
+    def register_batch_response_handler(cls, celery_app: 'Celery', response_queue: str = None):
+        """
+        Registers handler for batch responses that Saga Handler services
+         send when they use ResponseBatcher (see batching.py).
+        Batch task name depends on queue responses are sent to, so handler is registered
+         for every shard and priority lane of saga response queue
+         (register_async_step_handlers does it if saga has response_queue)
+        """
+        def on_batch_response_handler(celery_task: 'Task', responses: typing.List[list]):
+            _handle_batch_response(
+                responses,
+                lambda saga_id: cls(celery_app, saga_id),
+                functools.partial(_capture_batch_response, cls, celery_task)
+            )
+
+        for queue in cls.batch_response_queues(response_queue):
+            celery_app.task(
+                name=batch_response_task_name(queue),
+                bind=True
+            )(cls.wrap_response_handler(on_batch_response_handler, capture_dead_letters=False))
+
+    @classmethod
+    def batch_response_queues(cls, response_queue: str = None) -> typing.List[str]:
+        """
+        Returns queues that batch responses for this saga class can be sent to:
+         given response queue and, if it's saga response queue (or none is given),
+         all its shards and priority lanes
+        """
+        queues = [] if response_queue is None else [response_queue]
+        if response_queue is None or response_queue == cls.response_queue:
+            queues += [queue for queue in cls.response_queues() if queue not in queues]
+        return queues
+
+    def send_cached_response(self, step: AsyncStep, payload: dict):
+        """
+        Sends cached success response of memoized step to saga response queue,
+         so it's handled like the real one (after action finishes)
+        """
+        options = {}
+        priority = self.get_priority()
+        if priority is not None:
+            options['priority'] = priority
+
+        self._send_command(
+            success_task_name(step.base_task_name),
+            args=[self.saga_id, payload],
+            queue=self.get_response_queue() or self.response_queue,
+            **options
+        )
 
     def send_message_to_other_service(self, step: AsyncStep, payload: dict, task_name: str = None):
         """
         Helper for sending Celery tasks to Async Handler Services
+
+        For batched steps (if saga has command_batcher), command is buffered
+         and sent later as a part of batch task, so None is returned
+         instead of task id.
+        For fused steps, command is collected and sent later
+         as a part of fused command (see run_step), so None is returned as well.
+        If saga has outbox, command is written to outbox (even for batched steps)
+         and will be published by OutboxRelay (see outbox.py)
+        If step is memoized and response is cached, command isn't sent:
+         cached response is sent to saga response queue instead, so None is returned
         """
-        task_result = self.celery_app.send_task(
+        if step.memoize and self.response_cache is not None and self._fused_commands is None:
+            memo_key = (task_name or step.base_task_name, step.memoize.key(payload))
+            cached_payload = self.response_cache.get(memo_key, _NOT_CACHED)
+            if cached_payload is not _NOT_CACHED:
+                self.send_cached_response(step, cached_payload)
+                return None
+
+            self.response_cache.add_pending(self.saga_id, step.name, memo_key)
+
+        if self._fused_commands is not None:
+            self._fused_commands.append([task_name or step.base_task_name, payload])
+            return None
+
+        if step.batched and self.command_batcher and not self.outbox:
+            with self.profile_phase('send_task'):
+                self.command_batcher.add_command(task_name or step.base_task_name,
+                                                 self.get_command_queue(step),
+                                                 self.saga_id, payload,
+                                                 response_queue=self.get_response_queue(),
+                                                 priority=self.get_priority())
+            return None
+
+        return self._send_command(
             task_name or step.base_task_name,
             args=[
                 self.saga_id,
                 payload
             ],
-            queue=step.queue
+            queue=self.get_command_queue(step),
+            **self._command_options()
         )
 
-        return task_result.id
+    def send_compensation_command(self, step: AsyncStep, payload: dict) -> str:
+        """
+        Sends '{base_task_name}.compensation' command from compensation
+         of step with remote_compensation=True.
+        Saga Handler service handles it like any other command
+         (e.g. with @saga_step_handler), and its response continues compensation
+        """
+        return self._send_command(
+            compensation_task_name(step.base_task_name),
+            args=[
+                self.saga_id,
+                payload
+            ],
+            queue=self.get_command_queue(step),
+            **self._command_options()
+        )
+
+    def _send_command(self, task_name: str, args: list, queue: str, **options) -> str:
+        with self.profile_phase('send_task'):
+            if self.outbox:
+                return self.outbox.add(self.saga_id, task_name, queue, args, options)
+
+            return self.celery_app.send_task(task_name, args=args, queue=queue,
+                                             **options).id
+
+    def get_priority(self) -> typing.Optional[int]:
+        return self.priority
+
+    def get_command_queue(self, step: AsyncStep) -> str:
+        if self.priority_lanes:
+            return self.priority_lanes.queue_for(step.queue, self.get_priority())
+
+        return step.queue
+
+    def get_response_queue(self) -> typing.Optional[str]:
+        """
+        Returns queue that Saga Handler services should respond to.
+        None means that they respond to the queue set in @saga_step_handler
+        """
+        if not (self.shard_ring or self.priority_lanes):
+            return None
+
+        response_queue = self.response_queue
+        if self.shard_ring:
+            response_queue = shard_queue_name(response_queue,
+                                              self.shard_ring.get_node(self.saga_id))
+        if self.priority_lanes:
+            response_queue = self.priority_lanes.queue_for(response_queue,
+                                                           self.get_priority())
+
+        return response_queue
+
+    def _command_options(self) -> dict:
+        """
+        Extra send_task options for commands sent to Saga Handler services
+        """
+        options = {}
+        command_kwargs = {}
+
+        response_queue = self.get_response_queue()
+        if response_queue is not None:
+            command_kwargs['response_queue'] = response_queue
+
+        priority = self.get_priority()
+        if priority is not None:
+            options['priority'] = priority
+            # ask Saga Handler service to respond with the same priority
+            command_kwargs['priority'] = priority
+
+        if command_kwargs:
+            options['kwargs'] = command_kwargs
+
+        return options
+
+    @classmethod
+    def response_queues(cls, shards: typing.Iterable = None) -> typing.List[str]:
+        """
+        Returns response queues for given shards (all shards by default)
+         including their priority lanes
+        """
+        if cls.shard_ring is None:
+            response_queues = [cls.response_queue]
+        else:
+            if shards is None:
+                shards = cls.shard_ring.nodes
+            response_queues = [shard_queue_name(cls.response_queue, shard)
+                               for shard in shards]
+
+        if cls.priority_lanes:
+            return [lane_queue
+                    for response_queue in response_queues
+                    for lane_queue in cls.priority_lanes.queues(response_queue)]
+
+        return response_queues
+
+
+def _compensation_response_task_names(step: AsyncStep) -> typing.Tuple[str, str]:
+    task_name = compensation_task_name(step.base_task_name)
+    return success_task_name(task_name), failure_task_name(task_name)
+
+
+def _capture_batch_response(saga_class: typing.Type[AsyncSaga], celery_task: 'Task',
+                            index: int, response: list, saga: typing.Optional[AsyncSaga],
+                            exc: BaseException):
+    if saga_class.dead_letter_store is None:
+        return
+
+    response_task_name, saga_id, payload = response
+    step_name = None
+    if saga is not None:
+        step_name = next((step.name for step in saga.async_steps
+                          if response_task_name in (success_task_name(step.base_task_name),
+                                                    failure_task_name(step.base_task_name),
+                                                    fused_response_task_name(step.base_task_name),
+                                                    *_compensation_response_task_names(step))),
+                         None)
+
+    request_id = getattr(getattr(celery_task, 'request', None), 'id', None)
+    saga_class.capture_dead_letter(celery_task, response_task_name, [saga_id, payload], exc,
+                                   step_name,
+                                   message_id=request_id and f'{request_id}:{index}')
+
+
+def _handle_batch_response(responses: typing.List[list],
+                           saga_factory: typing.Callable[[int], AsyncSaga],
+                           on_response_failure: typing.Callable = None):
+    """
+    Handles responses in the order they were sent.
+    If handling of some response fails, further responses for the same saga
+     are skipped (but other sagas' responses are still handled)
+     and first error is re-raised after whole batch is processed.
+
+    on_response_failure(index, response, saga or None, exception) is called
+     for every failed or skipped response
+    """
+    failed_saga_ids = set()
+    first_exception = None
+
+    for index, (response_task_name, saga_id, payload) in enumerate(responses):
+        if saga_id in failed_saga_ids:
+            emit_saga_event(logger, logging.WARNING, SagaEventType.RESPONSE_SKIPPED, saga_id,
+                            response_task_name=response_task_name)
+            if on_response_failure:
+                on_response_failure(index, responses[index], None, RuntimeError(
+                    'skipped because previous response for this saga failed'))
+            continue
+
+        saga = None
+        try:
+            saga = saga_factory(saga_id)
+            saga.handle_message(saga.on_async_step_response, response_task_name, payload)
+        except Exception as exc:
+            emit_saga_event(logger, logging.ERROR, SagaEventType.RESPONSE_FAILED, saga_id,
+                            exc_info=exc, response_task_name=response_task_name)
+            failed_saga_ids.add(saga_id)
+            first_exception = first_exception or exc
+            if on_response_failure:
+                on_response_failure(index, responses[index], saga, exc)
+
+    if first_exception:
+        raise first_exception
@@ -1,38 +1,175 @@
-__all__ = ['BaseStep', 'SyncStep', 'BaseSaga', 'NO_ACTION']
+__all__ = ['StepKind', 'RetryPolicy', 'BaseStep', 'SyncStep', 'BaseSaga', 'NO_ACTION']
 
+import contextlib
+import enum
+import functools
 import logging
+import time
+import types
 import typing
 from abc import ABC
-from dataclasses import asdict
+from dataclasses import asdict, dataclass
 
-from .utils import serialize_saga_error, \
-    format_exception_as_python_does, NO_ACTION
+from .events import SagaEventType, emit_saga_event
+from .profiling import SagaProfiler
+from .utils import serialize_saga_error, NO_ACTION
 
 logger = logging.getLogger(__name__)
 
+_NOT_PROFILED = contextlib.nullcontext()
+
+
+class StepKind(str, enum.Enum):
+    """
+    Saga consists of compensatable steps, then (optional) pivot step,
+     then retriable steps.
+
+    Once pivot step succeeds, saga can't be rolled back anymore.
+    Retriable steps are ones that can't fail permanently (they are retried
+     until they succeed) and thus have no compensation.
+    So saga doesn't wait for them: they are dispatched together
+     right after pivot step and saga is marked as succeeded immediately,
+     while their completion is tracked asynchronously.
+    """
+    COMPENSATABLE = 'compensatable'
+    PIVOT = 'pivot'
+    RETRIABLE = 'retriable'
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """
+    Policy of retrying a callable (like step compensation).
+    Delay before n-th retry is delay * backoff ** (n - 1), but not more than max_delay
+    """
+    max_attempts: int = 3
+    delay: float = 0.0  # seconds
+    backoff: float = 2.0
+    max_delay: typing.Optional[float] = None
+    retry_on: typing.Tuple[typing.Type[BaseException], ...] = (Exception,)
+
+    def get_delay(self, retry_number: int) -> float:
+        delay = self.delay * self.backoff ** (retry_number - 1)
+        if self.max_delay is not None:
+            delay = min(delay, self.max_delay)
+        return delay
+
 
 class BaseStep(ABC):
+    """
+    Step definition. Steps are frozen after creation
+     so they can be safely shared between saga instances
+     (see BaseSaga docstring)
+
+    If compensation_retry_policy is set, failed compensation is retried
+     before saga gives up (see BaseSaga.schedule_compensation_retry
+     and BaseSaga.on_compensation_failure)
+    """
+    __slots__ = ('name', 'action', 'compensation', 'kind',
+                 'compensation_retry_policy', '_frozen')
+
     def __init__(self,
                  name: str,
                  action: typing.Callable = NO_ACTION,
                  compensation: typing.Callable = NO_ACTION,
+                 kind: StepKind = StepKind.COMPENSATABLE,
+                 compensation_retry_policy: RetryPolicy = None,
                  ):
         self.name = name
         self.action = action
         self.compensation = compensation
+        self.kind = kind
+        self.compensation_retry_policy = compensation_retry_policy
+        self._frozen = True
+
+    def __setattr__(self, key, value):
+        if getattr(self, '_frozen', False):
+            raise AttributeError(f'{type(self).__name__} "{self.name}" is frozen, '
+                                 f'can\'t set "{key}" attribute')
+        super().__setattr__(key, value)
+
+    def __repr__(self):
+        return f'<{type(self).__name__} "{self.name}">'
 
 
 class SyncStep(BaseStep):
-    pass
+    __slots__ = ()
+
+
+@functools.lru_cache(maxsize=None)
+def _class_body_qualnames(saga_class: type) -> typing.FrozenSet[typing.Tuple[str, str]]:
+    return frozenset((klass.__module__, klass.__qualname__) for klass in saga_class.__mro__)
+
+
+def _is_defined_in_class_body(func: types.FunctionType, saga_class: type) -> bool:
+    # function (or lambda) defined in body of saga class or its base
+    #  has qualname like 'SagaClass.func'
+    owner_qualname = func.__qualname__.rpartition('.')[0]
+    return (func.__module__, owner_qualname) in _class_body_qualnames(saga_class)
 
 
 class BaseSaga:
-    saga_id: int = None
+    """
+    Steps can be declared either per instance (in __init__)
+     or once on class level, so they are shared between all saga instances:
+
+    class Saga(BaseSaga):
+        __slots__ = ()  # saga instance will carry only per-saga fields
+
+        def charge_card(self, step: BaseStep):
+            ...
+
+        steps = [
+            SyncStep(name='charge_card', action=charge_card)
+        ]
+
+    Callables of class-level steps are called like methods,
+     i.e. saga instance is passed as first argument.
+
+    Set profiler to time phases of saga execution (see profiling.py)
+
+    Saga events (step started, saga failed, etc.) are logged
+     to event_logger as structured events (see events.py)
+    """
+    __slots__ = ('saga_id', '__weakref__')
+
     steps: typing.List[BaseStep] = None
 
+    profiler: SagaProfiler = None
+
+    event_logger: logging.Logger = logger
+
     def __init__(self, saga_id: int):
         self.saga_id = saga_id
 
+    @classmethod
+    def profile_phase(cls, phase: str) -> typing.ContextManager:
+        if cls.profiler is None:
+            return _NOT_PROFILED
+
+        return cls.profiler.measure(cls.__qualname__, phase)
+
+    def emit_event(self, level: int, event_type: SagaEventType, step: BaseStep = None,
+                   exc_info: BaseException = None, **details):
+        """
+        Logs structured saga event (see events.py) to event_logger.
+        Costs just a level check if event_logger isn't enabled for level
+        """
+        emit_saga_event(self.event_logger, level, event_type, self.saga_id,
+                        step.name if step else None, exc_info, **details)
+
+    def call_step_callable(self, func: typing.Callable, step: BaseStep, *args):
+        """
+        Calls step action, compensation or callback
+        """
+        # class-level steps hold plain functions from class body,
+        #  so bind them to saga instance (but not other functions, like module-level helpers)
+        if type(func) is types.FunctionType and self.steps is type(self).steps \
+                and _is_defined_in_class_body(func, type(self)):
+            return func(self, step, *args)
+
+        return func(step, *args)
+
     def get_first_step(self) -> BaseStep:
         return self.steps[0]
 
@@ -76,20 +213,106 @@ class BaseSaga:
     def step_is_last(self, step: BaseStep):
         return step == self.steps[-1]
 
+    def validate_steps(self):
+        """
+        Checks that steps go in order: compensatable, pivot, retriable
+        """
+        pivot_steps = [step for step in self.steps if step.kind == StepKind.PIVOT]
+        if len(pivot_steps) > 1:
+            raise ValueError(f'saga can have only one pivot step, '
+                             f'got {[step.name for step in pivot_steps]}')
+
+        retriable_step_met = False
+        for step in self.steps:
+            if step.kind == StepKind.RETRIABLE:
+                retriable_step_met = True
+                if step.compensation is not NO_ACTION:
+                    raise ValueError(f'retriable step "{step.name}" can\'t have compensation')
+            elif retriable_step_met:
+                raise ValueError(f'{step.kind.value} step "{step.name}" '
+                                 f'can\'t go after retriable steps')
+
     def run_step(self, step: BaseStep):
-        logger.info(f'Saga {self.saga_id}: running "{step.name}" step')
-        step.action(step)
+        with self.profile_phase('logging'):
+            self.emit_event(logging.INFO, SagaEventType.STEP_STARTED, step)
+        with self.profile_phase('action'):
+            self.call_step_callable(step.action, step)
 
     def compensate_step(self, step: BaseStep, initial_failure_payload: dict):
-        logger.info(f'Saga {self.saga_id}: '
-                    f'compensating "{step.name}" step')
-        step.compensation(step)
+        with self.profile_phase('logging'):
+            self.emit_event(logging.INFO, SagaEventType.STEP_COMPENSATING, step)
+        with self.profile_phase('compensation'):
+            self.call_step_callable(step.compensation, step)
 
     def compensate(self, failed_step: BaseStep, initial_failure_payload: dict = None):
+        with self.profile_phase('compensate'):
+            self._compensate(failed_step, initial_failure_payload)
+
+    def resume_compensation(self, failed_step: BaseStep, initial_failure_payload: dict = None):
+        """
+        Continues compensation that was stopped by compensation failure
+         (see on_compensation_failure) from the step which compensation failed.
+        It's the same as compensate: steps that were already compensated
+         (see save_compensation_checkpoint) aren't compensated again
+        """
+        return self.compensate(failed_step, initial_failure_payload)
+
+    def retry_compensation(self, failed_step: typing.Optional[BaseStep],
+                           initial_failure_payload: typing.Optional[dict],
+                           step: BaseStep, retry_number: int):
+        """
+        Continues compensation with retry of step compensation
+         scheduled by schedule_compensation_retry
+        """
+        with self.profile_phase('compensate'):
+            self._compensate(failed_step, initial_failure_payload,
+                             retried_step=step, retry_number=retry_number)
+
+    def _compensate(self, failed_step: BaseStep, initial_failure_payload: dict = None,
+                    compensated_step: BaseStep = None, retried_step: BaseStep = None,
+                    retry_number: int = 0):
+        """
+        If compensated_step is given, its remote compensation has just succeeded
+         and compensation continues from previous step (see compensation_is_remote).
+        If retried_step is given, compensation continues from it,
+         retry_number is number of its compensation retry
+        """
+        step = compensated_step or retried_step
         try:
-            step = self._get_previous_step(failed_step)
+            if compensated_step is not None:
+                self.on_step_compensated(compensated_step)
+                step = self._get_previous_step(compensated_step)
+            elif retried_step is None:
+                checkpoint = self.get_compensation_checkpoint()
+                if checkpoint is None:
+                    step = self._get_previous_step(failed_step)
+                else:
+                    step = self.steps[checkpoint - 1] if checkpoint else None
+
             while step:
-                self.compensate_step(step, initial_failure_payload)
+                try:
+                    self.compensate_step(step, initial_failure_payload)
+                except BaseException as exc:
+                    retry_policy = step.compensation_retry_policy
+                    if retry_policy is None or not isinstance(exc, retry_policy.retry_on) \
+                            or retry_number + 1 >= retry_policy.max_attempts:
+                        raise
+
+                    retry_number += 1
+                    self.emit_event(logging.WARNING, SagaEventType.COMPENSATION_RETRY, step,
+                                    error=exc, retry_number=retry_number)
+                    if self.schedule_compensation_retry(failed_step, initial_failure_payload,
+                                                        step, retry_number,
+                                                        retry_policy.get_delay(retry_number)):
+                        return
+                    continue
+
+                retry_number = 0
+                # compensation command was sent, response will continue compensation
+                if self.compensation_is_remote(step):
+                    return
+
+                self.on_step_compensated(step)
                 step = self._get_previous_step(step)
 
             self.on_saga_failure(failed_step, initial_failure_payload)
@@ -98,11 +321,57 @@ class BaseSaga:
             self.on_compensation_failure(
                 initially_failed_step=failed_step,
                 initial_failure_payload=initial_failure_payload,
-                compensation_failed_step=failed_step,
+                compensation_failed_step=step or failed_step,
                 compensation_exception=exception
             )
 
+    def schedule_compensation_retry(self, failed_step: BaseStep,
+                                    initial_failure_payload: typing.Optional[dict],
+                                    step: BaseStep, retry_number: int, delay: float) -> bool:
+        """
+        Schedules retry of step compensation in delay seconds
+         (see BaseStep.compensation_retry_policy).
+        Returns True if retry is scheduled: then compensation stops
+         and is continued later with retry_compensation.
+        BaseSaga has nothing to schedule retry with, so it waits and retries in place
+         (AsyncSaga sends a message with countdown instead)
+        """
+        time.sleep(delay)
+        return False
+
+    def compensation_is_remote(self, step: BaseStep) -> bool:
+        """
+        Remote compensation only sends a command, so saga doesn't wait for it:
+         compensation continues when response comes (see AsyncStep.remote_compensation)
+        """
+        return False
+
+    def on_step_compensated(self, step: BaseStep):
+        """
+        This method runs after every successful step compensation
+        """
+        self.save_compensation_checkpoint(step)
+        self.emit_event(logging.DEBUG, SagaEventType.STEP_COMPENSATED, step)
+
+    def get_compensation_checkpoint(self) -> typing.Optional[int]:
+        """
+        Returns index of the last compensated step
+         or None if compensation wasn't started yet.
+        Sagas that keep their state override it
+         to make compensation resumable (see resume_compensation)
+        """
+        return None
+
+    def save_compensation_checkpoint(self, compensated_step: BaseStep):
+        """
+        This method runs after every successful step compensation
+        """
+
     def execute(self, starting_step: BaseStep = None):
+        with self.profile_phase('execute'):
+            self._execute(starting_step)
+
+    def _execute(self, starting_step: BaseStep = None):
         if starting_step is None:
             starting_step = self.steps[0]
 
@@ -116,13 +385,21 @@ class BaseSaga:
                 self.run_step(step)
 
             except BaseException as exc:
-                exception = exc
-                break
+                # retriable steps can't be compensated, so just report a failure
+                #  and go on
+                if step.kind == StepKind.RETRIABLE:
+                    self.on_retriable_step_failure(
+                        step, asdict(serialize_saga_error(exc)))
+                else:
+                    exception = exc
+                    break
 
             # After running a step, we will run next one if current step was sync
             # For AsyncStep's, we firstly wait for on_success event from step handlers
-            #  and only then continue saga (see on_async_step_success method)
-            need_to_run_next_step = isinstance(step, SyncStep)
+            #  and only then continue saga (see on_async_step_success method).
+            # Retriable steps are an exception: we don't wait for them
+            need_to_run_next_step = isinstance(step, SyncStep) \
+                                    or step.kind == StepKind.RETRIABLE
             if need_to_run_next_step:
                 step = self._get_next_step(step)
 
@@ -141,14 +418,24 @@ class BaseSaga:
         This method runs when saga is fully completed with success
         """
 
-        logger.info(f'Saga {self.saga_id} succeeded')
+        self.emit_event(logging.INFO, SagaEventType.SAGA_SUCCEEDED)
+
+    def on_retriable_step_failure(self, step: BaseStep, failure_payload: dict):
+        """
+        This method runs when retriable step failed
+         (i.e. it failed even after all retries).
+        Saga is already succeeded at this moment, so it can't be rolled back:
+         override this method to alert or to re-dispatch a step
+        """
+        self.emit_event(logging.ERROR, SagaEventType.RETRIABLE_STEP_FAILED, step,
+                        failure_details=failure_payload)
 
     def on_saga_failure(self, failed_step: BaseStep, initial_failure_payload: dict):
         """
         This method runs when saga is failed (after all compensations finished)
         """
-        logger.info(f'Saga {self.saga_id} failed on "{failed_step.name}" step. \n'
-                    f'Failure details: {initial_failure_payload}')
+        self.emit_event(logging.INFO, SagaEventType.SAGA_FAILED, failed_step,
+                        failure_details=initial_failure_payload)
 
     def on_compensation_failure(self, initially_failed_step: BaseStep,
                                 initial_failure_payload: dict,
@@ -158,7 +445,7 @@ class BaseSaga:
         This method runs when compensation step unexpectedly failed,
           i.e. saga wasn't able to successfully rollback
         """
-        logger.info(f'Saga {self.saga_id} failed while compensating "{compensation_failed_step.name}" step.\n'
-                    f'Error details: {format_exception_as_python_does(compensation_exception)} \n \n'
-                    f'Initial failure details: {initial_failure_payload}')
+        self.emit_event(logging.ERROR, SagaEventType.COMPENSATION_FAILED, compensation_failed_step,
+                        exc_info=compensation_exception,
+                        initial_failure_details=initial_failure_payload)
 
@@ -0,0 +1,190 @@
+"""
+This module contains helpers for coalescing many small broker messages
+ into one batch message.
+
+For example, when many sagas run the same AsyncStep within milliseconds,
+ AsyncSaga can buffer 'create_restaurant_ticket' commands with CommandBatcher
+ and send them as one 'create_restaurant_ticket.batch' Celery task.
+Saga Handler service processes such task with @batch_saga_step_handler
+ (see saga_handlers.py) and responds to every saga separately.
+
+Similarly, Saga Handler service can buffer its responses with ResponseBatcher
+ and send them as one '{response_queue}.responses.batch' Celery task
+ that Orchestrator handles with AsyncSaga.register_batch_response_handler.
+
+Buffered items are flushed on interpreter exit (see close_all_batchers),
+ so they aren't lost when process stops before max_delay passes.
+Celery worker child processes may exit without running exit handlers,
+ so Celery workers should also call close_batchers_on_worker_shutdown (see celery_utils.py).
+"""
+
+__all__ = ['MessageBatcher', 'CommandBatcher', 'ResponseBatcher', 'close_all_batchers']
+
+import atexit
+import threading
+import typing
+import weakref
+
+from .utils import batch_task_name, batch_response_task_name
+
+
+class MessageBatcher:
+    """
+    Buffers items by key and passes them to flush_callback as one batch
+     when max_batch_size items are collected or max_delay seconds passed
+     since the first item was buffered.
+
+    If max_delay is None, batch is flushed only when it's full
+     or when flush() is called explicitly.
+
+    After close(), items aren't buffered anymore: each one is flushed right away
+    """
+    def __init__(self,
+                 flush_callback: typing.Callable[[typing.Hashable, list], typing.Any],
+                 max_batch_size: int = 100,
+                 max_delay: typing.Optional[float] = 0.01):
+        self.flush_callback = flush_callback
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+
+        self._buffers = {}  # type: typing.Dict[typing.Hashable, list]
+        self._timers = {}  # type: typing.Dict[typing.Hashable, threading.Timer]
+        self._lock = threading.Lock()
+        self._closed = False
+
+        _open_batchers.add(self)
+
+    def add(self, key: typing.Hashable, item):
+        with self._lock:
+            buffer = self._buffers.setdefault(key, [])
+            buffer.append(item)
+
+            if self._closed or len(buffer) >= self.max_batch_size:
+                items = self._pop_buffer(key)
+            else:
+                items = None
+                if self.max_delay is not None and key not in self._timers:
+                    timer = threading.Timer(self.max_delay, self.flush, args=(key,))
+                    timer.daemon = True
+                    self._timers[key] = timer
+                    timer.start()
+
+        if items:
+            self.flush_callback(key, items)
+
+    def flush(self, key: typing.Hashable = None):
+        """
+        Flush buffered items for a given key (or for all keys if key is None)
+        """
+        with self._lock:
+            keys = list(self._buffers) if key is None else [key]
+            batches = [(key_, self._pop_buffer(key_)) for key_ in keys]
+
+        for key_, items in batches:
+            if items:
+                self.flush_callback(key_, items)
+
+    def close(self):
+        """
+        Flushes all buffered items and stops buffering new ones.
+        Call it on shutdown
+        """
+        with self._lock:
+            self._closed = True
+        self.flush()
+        _open_batchers.discard(self)
+
+    def pending_count(self, key: typing.Hashable = None) -> int:
+        with self._lock:
+            if key is not None:
+                return len(self._buffers.get(key, ()))
+            return sum(len(buffer) for buffer in self._buffers.values())
+
+    def _pop_buffer(self, key: typing.Hashable) -> list:
+        # should be called under self._lock
+        timer = self._timers.pop(key, None)
+        if timer:
+            timer.cancel()
+
+        return self._buffers.pop(key, [])
+
+
+_open_batchers = weakref.WeakSet()  # type: typing.MutableSet[MessageBatcher]
+
+
+@atexit.register
+def close_all_batchers():
+    """
+    Closes (and so flushes) all batchers of this process
+    """
+    for batcher in list(_open_batchers):
+        batcher.close()
+
+
+class CommandBatcher(MessageBatcher):
+    """
+    Coalesces saga commands for the same task name, queue and priority
+     into one '{task_name}.batch' Celery task.
+
+    Batch task has single argument: list of [saga_id, payload] pairs
+     (or [saga_id, payload, response_queue] if saga asks for specific response queue).
+    Batch task is sent with commands' priority, and Saga Handler service
+     is asked to respond with it (like for regular commands)
+    """
+    def __init__(self, celery_app, max_batch_size: int = 100,
+                 max_delay: typing.Optional[float] = 0.01):
+        self.celery_app = celery_app
+        super().__init__(self._send_batch, max_batch_size, max_delay)
+
+    def add_command(self, task_name: str, queue: str, saga_id: int, payload: dict,
+                    response_queue: str = None, priority: int = None):
+        command = [saga_id, payload]
+        if response_queue:
+            command.append(response_queue)
+
+        self.add((task_name, queue, priority), command)
+
+    def _send_batch(self, key: typing.Tuple[str, str, typing.Optional[int]], commands: list):
+        task_name, queue, priority = key
+        options = {}
+        if priority is not None:
+            options['priority'] = priority
+            options['kwargs'] = {'priority': priority}
+
+        self.celery_app.send_task(
+            batch_task_name(task_name),
+            args=[commands],
+            queue=queue,
+            **options
+        )
+
+
+class ResponseBatcher(MessageBatcher):
+    """
+    Coalesces saga responses bound for the same response queue with the same priority
+     into one '{response_queue}.responses.batch' Celery task.
+
+    Batch task has single argument: list of [response_task_name, saga_id, payload]
+     items in the order responses were produced.
+    """
+    def __init__(self, celery_app, max_batch_size: int = 100,
+                 max_delay: typing.Optional[float] = 0.01):
+        self.celery_app = celery_app
+        super().__init__(self._send_batch, max_batch_size, max_delay)
+
+    def add_response(self, response_task_name: str, response_queue: str,
+                     saga_id: int, payload, priority: int = None):
+        self.add((response_queue, priority), [response_task_name, saga_id, payload])
+
+    def _send_batch(self, key: typing.Tuple[str, typing.Optional[int]], responses: list):
+        response_queue, priority = key
+        options = {}
+        if priority is not None:
+            options['priority'] = priority
+
+        self.celery_app.send_task(
+            batch_response_task_name(response_queue),
+            args=[responses],
+            queue=response_queue,
+            **options
+        )
@@ -1,10 +1,16 @@
-__all__ = ['auto_retry_then_reraise', 'close_sqlalchemy_db_connection_after_celery_task_ends']
+__all__ = ['auto_retry_then_reraise', 'close_sqlalchemy_db_connection_after_celery_task_ends',
+           'rebalance_worker_queues', 'close_batchers_on_worker_shutdown',
+           'add_consumed_priority_lanes']
 
 import functools
+import typing
 
 from celery import Task
 from celery.exceptions import MaxRetriesExceededError
-from celery.signals import task_postrun
+from celery.signals import task_postrun, worker_process_shutdown, worker_shutdown
+
+from .batching import close_all_batchers
+from .priority import PriorityLanes
 
 
 def auto_retry_then_reraise(max_retries: int = 3, **retry_kwargs):
@@ -40,3 +46,59 @@ def close_sqlalchemy_db_connection_after_celery_task_ends(sqlalchemy_session):
     @task_postrun.connect
     def close_session(*args, **kwargs):
         sqlalchemy_session.remove()
+
+
+def close_batchers_on_worker_shutdown():
+    """
+    Flushes buffered commands and responses (see batching.py) when Celery worker stops.
+    Worker child processes may exit without running exit handlers,
+     so batchers are closed on worker_process_shutdown signal too
+    """
+    def close_batchers(*args, **kwargs):
+        close_all_batchers()
+
+    worker_process_shutdown.connect(close_batchers, weak=False)
+    worker_shutdown.connect(close_batchers, weak=False)
+
+
+def rebalance_worker_queues(celery_app, worker_name: str,
+                            current_queues: typing.Iterable[str],
+                            new_queues: typing.Iterable[str]):
+    """
+    Makes running worker consume new_queues instead of current_queues.
+    Useful to move shards between Orchestrator workers, for example:
+
+        old_assignment = assign_shards(range(16), ['worker1@host', 'worker2@host'])
+        new_assignment = assign_shards(range(16), ['worker1@host', 'worker2@host', 'worker3@host'])
+        for worker in new_assignment:
+            rebalance_worker_queues(
+                celery_app, worker,
+                CreateOrderSaga.response_queues(old_assignment.get(worker, [])),
+                CreateOrderSaga.response_queues(new_assignment[worker])
+            )
+    """
+    current_queues, new_queues = set(current_queues), set(new_queues)
+
+    # start consuming new queues before cancelling old ones
+    #  so no shard is left without consumer
+    for queue in sorted(new_queues - current_queues):
+        celery_app.control.add_consumer(queue, destination=[worker_name])
+
+    for queue in sorted(current_queues - new_queues):
+        celery_app.control.cancel_consumer(queue, destination=[worker_name])
+
+
+def add_consumed_priority_lanes(celery_app, priority_lanes: PriorityLanes, queue: str,
+                                min_lane: str = None) -> typing.List[str]:
+    """
+    Makes Saga Handler service worker consume priority lanes of its queue
+     (see PriorityLanes.queues), declared with priority support
+     like Orchestrator declares them (see priority.py).
+    Returns added queues: if worker is started with -Q option, include them there
+    """
+    queues = priority_lanes.queues(queue, min_lane=min_lane)
+    for lane_queue in queues:
+        celery_app.amqp.queues.select_add(lane_queue,
+                                          queue_arguments=priority_lanes.queue_arguments)
+
+    return queues
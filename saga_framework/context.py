@@ -0,0 +1,111 @@
+"""
+This module contains saga context: data that steps pass to each other
+ (like ticket id that one step got in response and other step needs to cancel a ticket).
+
+StatefulSaga.context is a dict-like object that:
+ * loads values lazily, key by key, so a step reads only keys it needs
+ * tracks changed and deleted keys, so only they are persisted
+ * is persisted once per handled message (see StatefulSaga.handle_message)
+   within the same transaction as saga state
+
+Note: changes inside mutable values (like context['items'].append(item))
+ aren't tracked, so either re-assign a value or call mark_changed(key).
+"""
+
+__all__ = ['SagaContext']
+
+import collections.abc
+import typing
+
+_MISSING = object()
+
+
+class SagaContext(collections.abc.MutableMapping):
+    """
+    load(keys) returns {key: value} for existing keys among given ones
+     (or for all keys if keys is None).
+    save(changed, deleted_keys) persists changed values and deletes deleted keys
+    """
+    __slots__ = ('_load', '_save', '_values', '_changed', '_deleted', '_fully_loaded')
+
+    def __init__(self,
+                 load: typing.Callable[[typing.Optional[typing.List[str]]], dict],
+                 save: typing.Callable[[dict, typing.Set[str]], typing.Any]):
+        self._load = load
+        self._save = save
+        self._values = {}  # loaded or changed values, _MISSING for missing keys
+        self._changed = set()
+        self._deleted = set()
+        self._fully_loaded = False
+
+    def _get(self, key: str):
+        value = self._values.get(key, _MISSING)
+        if value is _MISSING and key not in self._values and not self._fully_loaded:
+            value = self._load([key]).get(key, _MISSING)
+            self._values[key] = value
+        return value
+
+    def _load_all(self):
+        if self._fully_loaded:
+            return
+
+        for key, value in self._load(None).items():
+            # don't overwrite values changed (or deleted) in this context
+            if key not in self._changed and key not in self._deleted:
+                self._values[key] = value
+        self._fully_loaded = True
+
+    def __getitem__(self, key: str):
+        value = self._get(key)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key) -> bool:
+        return self._get(key) is not _MISSING
+
+    def __setitem__(self, key: str, value):
+        self._values[key] = value
+        self._changed.add(key)
+        self._deleted.discard(key)
+
+    def __delitem__(self, key: str):
+        if self._get(key) is _MISSING:
+            raise KeyError(key)
+
+        self._values[key] = _MISSING
+        self._changed.discard(key)
+        self._deleted.add(key)
+
+    def __iter__(self) -> typing.Iterator[str]:
+        self._load_all()
+        return iter([key for key, value in self._values.items() if value is not _MISSING])
+
+    def __len__(self) -> int:
+        self._load_all()
+        return sum(1 for value in self._values.values() if value is not _MISSING)
+
+    def __repr__(self):
+        loaded = {key: value for key, value in self._values.items() if value is not _MISSING}
+        return f'<{type(self).__name__} {loaded!r}>'
+
+    def mark_changed(self, key: str):
+        """
+        Marks value as changed, e.g. after it was mutated in place
+        """
+        self[key] = self[key]
+
+    @property
+    def has_changes(self) -> bool:
+        return bool(self._changed or self._deleted)
+
+    def flush(self):
+        """
+        Persists changed and deleted keys (if any)
+        """
+        if not self.has_changes:
+            return
+
+        self._save({key: self._values[key] for key in self._changed}, set(self._deleted))
+        self._changed.clear()
+        self._deleted.clear()
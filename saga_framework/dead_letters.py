@@ -0,0 +1,269 @@
+"""
+This module contains dead-letter capture and replay of saga responses.
+
+If Orchestrator fails to handle a response (e.g. step can't be found
+ by response task name, or saga state repository is down),
+ Celery just logs an error and the response is lost.
+
+If AsyncSaga.dead_letter_store is set, such responses are captured to it
+ with their original args and headers (see AsyncSaga.wrap_response_handler),
+ and after the incident is fixed, DeadLetterReplayer re-injects them
+ to message broker in batches.
+"""
+
+__all__ = ['DeadLetter', 'AbstractDeadLetterStore', 'SQLiteDeadLetterStore',
+           'DeadLetterReplayer']
+
+import abc
+import contextlib
+import datetime
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+import typing
+from dataclasses import dataclass, field
+
+logger = logging.getLogger(__name__)
+
+
+def _to_db_datetime(value: datetime.datetime) -> str:
+    # stored as ISO string explicitly: sqlite3 default datetime adapter is deprecated
+    #  (the format is the same, so rows written with it are still compared correctly)
+    return value.isoformat(' ')
+
+
+def _dedup_key(task_name: str, args: list) -> str:
+    payload = json.dumps([task_name, args], sort_keys=True, default=str)
+    return hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()
+
+
+@dataclass
+class DeadLetter:
+    saga_class: str
+    task_name: str
+    saga_id: typing.Optional[int]
+    args: list
+    queue: typing.Optional[str] = None  # queue message was consumed from
+    headers: dict = field(default_factory=dict)
+    error: dict = field(default_factory=dict)  # see serialize_saga_error
+    step_name: typing.Optional[str] = None
+    message_id: typing.Optional[str] = None  # Celery task id
+    failed_at: datetime.datetime = field(default_factory=datetime.datetime.utcnow)
+    id: typing.Optional[int] = None  # store sequence number
+
+    @property
+    def dedup_key(self) -> str:
+        """
+        The same response delivered several times has the same dedup key
+        """
+        return _dedup_key(self.task_name, self.args)
+
+
+class AbstractDeadLetterStore(abc.ABC):
+    @abc.abstractmethod
+    def add(self, dead_letter: DeadLetter):
+        """
+        Saves dead letter (and commits it right away,
+         because saga transaction is rolled back at this moment).
+        Dead letter with already saved message_id should be ignored
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def find(self,
+             saga_class: str = None,
+             step_name: str = None,
+             since: datetime.datetime = None,
+             until: datetime.datetime = None,
+             after_id: int = 0,
+             limit: int = 1000) -> typing.List[DeadLetter]:
+        """
+        Returns not replayed dead letters with id > after_id, ordered by id
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def mark_replayed(self, ids: typing.List[int]):
+        raise NotImplementedError
+
+
+class SQLiteDeadLetterStore(AbstractDeadLetterStore):
+    """
+    Dead letters stored in SQLite table.
+    Don't share connection with saga state repository:
+     dead letters should be committed regardless of saga transaction
+    """
+    def __init__(self, connection: sqlite3.Connection, table_name: str = 'saga_dead_letter'):
+        self.connection = connection
+        self.table_name = table_name
+        self._lock = threading.Lock()
+
+    def create_table(self):
+        self.connection.execute(f'''
+            CREATE TABLE IF NOT EXISTS {self.table_name} (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                message_id TEXT UNIQUE,
+                saga_class TEXT NOT NULL,
+                step_name TEXT,
+                task_name TEXT NOT NULL,
+                saga_id INTEGER,
+                queue TEXT,
+                args TEXT NOT NULL,
+                headers TEXT NOT NULL,
+                error TEXT NOT NULL,
+                failed_at TIMESTAMP NOT NULL,
+                replayed_at TIMESTAMP
+            )
+        ''')
+        # partial index keeps replay lookups fast
+        #  no matter how many dead letters were replayed already
+        self.connection.execute(f'''
+            CREATE INDEX IF NOT EXISTS ix_{self.table_name}_not_replayed
+            ON {self.table_name} (saga_class, step_name, failed_at) WHERE replayed_at IS NULL
+        ''')
+        self.connection.commit()
+
+    def add(self, dead_letter: DeadLetter):
+        with self._lock:
+            self.connection.execute(
+                f'INSERT OR IGNORE INTO {self.table_name} '
+                f'(message_id, saga_class, step_name, task_name, saga_id, queue, '
+                f'args, headers, error, failed_at) '
+                f'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (dead_letter.message_id, dead_letter.saga_class, dead_letter.step_name,
+                 dead_letter.task_name, dead_letter.saga_id, dead_letter.queue,
+                 json.dumps(dead_letter.args, default=str),
+                 json.dumps(dead_letter.headers, default=str),
+                 json.dumps(dead_letter.error, default=str),
+                 _to_db_datetime(dead_letter.failed_at))
+            )
+            self.connection.commit()
+
+    def find(self,
+             saga_class: str = None,
+             step_name: str = None,
+             since: datetime.datetime = None,
+             until: datetime.datetime = None,
+             after_id: int = 0,
+             limit: int = 1000) -> typing.List[DeadLetter]:
+        conditions = ['replayed_at IS NULL', 'id > ?']
+        params = [after_id]
+        for condition, value in (('saga_class = ?', saga_class),
+                                 ('step_name = ?', step_name),
+                                 ('failed_at >= ?', since),
+                                 ('failed_at < ?', until)):
+            if value is not None:
+                conditions.append(condition)
+                params.append(_to_db_datetime(value)
+                              if isinstance(value, datetime.datetime) else value)
+
+        with self._lock:
+            rows = self.connection.execute(
+                f'SELECT id, message_id, saga_class, step_name, task_name, saga_id, queue, '
+                f'args, headers, error, failed_at FROM {self.table_name} '
+                f'WHERE {" AND ".join(conditions)} ORDER BY id LIMIT ?',
+                (*params, limit)
+            ).fetchall()
+
+        return [DeadLetter(id=id_, message_id=message_id, saga_class=saga_class_,
+                           step_name=step_name_, task_name=task_name, saga_id=saga_id,
+                           queue=queue, args=json.loads(args), headers=json.loads(headers),
+                           error=json.loads(error),
+                           failed_at=datetime.datetime.fromisoformat(failed_at))
+                for (id_, message_id, saga_class_, step_name_, task_name, saga_id, queue,
+                     args, headers, error, failed_at) in rows]
+
+    def mark_replayed(self, ids: typing.List[int]):
+        if not ids:
+            return
+
+        with self._lock:
+            self.connection.execute(
+                f'UPDATE {self.table_name} SET replayed_at = ? '
+                f'WHERE id IN ({", ".join("?" * len(ids))})',
+                (_to_db_datetime(datetime.datetime.utcnow()), *ids)
+            )
+            self.connection.commit()
+
+
+class DeadLetterReplayer:
+    """
+    Re-sends dead letters to message broker, in the order they were captured.
+
+    Dead letters are sent in batches of batch_size over one broker connection
+     and marked as replayed after each batch.
+    rate_limit (messages per second) prevents flooding Orchestrator after outage.
+    Duplicates (the same response captured several times) are replayed once.
+    """
+    def __init__(self, store: AbstractDeadLetterStore, celery_app,
+                 batch_size: int = 500,
+                 rate_limit: typing.Optional[float] = None):
+        self.store = store
+        self.celery_app = celery_app
+        self.batch_size = batch_size
+        self.rate_limit = rate_limit
+
+    def replay(self,
+               saga_class: str = None,
+               step_name: str = None,
+               since: datetime.datetime = None,
+               until: datetime.datetime = None,
+               queue: str = None) -> int:
+        """
+        Replays matching dead letters to the queues they were consumed from
+         (or to a given queue), returns number of sent messages
+        """
+        sent = 0
+        last_id = 0
+        seen_dedup_keys = set()
+        started_at = time.monotonic()
+
+        while True:
+            dead_letters = self.store.find(saga_class=saga_class, step_name=step_name,
+                                           since=since, until=until,
+                                           after_id=last_id, limit=self.batch_size)
+            if not dead_letters:
+                return sent
+
+            replayed_ids = []
+            try:
+                with self._producer() as producer:
+                    for dead_letter in dead_letters:
+                        dedup_key = dead_letter.dedup_key
+                        if dedup_key not in seen_dedup_keys:
+                            self._wait_for_rate_limit(sent, started_at)
+                            self.celery_app.send_task(
+                                dead_letter.task_name,
+                                args=dead_letter.args,
+                                queue=queue or dead_letter.queue,
+                                headers=dead_letter.headers,
+                                producer=producer
+                            )
+                            seen_dedup_keys.add(dedup_key)
+                            sent += 1
+
+                        replayed_ids.append(dead_letter.id)
+            finally:
+                self.store.mark_replayed(replayed_ids)
+
+            last_id = dead_letters[-1].id
+            logger.info('Replayed %s dead letters so far', sent)
+
+    def _wait_for_rate_limit(self, sent: int, started_at: float):
+        if not self.rate_limit:
+            return
+
+        delay = started_at + sent / self.rate_limit - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _producer(self):
+        # reuse one broker connection for whole batch
+        producer_or_acquire = getattr(self.celery_app, 'producer_or_acquire', None)
+        if producer_or_acquire is None:
+            return contextlib.nullcontext()
+
+        return producer_or_acquire()
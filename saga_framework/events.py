@@ -0,0 +1,135 @@
+"""
+This module contains structured saga events that sagas and saga handlers log.
+
+Events are emitted with emit_saga_event, which checks if logger is enabled
+ for event level before doing anything else, so disabled events cost
+ one cached level check: no event object, no message formatting,
+ no traceback formatting.
+
+Enabled events are logged as '%s' % event, i.e. message is formatted lazily
+ by a handler that actually writes it. Event itself is attached
+ to log record as record.saga_event, so structured handlers (JSON, metrics)
+ can use its fields instead of parsing the message.
+
+To keep I/O off the hot path, call start_queue_logging() at process start:
+ records are put to in-memory queue and written by handlers in a separate thread.
+"""
+
+__all__ = ['SagaEventType', 'SagaEvent', 'emit_saga_event',
+           'SagaEventQueueHandler', 'start_queue_logging']
+
+import enum
+import logging
+import logging.handlers
+import queue
+import typing
+
+
+class SagaEventType(str, enum.Enum):
+    STEP_STARTED = 'step_started'
+    STEP_SUCCEEDED = 'step_succeeded'
+    STEP_FAILED = 'step_failed'
+    STEP_COMPENSATING = 'step_compensating'
+    STEP_COMPENSATED = 'step_compensated'
+    COMPENSATION_RETRY = 'compensation_retry'
+    COMPENSATION_FAILED = 'compensation_failed'
+    RETRIABLE_STEP_SUCCEEDED = 'retriable_step_succeeded'
+    RETRIABLE_STEP_FAILED = 'retriable_step_failed'
+    SAGA_SUCCEEDED = 'saga_succeeded'
+    SAGA_FAILED = 'saga_failed'
+    RESPONSE_FAILED = 'response_failed'
+    RESPONSE_SKIPPED = 'response_skipped'
+    STEP_HANDLER_FAILED = 'step_handler_failed'
+
+
+_MESSAGES = {
+    SagaEventType.STEP_STARTED: 'Saga {saga_id}: running "{step_name}" step',
+    SagaEventType.STEP_SUCCEEDED: 'Saga {saga_id}: running on_success for "{step_name}" step',
+    SagaEventType.STEP_FAILED: 'Saga {saga_id}: running on_failure for "{step_name}" step',
+    SagaEventType.STEP_COMPENSATING: 'Saga {saga_id}: compensating "{step_name}" step',
+    SagaEventType.STEP_COMPENSATED: 'Saga {saga_id}: "{step_name}" step compensated',
+    SagaEventType.COMPENSATION_RETRY: 'Saga {saga_id}: compensation of "{step_name}" step '
+                                      'failed, retrying',
+    SagaEventType.COMPENSATION_FAILED: 'Saga {saga_id} failed while compensating '
+                                       '"{step_name}" step',
+    SagaEventType.RETRIABLE_STEP_SUCCEEDED: 'Saga {saga_id}: retriable "{step_name}" '
+                                            'step succeeded',
+    SagaEventType.RETRIABLE_STEP_FAILED: 'Saga {saga_id}: retriable "{step_name}" step failed',
+    SagaEventType.SAGA_SUCCEEDED: 'Saga {saga_id} succeeded',
+    SagaEventType.SAGA_FAILED: 'Saga {saga_id} failed on "{step_name}" step',
+    SagaEventType.RESPONSE_FAILED: 'Saga {saga_id}: handling of response failed',
+    SagaEventType.RESPONSE_SKIPPED: 'Saga {saga_id}: skipping response '
+                                    'because previous response for this saga failed',
+    SagaEventType.STEP_HANDLER_FAILED: 'Saga {saga_id}: step handler failed',
+}
+
+
+class SagaEvent:
+    """
+    details are event-specific fields, like failure payload or task name
+    """
+    __slots__ = ('type', 'saga_id', 'step_name', 'details')
+
+    def __init__(self, type: SagaEventType, saga_id,
+                 step_name: typing.Optional[str] = None,
+                 details: dict = None):
+        self.type = type
+        self.saga_id = saga_id
+        self.step_name = step_name
+        self.details = details or {}
+
+    def as_dict(self) -> dict:
+        return {'event': self.type.value, 'saga_id': self.saga_id,
+                'step_name': self.step_name, **self.details}
+
+    def __str__(self):
+        message = _MESSAGES[self.type].format(saga_id=self.saga_id, step_name=self.step_name)
+        if self.details:
+            message += ''.join(f'\n{key}: {value}' for key, value in self.details.items())
+        return message
+
+    def __repr__(self):
+        return f'<{type(self).__name__} {self.as_dict()!r}>'
+
+
+def emit_saga_event(logger: logging.Logger, level: int, event_type: SagaEventType,
+                    saga_id, step_name: str = None,
+                    exc_info: BaseException = None, **details):
+    """
+    Logs saga event if logger is enabled for given level.
+    exc_info exception traceback is formatted by handler, only if event is logged
+    """
+    if not logger.isEnabledFor(level):
+        return
+
+    event = SagaEvent(event_type, saga_id, step_name, details)
+    logger.log(level, '%s', event, exc_info=exc_info, extra={'saga_event': event})
+
+
+class SagaEventQueueHandler(logging.handlers.QueueHandler):
+    """
+    Unlike standard QueueHandler, doesn't format message before putting record to queue:
+     message (and traceback) is formatted in listener thread.
+    Events are snapshots, so formatting them later is safe,
+     but avoid mutating payloads after they were logged
+    """
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def start_queue_logging(*handlers: logging.Handler,
+                        logger_name: str = 'saga_framework') -> logging.handlers.QueueListener:
+    """
+    Routes saga_framework logs through in-memory queue to given handlers,
+     which are called in a separate thread.
+    Returns started listener: call its stop() on shutdown to flush the queue
+    """
+    log_queue = queue.SimpleQueue()
+    logger = logging.getLogger(logger_name)
+    logger.addHandler(SagaEventQueueHandler(log_queue))
+    logger.propagate = False
+
+    listener = logging.handlers.QueueListener(log_queue, *handlers,
+                                              respect_handler_level=True)
+    listener.start()
+    return listener
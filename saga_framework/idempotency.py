@@ -0,0 +1,161 @@
+"""
+This module contains idempotency stores for Saga Handler services.
+
+Message broker may deliver a command more than once (e.g. worker died
+ before acknowledging it, or dead letters were replayed).
+If idempotency_store is passed to @saga_step_handler, response to every handled command
+ is saved under (task name, saga_id) key, and repeated command
+ isn't handled again: stored response is just sent again.
+
+Both success and failure responses are stored; Celery retries aren't
+ (command isn't handled yet at this moment).
+
+Note: response is saved after handler returns, so if handler commits
+ its own DB transaction and process dies right after it,
+ the command will be handled again. To close this gap, use
+ SQLAlchemyIdempotencyStore with commit=False and the same session handler uses,
+ then commit it after handler returns (e.g. in task_postrun signal).
+Also, duplicates delivered concurrently (to different workers) aren't detected.
+"""
+
+__all__ = ['StoredResponse', 'AbstractIdempotencyStore', 'InMemoryIdempotencyStore',
+           'SQLiteIdempotencyStore', 'SQLAlchemyIdempotencyStore']
+
+import abc
+import collections
+import dataclasses
+import json
+import sqlite3
+import threading
+import typing
+
+
+class StoredResponse(typing.NamedTuple):
+    response_task_name: str
+    payload: typing.Any
+
+
+def _to_json(payload) -> str:
+    # response payloads may be dataclasses (see send_saga_response)
+    return json.dumps(payload, default=lambda value: dataclasses.asdict(value)
+                      if dataclasses.is_dataclass(value) else str(value))
+
+
+class AbstractIdempotencyStore(abc.ABC):
+    @abc.abstractmethod
+    def get(self, task_name: str, saga_id: int) -> typing.Optional[StoredResponse]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def save(self, task_name: str, saga_id: int, response: StoredResponse):
+        raise NotImplementedError
+
+
+class InMemoryIdempotencyStore(AbstractIdempotencyStore):
+    """
+    Keeps responses for max_size most recently handled commands in process memory.
+    Catches redeliveries to the same worker process only (e.g. after Celery retry
+     of a failed acknowledgement), but costs nothing
+    """
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self._responses = collections.OrderedDict()  # type: typing.Dict[tuple, StoredResponse]
+        self._lock = threading.Lock()
+
+    def get(self, task_name: str, saga_id: int) -> typing.Optional[StoredResponse]:
+        key = (task_name, saga_id)
+        with self._lock:
+            response = self._responses.get(key)
+            if response is not None:
+                self._responses.move_to_end(key)
+            return response
+
+    def save(self, task_name: str, saga_id: int, response: StoredResponse):
+        key = (task_name, saga_id)
+        with self._lock:
+            self._responses[key] = response
+            self._responses.move_to_end(key)
+            while len(self._responses) > self.max_size:
+                self._responses.popitem(last=False)
+
+
+class SQLiteIdempotencyStore(AbstractIdempotencyStore):
+    """
+    Responses stored in SQLite table, payloads are stored as JSON
+    """
+    def __init__(self, connection: sqlite3.Connection,
+                 table_name: str = 'saga_handled_command'):
+        self.connection = connection
+        self.table_name = table_name
+        self._lock = threading.Lock()
+
+    def create_table(self):
+        self.connection.execute(f'''
+            CREATE TABLE IF NOT EXISTS {self.table_name} (
+                task_name TEXT NOT NULL,
+                saga_id INTEGER NOT NULL,
+                response_task_name TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                PRIMARY KEY (task_name, saga_id)
+            ) WITHOUT ROWID
+        ''')
+        self.connection.commit()
+
+    def get(self, task_name: str, saga_id: int) -> typing.Optional[StoredResponse]:
+        with self._lock:
+            row = self.connection.execute(
+                f'SELECT response_task_name, payload FROM {self.table_name} '
+                f'WHERE task_name = ? AND saga_id = ?',
+                (task_name, saga_id)
+            ).fetchone()
+
+        if row is None:
+            return None
+        return StoredResponse(row[0], json.loads(row[1]))
+
+    def save(self, task_name: str, saga_id: int, response: StoredResponse):
+        with self._lock:
+            self.connection.execute(
+                f'INSERT OR REPLACE INTO {self.table_name} '
+                f'(task_name, saga_id, response_task_name, payload) VALUES (?, ?, ?, ?)',
+                (task_name, saga_id, response.response_task_name, _to_json(response.payload))
+            )
+            self.connection.commit()
+
+
+class SQLAlchemyIdempotencyStore(AbstractIdempotencyStore):
+    """
+    Responses stored with SQLAlchemy model that has
+     task_name, saga_id (composite primary key), response_task_name
+     and payload (JSON) columns, for example:
+
+    class HandledCommand(Base):
+        task_name = Column(String, primary_key=True)
+        saga_id = Column(Integer, primary_key=True)
+        response_task_name = Column(String, nullable=False)
+        payload = Column(JSON)
+
+    session is SQLAlchemy session (or scoped_session).
+    With commit=False, saved response is only flushed:
+     commit it together with handler changes
+    """
+    def __init__(self, session, model: type, commit: bool = True):
+        self.session = session
+        self.model = model
+        self.commit = commit
+
+    def get(self, task_name: str, saga_id: int) -> typing.Optional[StoredResponse]:
+        handled_command = self.session.get(self.model, (task_name, saga_id))
+        if handled_command is None:
+            return None
+        return StoredResponse(handled_command.response_task_name, handled_command.payload)
+
+    def save(self, task_name: str, saga_id: int, response: StoredResponse):
+        self.session.merge(self.model(task_name=task_name,
+                                      saga_id=saga_id,
+                                      response_task_name=response.response_task_name,
+                                      payload=json.loads(_to_json(response.payload))))
+        if self.commit:
+            self.session.commit()
+        else:
+            self.session.flush()
@@ -0,0 +1,48 @@
+"""
+This module contains striped locks that serialize handling of messages
+ of one saga within Orchestrator process.
+
+With prefork Celery pool, every worker process handles one message at a time.
+With threads or gevent pools, several responses of the same saga
+ (e.g. a retried response, or responses of retriable steps)
+ can be handled concurrently in one process, so AsyncSaga.handle_message
+ takes a lock of saga_id before handling a message.
+
+Instead of lock per saga (which would need cleanup), fixed number of locks
+ is allocated and saga_id is mapped to one of them: sagas sharing a stripe
+ just wait for each other a bit.
+
+Locks are created with threading.RLock, so they work with gevent pools too
+ (Celery worker monkey-patches threading module for gevent and eventlet pools).
+They are created on first use, i.e. after monkey-patching,
+ even if StripedLock itself is created at import time.
+"""
+
+__all__ = ['StripedLock']
+
+import threading
+import typing
+
+
+class StripedLock:
+    def __init__(self, stripes: int = 1024,
+                 lock_factory: typing.Callable[[], typing.ContextManager] = None):
+        self.stripes = stripes
+        self.lock_factory = lock_factory
+        self._locks = None  # type: typing.Optional[typing.List[typing.ContextManager]]
+        self._init_lock = threading.Lock()
+
+    def lock_for(self, key: typing.Hashable) -> typing.ContextManager:
+        """
+        Returns (reentrant by default) lock for a given key, like saga_id
+        """
+        locks = self._locks
+        if locks is None:
+            with self._init_lock:
+                if self._locks is None:
+                    # look threading.RLock up now to get monkey-patched version
+                    lock_factory = self.lock_factory or threading.RLock
+                    self._locks = [lock_factory() for _ in range(self.stripes)]
+            locks = self._locks
+
+        return locks[hash(key) % self.stripes]
@@ -0,0 +1,121 @@
+"""
+This module contains memoization of responses for read-only AsyncSteps.
+
+Some steps are pure lookups (like "verify consumer details"), and many sagas
+ send the same command for the same customer. If step has memoize policy
+ and saga class has response_cache, success response is cached
+ under (task name, key derived from command payload) for policy.ttl seconds.
+While it's cached, saga doesn't send such command at all:
+ cached response is sent to saga response queue instead
+ and is handled like the real one.
+
+Orchestrator has to know cache key when response comes, so key is remembered
+ as pending for (saga_id, step name) when command is sent. Pending keys live in
+ the same cache, so response that comes to other process
+ (e.g. other prefork Celery worker child) is just not cached.
+For best hit rate, run Orchestrator with threads or gevent pool.
+
+Use it only for steps whose handlers don't change anything
+ and whose responses may be stale for ttl seconds.
+"""
+
+__all__ = ['MemoizationPolicy', 'ResponseCache']
+
+import collections
+import copy
+import json
+import threading
+import time
+import typing
+from dataclasses import dataclass
+
+_MISSING = object()
+
+
+def _default_key(payload) -> str:
+    return json.dumps(payload, sort_keys=True, default=str)
+
+
+@dataclass(frozen=True)
+class MemoizationPolicy:
+    """
+    key(payload) derives cache key from command payload,
+     by default payload is serialized as is
+    """
+    ttl: float  # seconds
+    key: typing.Callable[[typing.Any], typing.Hashable] = _default_key
+
+
+class ResponseCache:
+    """
+    LRU cache of success response payloads, with TTL per entry.
+    Keeps up to max_size responses and max_size pending keys
+    """
+    def __init__(self, max_size: int = 10000,
+                 clock: typing.Callable[[], float] = time.monotonic):
+        self.max_size = max_size
+        self.clock = clock
+        self._responses = collections.OrderedDict()  # key -> (expires_at, payload)
+        self._pending = collections.OrderedDict()  # (saga_id, step name) -> key
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0  # entries evicted because cache was full
+        self.expirations = 0
+
+    def get(self, key: typing.Hashable, default=None):
+        """
+        Returns copy of cached payload (so callbacks can't change cached one)
+         or default if there's no fresh response for key
+        """
+        with self._lock:
+            expires_at, payload = self._responses.get(key, (None, _MISSING))
+            if payload is not _MISSING and expires_at <= self.clock():
+                del self._responses[key]
+                self.expirations += 1
+                payload = _MISSING
+
+            if payload is _MISSING:
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            self._responses.move_to_end(key)
+
+        return copy.deepcopy(payload)
+
+    def put(self, key: typing.Hashable, payload, ttl: float):
+        """
+        Caches copy of payload (so callbacks can't change cached one)
+        """
+        payload = copy.deepcopy(payload)
+        with self._lock:
+            self._responses[key] = (self.clock() + ttl, payload)
+            self._responses.move_to_end(key)
+            while len(self._responses) > self.max_size:
+                self._responses.popitem(last=False)
+                self.evictions += 1
+
+    def add_pending(self, saga_id, step_name: str, key: typing.Hashable):
+        with self._lock:
+            self._pending[saga_id, step_name] = key
+            while len(self._pending) > self.max_size:
+                self._pending.popitem(last=False)
+
+    def pop_pending(self, saga_id, step_name: str) -> typing.Optional[typing.Hashable]:
+        with self._lock:
+            return self._pending.pop((saga_id, step_name), None)
+
+    def __len__(self):
+        return len(self._responses)
+
+    def stats(self) -> dict:
+        with self._lock:
+            requests = self.hits + self.misses
+            return {'size': len(self._responses),
+                    'pending': len(self._pending),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_ratio': self.hits / requests if requests else 0.0,
+                    'evictions': self.evictions,
+                    'expirations': self.expirations}
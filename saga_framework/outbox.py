@@ -0,0 +1,209 @@
+"""
+This module contains transactional outbox for saga commands.
+
+Without outbox, StatefulSaga updates saga state in DB and sends Celery task
+ separately, so if process crashes in between, state and sent commands
+ become inconsistent.
+
+With outbox (AsyncSaga.outbox), commands are written to outbox table
+ in the same DB transaction as saga state update
+ (see AbstractSagaStateRepository.transaction), and separate relay process
+ (OutboxRelay) drains outbox in big batches and publishes commands
+ to message broker in the order they were written.
+"""
+
+__all__ = ['OutboxMessage', 'AbstractOutbox', 'SQLiteOutbox', 'OutboxRelay']
+
+import abc
+import contextlib
+import datetime
+import json
+import logging
+import sqlite3
+import threading
+import typing
+import uuid
+from dataclasses import dataclass
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class OutboxMessage:
+    id: int  # outbox sequence number, defines publishing order
+    message_id: str  # id that message will have in broker (Celery task id)
+    saga_id: int
+    task_name: str
+    queue: str
+    args: list
+    options: dict  # extra send_task options like priority or kwargs
+
+
+class AbstractOutbox(abc.ABC):
+    @abc.abstractmethod
+    def add(self, saga_id: int, task_name: str, queue: str,
+            args: list, options: dict) -> str:
+        """
+        Writes message to outbox within current transaction
+         (shouldn't commit it) and returns message id
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_unpublished(self, limit: int) -> typing.List[OutboxMessage]:
+        """
+        Returns oldest unpublished messages in the order they were added
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def mark_published(self, ids: typing.List[int]):
+        raise NotImplementedError
+
+
+class SQLiteOutbox(AbstractOutbox):
+    """
+    Outbox stored in SQLite table.
+    Use the same connection as saga state repository does,
+     so messages are committed together with saga state.
+    """
+    def __init__(self, connection: sqlite3.Connection, table_name: str = 'saga_outbox'):
+        self.connection = connection
+        self.table_name = table_name
+
+    def create_table(self):
+        self.connection.execute(f'''
+            CREATE TABLE IF NOT EXISTS {self.table_name} (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                message_id TEXT NOT NULL,
+                saga_id INTEGER NOT NULL,
+                task_name TEXT NOT NULL,
+                queue TEXT NOT NULL,
+                args TEXT NOT NULL,
+                options TEXT NOT NULL,
+                created_at TIMESTAMP NOT NULL,
+                published_at TIMESTAMP
+            )
+        ''')
+        # partial index keeps unpublished messages lookup fast
+        #  no matter how many published messages table has
+        self.connection.execute(f'''
+            CREATE INDEX IF NOT EXISTS ix_{self.table_name}_unpublished
+            ON {self.table_name} (id) WHERE published_at IS NULL
+        ''')
+        self.connection.commit()
+
+    def add(self, saga_id: int, task_name: str, queue: str,
+            args: list, options: dict) -> str:
+        message_id = str(uuid.uuid4())
+        self.connection.execute(
+            f'INSERT INTO {self.table_name} '
+            f'(message_id, saga_id, task_name, queue, args, options, created_at) '
+            f'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (message_id, saga_id, task_name, queue, json.dumps(args),
+             json.dumps(options), datetime.datetime.utcnow().isoformat(' '))
+        )
+        return message_id
+
+    def get_unpublished(self, limit: int) -> typing.List[OutboxMessage]:
+        rows = self.connection.execute(
+            f'SELECT id, message_id, saga_id, task_name, queue, args, options '
+            f'FROM {self.table_name} WHERE published_at IS NULL '
+            f'ORDER BY id LIMIT ?',
+            (limit,)
+        ).fetchall()
+
+        return [OutboxMessage(id=id_, message_id=message_id, saga_id=saga_id,
+                              task_name=task_name, queue=queue,
+                              args=json.loads(args), options=json.loads(options))
+                for id_, message_id, saga_id, task_name, queue, args, options in rows]
+
+    def mark_published(self, ids: typing.List[int]):
+        if not ids:
+            return
+
+        self.connection.execute(
+            f'UPDATE {self.table_name} SET published_at = ? '
+            f'WHERE id IN ({", ".join("?" * len(ids))})',
+            # ISO string explicitly, sqlite3 default datetime adapter is deprecated
+            (datetime.datetime.utcnow().isoformat(' '), *ids)
+        )
+        self.connection.commit()
+
+
+class OutboxRelay:
+    """
+    Publishes outbox messages to message broker.
+    Messages are published in batches of batch_size over one broker connection,
+     strictly in the order they were added to outbox,
+     so commands of each saga are published in order.
+
+    Relay guarantees at-least-once delivery: if it crashes after publishing
+     but before marking messages as published, they will be published again
+     (with the same task id).
+    """
+    def __init__(self, outbox: AbstractOutbox, celery_app, batch_size: int = 500):
+        self.outbox = outbox
+        self.celery_app = celery_app
+        self.batch_size = batch_size
+
+    def relay_batch(self) -> int:
+        """
+        Publishes one batch of messages, returns number of published messages
+        """
+        messages = self.outbox.get_unpublished(self.batch_size)
+        published_ids = []
+
+        try:
+            with self._producer() as producer:
+                for message in messages:
+                    self.celery_app.send_task(
+                        message.task_name,
+                        args=message.args,
+                        queue=message.queue,
+                        task_id=message.message_id,
+                        producer=producer,
+                        **message.options
+                    )
+                    published_ids.append(message.id)
+        finally:
+            # if publishing failed in the middle, keep successfully published
+            #  messages marked, and retry the rest (in order) next time
+            self.outbox.mark_published(published_ids)
+
+        return len(published_ids)
+
+    def relay_all(self) -> int:
+        """
+        Publishes all unpublished messages, returns number of published messages
+        """
+        total = 0
+        while True:
+            published = self.relay_batch()
+            total += published
+            if published < self.batch_size:
+                return total
+
+    def run(self, poll_interval: float = 0.1,
+            stop_event: threading.Event = None):
+        """
+        Relays messages until stop_event is set
+        """
+        stop_event = stop_event or threading.Event()
+        while not stop_event.is_set():
+            try:
+                published = self.relay_all()
+            except Exception as exc:
+                logger.exception(exc)
+                published = 0
+
+            if not published:
+                stop_event.wait(poll_interval)
+
+    def _producer(self):
+        # reuse one broker connection for whole batch
+        producer_or_acquire = getattr(self.celery_app, 'producer_or_acquire', None)
+        if producer_or_acquire is None:
+            return contextlib.nullcontext()
+
+        return producer_or_acquire()
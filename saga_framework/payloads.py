@@ -0,0 +1,239 @@
+"""
+This module contains compiled decoders of message payloads.
+
+Payloads travel between services as plain dicts. If message payload is described
+ by a @dataclass (like ones passed to asyncapi_message_for_success_response),
+ compile_decoder generates a function that validates dict against dataclass fields
+ and builds dataclass instance. Code is generated once per dataclass,
+ so decoding with validation costs about twice as much as naive
+ PayloadDataclass(**payload) which doesn't validate anything
+ (see tests/test_payloads.py::test_decoder_overhead).
+
+Supported field types: int, float, str, bool, dict, list, Enum subclasses,
+ nested dataclasses, typing.Optional, typing.List and typing.Dict of them.
+Fields of other types are checked with isinstance or (for other typing constructs)
+ not checked at all. Unknown keys are ignored.
+
+PayloadRegistry maps message (task) names to decoders:
+ * Saga Handler services pass it to @saga_step_handler to get typed commands
+ * Orchestrator sets it on saga class (AsyncSaga.payload_registry)
+   to get typed responses in on_success/on_failure callbacks
+"""
+
+__all__ = ['PayloadValidationError', 'compile_decoder', 'PayloadRegistry']
+
+import dataclasses
+import enum
+import itertools
+import types
+import typing
+
+_MISSING = object()
+# 'X | None' annotations have their own origin since Python 3.10
+_UNION_TYPES = (typing.Union, getattr(types, 'UnionType', typing.Union))
+_decoders = {}  # type: typing.Dict[type, typing.Callable]
+_names = itertools.count()
+
+
+class PayloadValidationError(ValueError):
+    pass
+
+
+def _unique_name(prefix: str) -> str:
+    return f'_{prefix}_{next(_names)}'
+
+
+def _raise_invalid(path: str, expected: str, value):
+    raise PayloadValidationError(f'{path}: expected {expected}, '
+                                 f'got {type(value).__name__}')
+
+
+def _check_lines(annotation, var: str, path: str, namespace: dict) -> typing.List[str]:
+    """
+    Returns code lines that check (and convert, if needed) value of var variable.
+    path is an expression that evaluates to path of the value (for error messages)
+    """
+    origin = typing.get_origin(annotation)
+    args = typing.get_args(annotation)
+
+    if annotation is typing.Any or annotation is object:
+        return []
+
+    if origin in _UNION_TYPES:
+        if type(None) not in args or len(args) != 2:
+            return []  # not checked
+
+        inner_lines = _check_lines(next(arg for arg in args if arg is not type(None)),
+                                   var, path, namespace)
+        if not inner_lines:
+            return []
+        return [f'if {var} is not None:'] + [f'    {line}' for line in inner_lines]
+
+    if origin in (list, dict):
+        container_type = origin.__name__
+        lines = [f'if type({var}) is not {container_type}: '
+                 f'_raise_invalid({path}, {container_type!r}, {var})']
+
+        item_annotation = args[-1] if args else typing.Any
+        convert = _compile_converter(item_annotation, namespace)
+        if convert:
+            lines.append(f'{var}_path = {path} + \'[]\'')
+            if origin is list:
+                lines.append(f'{var} = [{convert}(item, {var}_path) for item in {var}]')
+            else:
+                lines.append(f'{var} = {{key: {convert}(item, {var}_path) '
+                             f'for key, item in {var}.items()}}')
+        return lines
+
+    if not isinstance(annotation, type):
+        return []  # not checked
+
+    if dataclasses.is_dataclass(annotation):
+        decoder_name = _unique_name('decode')
+        namespace[decoder_name] = _get_decoder_lazily(annotation)
+        return [f'{var} = {decoder_name}({var}, {path})']
+
+    if issubclass(annotation, enum.Enum):
+        enum_name = _unique_name('enum')
+        namespace[enum_name] = annotation
+        return [f'try:',
+                f'    {var} = {enum_name}({var})',
+                f'except ValueError:',
+                f'    _raise_invalid({path}, {annotation.__name__!r}, {var})']
+
+    type_name = _unique_name('type')
+    namespace[type_name] = annotation
+    if annotation is bool:
+        condition = f'type({var}) is not bool'
+    elif annotation is int:
+        condition = f'type({var}) is not int and (type({var}) is bool or not isinstance({var}, int))'
+    elif annotation is float:
+        condition = f'type({var}) is not float and (type({var}) is bool or not isinstance({var}, (int, float)))'
+    else:
+        condition = f'not isinstance({var}, {type_name})'
+
+    return [f'if {condition}: _raise_invalid({path}, {annotation.__name__!r}, {var})']
+
+
+def _compile_converter(annotation, namespace: dict) -> typing.Optional[str]:
+    """
+    Compiles function that checks and converts one value (like list item).
+    Returns its name in namespace or None if value doesn't need any check
+    """
+    lines = _check_lines(annotation, 'value', 'path', namespace)
+    if not lines:
+        return None
+
+    converter_name = _unique_name('convert')
+    source = '\n'.join([f'def {converter_name}(value, path):',
+                        *(f'    {line}' for line in lines),
+                        f'    return value'])
+    exec(source, namespace)
+    return converter_name
+
+
+def _get_decoder_lazily(payload_dataclass: type) -> typing.Callable:
+    # nested dataclass can refer to dataclass being compiled,
+    #  so don't compile it right now
+    def decode(payload, path):
+        decoder = _decoders.get(payload_dataclass) or compile_decoder(payload_dataclass)
+        return decoder(payload, path)
+
+    return _decoders.get(payload_dataclass) or decode
+
+
+def compile_decoder(payload_dataclass: type) -> typing.Callable[[dict], typing.Any]:
+    """
+    Returns function decode(payload: dict, path: str = 'payload')
+     that validates payload and returns payload_dataclass instance.
+    Instances of payload_dataclass are returned as is.
+    Raises PayloadValidationError with path to invalid field.
+    """
+    decoder = _decoders.get(payload_dataclass)
+    if decoder:
+        return decoder
+
+    type_hints = typing.get_type_hints(payload_dataclass)
+    namespace = {'_raise_invalid': _raise_invalid,
+                 '_PayloadValidationError': PayloadValidationError,
+                 '_cls': payload_dataclass}
+
+    lines = []
+    arguments = []
+    has_optional_fields = False
+    for i, field in enumerate(dataclasses.fields(payload_dataclass)):
+        if not field.init:
+            continue
+
+        var = f'v{i}'
+        check_lines = _check_lines(type_hints.get(field.name, typing.Any),
+                                   var, f'path + {"." + field.name!r}', namespace)
+
+        if field.default is dataclasses.MISSING and field.default_factory is dataclasses.MISSING:
+            lines += [f'    try:',
+                      f'        {var} = payload[{field.name!r}]',
+                      f'    except KeyError:',
+                      f'        raise _PayloadValidationError(f\'{{path}}: '
+                      f'"{field.name}" field is required\') from None']
+            lines += [f'    {line}' for line in check_lines]
+            arguments.append(f'{field.name}={var}')
+        else:
+            has_optional_fields = True
+            lines += [f'    {var} = payload.get({field.name!r}, _MISSING)',
+                      f'    if {var} is not _MISSING:']
+            lines += [f'        {line}' for line in check_lines]
+            lines += [f'        kwargs[{field.name!r}] = {var}']
+
+    if has_optional_fields:
+        lines.insert(0, '    kwargs = {}')
+        arguments.append('**kwargs')
+        namespace['_MISSING'] = _MISSING
+
+    source = '\n'.join([
+        'def decode(payload, path=\'payload\'):',
+        '    if type(payload) is not dict:',
+        '        if isinstance(payload, _cls):',
+        '            return payload',
+        '        _raise_invalid(path, \'dict\', payload)',
+        *lines,
+        f'    return _cls({", ".join(arguments)})'
+    ])
+    exec(source, namespace)
+
+    decoder = _decoders[payload_dataclass] = namespace['decode']
+    return decoder
+
+
+class PayloadRegistry:
+    """
+    Maps message names (task names or response task names)
+     to compiled payload decoders
+    """
+    def __init__(self):
+        self._decoders = {}  # type: typing.Dict[str, typing.Callable]
+
+    def register(self, name: str, payload_dataclass: type):
+        self._decoders[name] = compile_decoder(payload_dataclass)
+
+    def register_messages(self, messages: typing.Iterable):
+        """
+        Registers messages that have name and payload dataclass,
+         like asyncapi.Message (see asyncapi_utils)
+        """
+        for message in messages:
+            if dataclasses.is_dataclass(message.payload):
+                self.register(message.name, message.payload)
+
+    def decoder_for(self, name: str) -> typing.Optional[typing.Callable]:
+        return self._decoders.get(name)
+
+    def decode(self, name: str, payload):
+        """
+        Returns decoded payload or payload as is
+         if no dataclass is registered for message name
+        """
+        decoder = self._decoders.get(name)
+        if decoder is None:
+            return payload
+
+        return decoder(payload)
@@ -0,0 +1,99 @@
+"""
+This module contains helpers for priority-aware saga scheduling.
+
+Saga priority (AsyncSaga.priority) is propagated to every command
+ Orchestrator sends and to every response Saga Handler services send back:
+ * as broker message priority (supported by RabbitMQ and Redis Celery transports)
+ * optionally, as routing to priority lane queues, like 'some_queue.high'
+   and 'some_queue.low' (see PriorityLanes)
+
+Priority lanes isolate sagas of different priority, they don't order consumption:
+ a Celery worker consumes all queues it listens to in round-robin,
+ so a worker listening to several lanes takes from low lane as often as from high one
+ (low priority sagas don't starve, but high ones aren't served first either).
+To serve high priority lane faster, run extra workers that consume only it
+ (see PriorityLanes.queues).
+
+Within one queue, messages are ordered by broker message priority
+ only if queue is declared with priority support (x-max-priority argument in RabbitMQ).
+AsyncSaga.register_async_step_handlers declares lane queues of its responses
+ and commands this way (see PriorityLanes.queue_arguments),
+ Saga Handler services should declare lane queues they consume the same way
+ (see celery_utils.add_consumed_priority_lanes).
+Queues are declared once, so if lane queue already exists without this argument,
+ it has to be deleted first.
+For sagas with priority, but without lanes, set Celery task_queue_max_priority setting.
+"""
+
+__all__ = ['PriorityLanes']
+
+import typing
+
+from .utils import priority_lane_queue_name
+
+
+class PriorityLanes:
+    """
+    Maps priorities to lanes (it's only routing, see module docstring).
+    lanes is a {lane name: minimal priority} dict, for example
+     {'high': 7, 'default': 3, 'low': 0}.
+    Priority goes to the lane with highest minimal priority not exceeding it.
+
+    Sagas without priority (None) go to default_lane.
+    By default, it's the lowest lane, like brokers treat messages without priority.
+
+    Lane queues are declared with max_priority (see queue_arguments),
+     Celery supports priorities from 0 to 9 for RabbitMQ
+    """
+    def __init__(self, lanes: typing.Dict[str, int], default_lane: str = None,
+                 max_priority: int = 9):
+        if not lanes:
+            raise ValueError('at least one lane is required')
+        if default_lane is not None and default_lane not in lanes:
+            raise ValueError(f'unknown default lane {default_lane!r}')
+        if max(lanes.values()) > max_priority:
+            raise ValueError(f'lane minimal priority exceeds max priority {max_priority}')
+
+        self.max_priority = max_priority
+
+        # highest lanes first
+        self._lanes = sorted(lanes.items(), key=lambda lane: lane[1], reverse=True)
+        self.default_lane = default_lane or self._lanes[-1][0]
+
+    @property
+    def queue_arguments(self) -> dict:
+        """
+        Arguments to declare lane queues with, so broker orders messages
+         in them by priority (see module docstring)
+        """
+        return {'x-max-priority': self.max_priority}
+
+    @property
+    def lane_names(self) -> typing.List[str]:
+        return [name for name, _ in self._lanes]
+
+    def lane_for(self, priority: typing.Optional[int]) -> str:
+        if priority is None:
+            return self.default_lane
+
+        for name, min_priority in self._lanes:
+            if priority >= min_priority:
+                return name
+
+        return self._lanes[-1][0]
+
+    def queue_for(self, queue: str, priority: typing.Optional[int]) -> str:
+        return priority_lane_queue_name(queue, self.lane_for(priority))
+
+    def queues(self, queue: str, min_lane: str = None) -> typing.List[str]:
+        """
+        Returns lane queues for a given queue, highest lanes first
+         (Celery doesn't consume them in this order, see module docstring).
+        If min_lane is given, only this and higher lanes are returned
+         (useful for workers dedicated to high priority lanes)
+        """
+        lane_names = self.lane_names
+        if min_lane is not None:
+            lane_names = lane_names[:lane_names.index(min_lane) + 1]
+
+        return [priority_lane_queue_name(queue, name) for name in lane_names]
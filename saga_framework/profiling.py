@@ -0,0 +1,147 @@
+"""
+This module contains opt-in profiler for Orchestrator hot path.
+
+Set profiler on saga class (one profiler can be shared by many saga classes):
+
+    CreateOrderSaga.profiler = SagaProfiler(sample_rate=0.1)
+
+and saga will time phases of message handling:
+ * handler - whole Celery response handler registered by register_async_step_handlers
+ * construction - saga instance construction in handler
+ * step_lookup - finding step by response task name
+ * execute, compensate, on_async_step_success, on_async_step_failure - saga methods
+ * action, compensation, callback - user step actions, compensations
+   and on_success/on_failure callbacks
+ * repository - saga state repository calls (StatefulSaga)
+ * send_task - sending (or buffering, or writing to outbox) commands
+ * logging - saga log records
+
+Phases are nested (e.g. action includes send_task), so they don't sum up to handler time.
+
+Sampling decision is made once per outermost measured phase (usually a handler),
+ so either all phases of a message are measured or none of them.
+
+To get report from a running worker, call SagaProfiler.dump_on_signal()
+ at worker startup and send signal (SIGUSR1 by default) to worker process.
+"""
+
+__all__ = ['PhaseStats', 'SagaProfiler']
+
+import random
+import signal
+import sys
+import threading
+import time
+import typing
+from dataclasses import dataclass
+
+
+@dataclass
+class PhaseStats:
+    count: int = 0
+    total: float = 0.0  # seconds
+    max: float = 0.0  # seconds
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+
+class _Measurement:
+    __slots__ = ('profiler', 'saga_class', 'phase', 'started_at')
+
+    def __init__(self, profiler: 'SagaProfiler', saga_class: str, phase: str):
+        self.profiler = profiler
+        self.saga_class = saga_class
+        self.phase = phase
+        self.started_at = None
+
+    def __enter__(self):
+        local = self.profiler._local
+        depth = getattr(local, 'depth', 0)
+        if not depth:
+            local.sampled = random.random() < self.profiler.sample_rate
+        local.depth = depth + 1
+
+        if local.sampled:
+            self.started_at = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.profiler._local.depth -= 1
+
+        if self.started_at is not None:
+            self.profiler.record(self.saga_class, self.phase,
+                                 time.perf_counter() - self.started_at)
+
+
+class SagaProfiler:
+    """
+    Aggregates phase timings per saga class. Thread-safe.
+    sample_rate is a share of messages to measure (1.0 means all of them)
+    """
+    def __init__(self, sample_rate: float = 1.0):
+        self.sample_rate = sample_rate
+        self._stats = {}  # type: typing.Dict[typing.Tuple[str, str], PhaseStats]
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def measure(self, saga_class: str, phase: str) -> typing.ContextManager:
+        return _Measurement(self, saga_class, phase)
+
+    def record(self, saga_class: str, phase: str, seconds: float):
+        with self._lock:
+            stats = self._stats.get((saga_class, phase))
+            if stats is None:
+                stats = self._stats[(saga_class, phase)] = PhaseStats()
+
+            stats.count += 1
+            stats.total += seconds
+            stats.max = max(stats.max, seconds)
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+    def report(self) -> typing.Dict[str, typing.Dict[str, PhaseStats]]:
+        """
+        Returns {saga class: {phase: stats}}
+        """
+        with self._lock:
+            report = {}
+            for (saga_class, phase), stats in self._stats.items():
+                report.setdefault(saga_class, {})[phase] = PhaseStats(
+                    stats.count, stats.total, stats.max)
+
+        return report
+
+    def format_report(self) -> str:
+        """
+        Returns report as text table, phases are sorted by total time.
+        Share is calculated relative to handler phase
+         (or to the longest phase if there were no handled messages)
+        """
+        lines = []
+        for saga_class, phases in sorted(self.report().items()):
+            phases = sorted(phases.items(), key=lambda item: item[1].total, reverse=True)
+            base_total = dict(phases).get('handler', phases[0][1]).total or 1.0
+
+            lines.append(f'{saga_class} (sample rate {self.sample_rate:g})')
+            lines.append(f'  {"phase":<24}{"count":>10}{"total, ms":>12}'
+                         f'{"mean, ms":>12}{"max, ms":>12}{"share":>8}')
+            for phase, stats in phases:
+                lines.append(f'  {phase:<24}{stats.count:>10}'
+                             f'{stats.total * 1000:>12.2f}{stats.mean * 1000:>12.3f}'
+                             f'{stats.max * 1000:>12.3f}{stats.total / base_total:>8.1%}')
+
+        return '\n'.join(lines)
+
+    def dump_on_signal(self, signum: int = getattr(signal, 'SIGUSR1', None),
+                       stream: typing.TextIO = None):
+        """
+        Installs signal handler that writes report to stream (stderr by default).
+        Should be called from main thread
+        """
+        def signal_handler(signum_, frame):
+            print(self.format_report(), file=stream or sys.stderr, flush=True)
+
+        signal.signal(signum, signal_handler)
@@ -1,37 +1,95 @@
 __all__ = ['saga_step_handler', 'no_response_saga_step_handler',
+           'batch_saga_step_handler', 'fused_saga_step_handler',
            'send_saga_response']
 
 
 import functools
 import logging
+import sys
 from dataclasses import dataclass, asdict
 
 import typing
 
-import celery
-from celery import Celery, Task
+if typing.TYPE_CHECKING:
+    from celery import Celery, Task
 
-from .utils import success_task_name, failure_task_name, serialize_saga_error
+from .batching import ResponseBatcher
+from .events import SagaEventType, emit_saga_event
+from .idempotency import AbstractIdempotencyStore, StoredResponse
+from .payloads import PayloadRegistry
+from .utils import success_task_name, failure_task_name, \
+    serialize_saga_error, task_name_from_batch_task_name, \
+    fused_response_task_name
 
 logger = logging.getLogger(__name__)
 
 
-def send_saga_response(celery_app: Celery,
+def send_saga_response(celery_app: 'Celery',
                        response_task_name: str,
                        response_queue_name: str,
                        saga_id: int,
-                       payload):  # assuming payload is a @dataclass
+                       payload,  # assuming payload is a @dataclass
+                       priority: int = None):
+    options = {}
+    if priority is not None:
+        options['priority'] = priority
+
     return celery_app.send_task(
         response_task_name,
         args=[
             saga_id,
             payload
         ],
-        queue=response_queue_name
+        queue=response_queue_name,
+        **options
     )
 
 
-def _saga_step_handler(response_queue: typing.Union[str, None]):
+def _send_saga_response(celery_task: 'Task',
+                        response_batcher: typing.Optional[ResponseBatcher],
+                        response_task_name: str,
+                        response_queue_name: str,
+                        saga_id: int,
+                        payload,
+                        priority: int = None):
+    if response_batcher:
+        response_batcher.add_response(response_task_name, response_queue_name,
+                                      saga_id, payload, priority)
+    else:
+        send_saga_response(celery_task.app,
+                           response_task_name,
+                           response_queue_name,
+                           saga_id,
+                           payload,
+                           priority)
+
+
+def _failure_response_payload(exc: BaseException, saga_id: int = None,
+                              task_name: str = None) -> dict:
+    # Celery is never imported here, so handlers work with any transport
+    #  (see transports.py) and don't pay Celery import cost
+    celery_exceptions = sys.modules.get('celery.exceptions')
+
+    # let Celery handle retries
+    if celery_exceptions is not None and isinstance(exc, celery_exceptions.Retry):
+        raise exc
+
+    emit_saga_event(logger, logging.ERROR, SagaEventType.STEP_HANDLER_FAILED, saga_id,
+                    exc_info=exc, task_name=task_name)
+
+    # serialize error in a unified way
+    return asdict(serialize_saga_error(exc))
+
+
+def _get_response_queue(default_response_queue: str, command_options: dict) -> str:
+    # Orchestrator may ask to respond to specific queue (see AsyncSaga.get_response_queue)
+    return command_options.get('response_queue') or default_response_queue
+
+
+def _saga_step_handler(response_queue: typing.Union[str, None],
+                       response_batcher: ResponseBatcher = None,
+                       payload_registry: PayloadRegistry = None,
+                       idempotency_store: AbstractIdempotencyStore = None):
     """
     Apply this decorator between @task and actual task handler.
 
@@ -40,38 +98,62 @@ def _saga_step_handler(response_queue: typing.Union[str, None]):
 
     Note: it's important to set bind=True in @task
       because @saga_handler will need access to celery task instance
+
+    If Orchestrator asks to respond to specific queue (it does so for sharded sagas
+     and sagas with priority lanes), response is sent there instead of response_queue.
+    Response is sent with the same priority as command has
+
+    If response_batcher is given, response isn't sent immediately
+     but buffered and sent as a part of batch response
+     (see AsyncSaga.register_batch_response_handler)
+
+    If payload_registry is given, command payload is decoded to dataclass
+     registered for task name (see payloads.py); invalid payload results
+     in failure response
+
+    If idempotency_store is given, repeated command with the same saga_id
+     isn't handled again, stored response is sent instead (see idempotency.py)
     """
     def inner(func):
         @functools.wraps(func)
-        def wrapper(celery_task: Task, saga_id: int, payload: dict):
-            try:
-                response_payload = func(celery_task, saga_id, payload)  # type: typing.Union[dict, None]
-                # use convention response task name
-                task_name = success_task_name(celery_task.name)
-            except BaseException as exc:
-                # let Celery handle retries
-                if isinstance(exc, celery.exceptions.Retry):
-                    raise
-
-                logger.exception(exc)
+        def wrapper(celery_task: 'Task', saga_id: int, payload: dict, **command_options):
+            stored_response = idempotency_store and \
+                              idempotency_store.get(celery_task.name, saga_id)
+            if stored_response:
+                task_name, response_payload = stored_response
+            else:
+                try:
+                    if payload_registry:
+                        payload = payload_registry.decode(celery_task.name, payload)
+                    response_payload = func(celery_task, saga_id, payload)  # type: typing.Union[dict, None]
+                    # use convention response task name
+                    task_name = success_task_name(celery_task.name)
+                except BaseException as exc:
+                    response_payload = _failure_response_payload(exc, saga_id, celery_task.name)
+                    # use convention response task name
+                    task_name = failure_task_name(celery_task.name)
 
-                # serialize error in a unified way
-                response_payload = asdict(serialize_saga_error(exc))
-                # use convention response task name
-                task_name = failure_task_name(celery_task.name)
+                if idempotency_store:
+                    idempotency_store.save(celery_task.name, saga_id,
+                                           StoredResponse(task_name, response_payload))
 
             if response_queue:
-                send_saga_response(celery_task.app,
-                                   task_name,
-                                   response_queue,
-                                   saga_id,
-                                   response_payload)
+                _send_saga_response(celery_task,
+                                    response_batcher,
+                                    task_name,
+                                    _get_response_queue(response_queue, command_options),
+                                    saga_id,
+                                    response_payload,
+                                    command_options.get('priority'))
         return wrapper
 
     return inner
 
 
-def saga_step_handler(response_queue: str):
+def saga_step_handler(response_queue: str,
+                      response_batcher: ResponseBatcher = None,
+                      payload_registry: PayloadRegistry = None,
+                      idempotency_store: AbstractIdempotencyStore = None):
     """
     Compensatable saga step assumed.
     For retriable steps, use corresponding decorator
@@ -79,7 +161,8 @@ def saga_step_handler(response_queue: str):
     It's also assumed that you will use this decorator with
      @task decorator, see docstring for _saga_step_handler
     """
-    return _saga_step_handler(response_queue)
+    return _saga_step_handler(response_queue, response_batcher, payload_registry,
+                              idempotency_store)
 
 
 no_response_saga_step_handler = _saga_step_handler(response_queue=None)
@@ -89,3 +172,117 @@ It's assumed that you will use this decorator with
 """
 
 
+def batch_saga_step_handler(response_queue: str,
+                            response_batcher: ResponseBatcher = None):
+    """
+    Batch version of saga_step_handler.
+    Apply this decorator between @task and actual batch handler:
+
+    @command_handlers_celery_app.task(bind=True, name=batch_task_name(verify_consumer_details_message.TASK_NAME))
+    @batch_saga_step_handler(CREATE_ORDER_SAGA_RESPONSE_QUEUE)
+    def verify_consumer_details_batch_task(self, commands: list) -> dict:
+        ...
+
+    Handler receives list of [saga_id, payload] pairs
+     (or [saga_id, payload, response_queue] if saga asks for specific response queue)
+     and should return dict {saga_id: response payload}.
+    If response for some saga is an exception instance or it's missing,
+     failure response will be sent for this saga.
+    If handler raises or returns something other than dict,
+     failure response will be sent for every saga in batch.
+
+    Responses are sent for each saga separately (with the same priority as batch has),
+     so Orchestrator handles them exactly like non-batched ones.
+    """
+    def inner(func):
+        @functools.wraps(func)
+        def wrapper(celery_task: 'Task', commands: typing.List[list], **command_options):
+            base_task_name = task_name_from_batch_task_name(celery_task.name)
+
+            try:
+                responses = func(celery_task, commands)  # type: typing.Dict[int, typing.Any]
+                if not isinstance(responses, dict):
+                    raise TypeError(f'Batch handler must return dict {{saga_id: response}}, '
+                                    f'got {type(responses).__name__}')
+            except BaseException as exc:
+                error_payload = _failure_response_payload(exc, task_name=base_task_name)
+                responses = {command[0]: exc for command in commands}
+            else:
+                error_payload = None
+
+            for saga_id, _, *command_response_queue in commands:
+                if saga_id in responses:
+                    response_payload = responses[saga_id]
+                else:
+                    response_payload = KeyError(f'Batch handler returned no response '
+                                                f'for saga {saga_id}')
+
+                if isinstance(response_payload, BaseException):
+                    response_payload = error_payload or \
+                                       _failure_response_payload(response_payload, saga_id,
+                                                                 base_task_name)
+                    task_name = failure_task_name(base_task_name)
+                else:
+                    task_name = success_task_name(base_task_name)
+
+                _send_saga_response(celery_task,
+                                    response_batcher,
+                                    task_name,
+                                    (command_response_queue or [response_queue])[0],
+                                    saga_id,
+                                    response_payload,
+                                    command_options.get('priority'))
+        return wrapper
+
+    return inner
+
+
+def fused_saga_step_handler(response_queue: str,
+                            handlers: typing.Dict[str, typing.Callable],
+                            response_batcher: ResponseBatcher = None,
+                            payload_registry: PayloadRegistry = None):
+    """
+    Builds Celery task handler for fused commands that Orchestrator sends
+     for consecutive AsyncSteps marked with fuse_with_next=True.
+    Register it for '{queue}.fused' task name:
+
+    command_handlers_celery_app.task(bind=True, name=fused_task_name(RESTAURANT_SERVICE_QUEUE))(
+        fused_saga_step_handler(CREATE_ORDER_SAGA_RESPONSE_QUEUE, handlers={
+            create_ticket_message.TASK_NAME: create_ticket,
+            approve_ticket_message.TASK_NAME: approve_ticket,
+        })
+    )
+
+    handlers are plain (not decorated with @saga_step_handler) functions
+     with the same signature as regular saga step handlers.
+    They are run in sequence until first failure,
+     then one combined response with per-step outcomes is sent.
+
+    Note: if some handler requests Celery retry, whole fused command is retried,
+     so handlers should be idempotent.
+
+    payload_registry works the same way as in saga_step_handler
+    """
+    def fused_handler(celery_task: 'Task', saga_id: int, commands: typing.List[list],
+                      **command_options):
+        outcomes = []
+        for task_name, payload in commands:
+            try:
+                if payload_registry:
+                    payload = payload_registry.decode(task_name, payload)
+                response_payload = handlers[task_name](celery_task, saga_id, payload)
+                outcomes.append([success_task_name(task_name), response_payload])
+            except BaseException as exc:
+                outcomes.append([failure_task_name(task_name),
+                                 _failure_response_payload(exc, saga_id, task_name)])
+                break
+
+        _send_saga_response(celery_task,
+                            response_batcher,
+                            fused_response_task_name(commands[0][0]),
+                            _get_response_queue(response_queue, command_options),
+                            saga_id,
+                            outcomes,
+                            command_options.get('priority'))
+
+    return fused_handler
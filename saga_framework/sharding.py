@@ -0,0 +1,89 @@
+"""
+This module contains helpers for sharded orchestration.
+
+By default, responses for all sagas go to one response queue
+ (like 'create_order_saga_responses'), and any Orchestrator worker
+ can pick any response.
+
+With sharding, saga_id is mapped to a shard with consistent hashing,
+ AsyncSaga asks Saga Handler services to respond to shard's own response queue
+ (like 'create_order_saga_responses.shard.3'), and every Orchestrator worker
+ consumes only queues of its shards.
+So all messages of one saga are handled by one worker.
+
+Shards are distributed between workers with consistent hashing too,
+ so when a worker is added or removed, only few shards move to other workers
+ (see assign_shards and celery_utils.rebalance_worker_queues).
+"""
+
+__all__ = ['ConsistentHashRing', 'assign_shards']
+
+import bisect
+import hashlib
+import typing
+
+
+def _hash(key) -> int:
+    digest = hashlib.blake2b(str(key).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big')
+
+
+class ConsistentHashRing:
+    """
+    Maps keys (like saga ids) to nodes (like shards or workers).
+    Each node is placed on the ring virtual_nodes times
+     to distribute keys evenly.
+    """
+    def __init__(self, nodes: typing.Iterable = (), virtual_nodes: int = 64):
+        self.virtual_nodes = virtual_nodes
+        self._nodes = set()
+        self._hashes = []  # type: typing.List[int]  # sorted
+        self._hash_to_node = {}
+
+        for node in nodes:
+            self.add_node(node)
+
+    @property
+    def nodes(self) -> typing.List:
+        return sorted(self._nodes, key=str)
+
+    def add_node(self, node):
+        if node in self._nodes:
+            return
+
+        self._nodes.add(node)
+        for i in range(self.virtual_nodes):
+            hash_ = _hash(f'{node}#{i}')
+            self._hash_to_node[hash_] = node
+            bisect.insort(self._hashes, hash_)
+
+    def remove_node(self, node):
+        if node not in self._nodes:
+            raise KeyError(f'node {node} is not in the ring')
+
+        self._nodes.remove(node)
+        for i in range(self.virtual_nodes):
+            hash_ = _hash(f'{node}#{i}')
+            del self._hash_to_node[hash_]
+            self._hashes.pop(bisect.bisect_left(self._hashes, hash_))
+
+    def get_node(self, key):
+        if not self._hashes:
+            raise LookupError('hash ring is empty')
+
+        index = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._hash_to_node[self._hashes[index]]
+
+
+def assign_shards(shards: typing.Iterable, workers: typing.Iterable,
+                  virtual_nodes: int = 64) -> typing.Dict[typing.Any, typing.List]:
+    """
+    Distributes shards between workers.
+    When workers set changes, only shards of added/removed workers move.
+    """
+    ring = ConsistentHashRing(workers, virtual_nodes)
+    assignment = {worker: [] for worker in ring.nodes}
+    for shard in shards:
+        assignment[ring.get_node(shard)].append(shard)
+
+    return assignment
@@ -0,0 +1,452 @@
+"""
+This module contains capacity-planning simulator for saga definitions.
+
+Requires numpy (pip install saga_framework[simulation]).
+
+SagaSimulator takes steps of actual saga class and simulates sagas
+ going through Orchestrator and Saga Handler services:
+
+ * Orchestrator handles saga start and every response: it costs orchestrator_time
+   plus service time of sync steps that run in this message
+   (plus compensation time of compensated steps if saga fails here)
+ * command and response travel through broker for broker_latency each
+ * command waits in step queue until one of queue workers is free,
+   then is handled for step service time
+ * step fails with its failure probability, then saga is compensated
+ * retriable steps are dispatched after saga succeeds and don't add to its latency
+
+Every queue (and Orchestrator) is a pool of workers taking messages in FIFO order,
+ with number of workers given per run, so runs with different worker counts
+ show throughput ceilings, waiting in queues and saga latency percentiles:
+
+    simulator = SagaSimulator(CreateOrderSaga, {
+        'verify_consumer_details': StepProfile(exponential(0.020)),
+        'create_ticket': StepProfile(lognormal(0.050, 0.5), failure_probability=0.01,
+                                     compensation_time=0.002),
+    }, broker_latency=exponential(0.002))
+
+    for result in simulator.sweep(arrival_rate=500, sagas=1_000_000, workers_options=[
+        {'orchestrator': 4, 'consumer_service': 8, 'restaurant_service': 16},
+        {'orchestrator': 4, 'consumer_service': 8, 'restaurant_service': 32},
+    ]):
+        print(result.format_report())
+
+All random values are sampled up front with numpy (the same values for every run,
+ so runs differ only by worker counts), so event loop just assigns messages to workers
+ in the order they arrive. The event loop itself isn't vectorized
+ (a message's wait depends on every earlier message of its queue),
+ so run time grows linearly with the number of simulated messages
+ (2 * async steps + 1 per saga), and millions of sagas take tens of seconds.
+Batched and fused steps are simulated as regular ones.
+"""
+
+__all__ = ['StepProfile', 'ResourceStats', 'SimulationResult', 'SagaSimulator',
+           'constant', 'exponential', 'lognormal', 'uniform']
+
+import array
+import heapq
+import math
+import typing
+from dataclasses import dataclass, field
+
+import numpy
+
+from .async_saga import AsyncStep
+from .base_saga import BaseStep, StepKind, NO_ACTION
+
+ORCHESTRATOR = 'orchestrator'
+
+# distribution(rng, size) returns array of sampled durations (in seconds)
+Distribution = typing.Callable[[numpy.random.Generator, int], numpy.ndarray]
+
+
+def constant(value: float) -> Distribution:
+    return lambda rng, size: numpy.full(size, float(value))
+
+
+def exponential(mean: float) -> Distribution:
+    return lambda rng, size: rng.exponential(mean, size)
+
+
+def lognormal(mean: float, sigma: float) -> Distribution:
+    """
+    Log-normal distribution with given mean
+     (sigma is standard deviation of underlying normal distribution)
+    """
+    mu = math.log(mean) - sigma ** 2 / 2
+    return lambda rng, size: rng.lognormal(mu, sigma, size)
+
+
+def uniform(low: float, high: float) -> Distribution:
+    return lambda rng, size: rng.uniform(low, high, size)
+
+
+def _as_distribution(value: typing.Union[float, Distribution]) -> Distribution:
+    return value if callable(value) else constant(value)
+
+
+@dataclass
+class StepProfile:
+    """
+    service_time is time of handling step command in Saga Handler service
+     (or time of running action in Orchestrator for sync steps)
+    """
+    service_time: typing.Union[float, Distribution] = 0.0
+    failure_probability: float = 0.0
+    compensation_time: typing.Union[float, Distribution] = 0.0
+
+
+@dataclass
+class ResourceStats:
+    workers: int
+    messages: int
+    utilization: float
+    throughput_ceiling: float  # sagas per second that workers can handle at most
+    mean_wait: float  # seconds that messages wait for free worker
+    p99_wait: float
+    max_wait: float
+    mean_queue_length: float
+
+
+@dataclass
+class SimulationResult:
+    arrival_rate: float  # sagas per second
+    workers: typing.Dict[str, int]
+    sagas: int
+    failed_ratio: float
+    throughput: float  # finished sagas per second
+    throughput_ceiling: float
+    bottleneck: str
+    latency_percentiles: typing.Dict[float, float]  # seconds
+    resources: typing.Dict[str, ResourceStats] = field(default_factory=dict)
+
+    def format_report(self) -> str:
+        workers = ', '.join(f'{name}={count}' for name, count in self.workers.items())
+        latency = ', '.join(f'p{percentile:g}={seconds * 1000:.1f}ms'
+                            for percentile, seconds in self.latency_percentiles.items())
+        lines = [f'workers: {workers}',
+                 f'  arrival rate {self.arrival_rate:g}/s, throughput {self.throughput:.1f}/s, '
+                 f'ceiling {self.throughput_ceiling:.1f}/s ({self.bottleneck}), '
+                 f'failed {self.failed_ratio:.2%}',
+                 f'  saga latency: {latency}',
+                 f'  {"resource":<28}{"workers":>8}{"util":>8}{"ceiling/s":>12}'
+                 f'{"mean wait":>12}{"p99 wait":>12}{"queue":>10}']
+        for name, stats in self.resources.items():
+            lines.append(f'  {name:<28}{stats.workers:>8}{stats.utilization:>8.1%}'
+                         f'{stats.throughput_ceiling:>12.1f}'
+                         f'{stats.mean_wait * 1000:>10.1f}ms{stats.p99_wait * 1000:>10.1f}ms'
+                         f'{stats.mean_queue_length:>10.1f}')
+
+        return '\n'.join(lines)
+
+
+def _to_array(values: numpy.ndarray) -> array.array:
+    # indexing array.array returns Python floats, which is way faster
+    #  than indexing numpy array in event loop
+    result = array.array('d')
+    result.frombytes(numpy.ascontiguousarray(values, dtype=numpy.float64).tobytes())
+    return result
+
+
+class _Sample:
+    """
+    Sampled durations of all messages of all simulated sagas.
+
+    Main route of saga is: Orchestrator, queue of 1st async step, Orchestrator,
+     queue of 2nd async step, ..., Orchestrator (i.e. 2 * async steps + 1 visits),
+     shorter if saga fails.
+    Retriable async steps of succeeded saga are routes of 2 visits:
+     step queue, Orchestrator
+    """
+    def __init__(self, simulator: 'SagaSimulator', sagas: int, arrival_rate: float):
+        rng = numpy.random.default_rng(simulator.seed)
+        n = sagas
+        segments = simulator._segments
+        async_steps = [async_step for _, async_step in segments[:-1]]
+        main_steps = simulator._main_steps
+        profiles = [simulator._profile(step) for step in main_steps]
+        route_length = 2 * len(async_steps) + 1
+
+        self.starts = numpy.cumsum(rng.exponential(1 / arrival_rate, n))
+
+        # index of first failed step among main steps (len(main_steps) if none)
+        failed_at = numpy.full(n, len(main_steps))
+        for index in reversed(range(len(main_steps))):
+            probability = profiles[index].failure_probability
+            if probability:
+                failed_at[rng.random(n) < probability] = index
+
+        # compensation time if saga fails on given step: sum for all previous steps
+        compensation_cumsum = numpy.zeros((n, len(main_steps) + 1))
+        for index, (step, profile) in enumerate(zip(main_steps, profiles)):
+            compensation = numpy.zeros(n)
+            if step.compensation is not NO_ACTION:
+                compensation = _as_distribution(profile.compensation_time)(rng, n)
+            compensation_cumsum[:, index + 1] = compensation_cumsum[:, index] + compensation
+        compensation_time = compensation_cumsum[numpy.arange(n), failed_at]
+        self.failed = failed_at < len(main_steps)
+
+        service = numpy.zeros((n, route_length))
+        self.route_lengths = numpy.full(n, route_length)
+        step_index = 0
+        for segment_index, (sync_steps, async_step) in enumerate(segments):
+            visit = 2 * segment_index
+            service[:, visit] = simulator.orchestrator_time(rng, n)
+            for sync_step in sync_steps:
+                runs = failed_at >= step_index
+                service[:, visit] += numpy.where(
+                    runs, _as_distribution(simulator._profile(sync_step).service_time)(rng, n), 0)
+                fails_here = failed_at == step_index
+                self.route_lengths[fails_here] = visit + 1
+                step_index += 1
+
+            if async_step is not None:
+                service[:, visit + 1] = _as_distribution(
+                    simulator._profile(async_step).service_time)(rng, n)
+                self.route_lengths[failed_at == step_index] = visit + 3
+                step_index += 1
+
+        for step in simulator._retriable_sync_steps:
+            service[:, route_length - 1] += numpy.where(
+                self.failed, 0, _as_distribution(simulator._profile(step).service_time)(rng, n))
+
+        # compensation runs in Orchestrator when handling the last message
+        last_visit = self.route_lengths - 1
+        service[self.failed, last_visit[self.failed]] += compensation_time[self.failed]
+
+        self.route_length = route_length
+        self.service = service
+        self.latency = simulator.broker_latency(rng, n * route_length).reshape(n, route_length)
+
+        retriable = len(simulator._retriable_async_steps)
+        self.branch_service = numpy.zeros((retriable, n, 2))
+        for index, step in enumerate(simulator._retriable_async_steps):
+            self.branch_service[index, :, 0] = _as_distribution(
+                simulator._profile(step).service_time)(rng, n)
+            self.branch_service[index, :, 1] = simulator.orchestrator_time(rng, n)
+        self.branch_latency = simulator.broker_latency(
+            rng, retriable * n * 2).reshape(retriable, n, 2)
+
+
+class SagaSimulator:
+    def __init__(self,
+                 saga: typing.Union[type, object, typing.List[BaseStep]],
+                 step_profiles: typing.Dict[str, StepProfile],
+                 broker_latency: typing.Union[float, Distribution] = 0.002,
+                 orchestrator_time: typing.Union[float, Distribution] = 0.001,
+                 seed: int = 0):
+        """
+        saga is saga class with class-level steps, saga instance or list of steps.
+        step_profiles are given by step name, steps without profile take no time
+        """
+        steps = saga if isinstance(saga, list) else saga.steps
+        self.step_profiles = step_profiles
+        self.broker_latency = _as_distribution(broker_latency)
+        self.orchestrator_time = _as_distribution(orchestrator_time)
+        self.seed = seed
+
+        self._main_steps = [step for step in steps if step.kind != StepKind.RETRIABLE]
+        self._retriable_async_steps = [step for step in steps
+                                       if step.kind == StepKind.RETRIABLE
+                                       and isinstance(step, AsyncStep)]
+        # main steps split by async steps: [(sync steps, async step)],
+        #  last segment has no async step
+        self._segments = []
+        sync_steps = []
+        for step in self._main_steps:
+            if isinstance(step, AsyncStep):
+                self._segments.append((sync_steps, step))
+                sync_steps = []
+            else:
+                sync_steps.append(step)
+        self._segments.append((sync_steps, None))
+        # retriable sync steps run right after the last main step
+        self._retriable_sync_steps = [step for step in steps
+                                      if step.kind == StepKind.RETRIABLE
+                                      and not isinstance(step, AsyncStep)]
+
+        self._samples = {}  # type: typing.Dict[tuple, _Sample]
+
+    def _profile(self, step: BaseStep) -> StepProfile:
+        return self.step_profiles.get(step.name) or StepProfile()
+
+    @property
+    def resources(self) -> typing.List[str]:
+        queues = [async_step.queue for _, async_step in self._segments[:-1]] + \
+                 [step.queue for step in self._retriable_async_steps]
+        return [ORCHESTRATOR] + list(dict.fromkeys(queues))
+
+    def _sample(self, sagas: int, arrival_rate: float) -> _Sample:
+        # the same random values for all runs with the same load
+        key = (sagas, arrival_rate)
+        if key not in self._samples:
+            self._samples = {key: _Sample(self, sagas, arrival_rate)}
+        return self._samples[key]
+
+    def run(self, arrival_rate: float, workers: typing.Dict[str, int],
+            sagas: int = 100000,
+            percentiles: typing.Iterable[float] = (50, 90, 99, 99.9)) -> SimulationResult:
+        """
+        Simulates given number of sagas started at arrival_rate per second (Poisson process).
+        workers are given by queue name and ORCHESTRATOR, default is 1
+        """
+        sample = self._sample(sagas, arrival_rate)
+        resources = self.resources
+        workers = {name: workers.get(name, 1) for name in resources}
+        resource_index = {name: index for index, name in enumerate(resources)}
+        route_resources = []
+        for _, async_step in self._segments:
+            route_resources.append(resource_index[ORCHESTRATOR])
+            if async_step is not None:
+                route_resources.append(resource_index[async_step.queue])
+        branch_resources = [resource_index[step.queue] for step in self._retriable_async_steps]
+
+        main_wait, branch_wait, ends, branches_finished_at = self._simulate(
+            sample, resources, workers, route_resources, branch_resources)
+
+        # retriable steps can be handled after the last saga finished
+        duration = max(float(ends.max()), branches_finished_at) - float(sample.starts[0])
+        main_wait = main_wait.reshape(sagas, sample.route_length)
+        branch_wait = branch_wait.reshape(len(branch_resources), sagas, 2)
+
+        resource_stats = {}
+        for index, name in enumerate(resources):
+            waits = [main_wait[:, [visit for visit, resource in enumerate(route_resources)
+                                   if resource == index]]]
+            services = [sample.service[:, [visit for visit, resource in enumerate(route_resources)
+                                           if resource == index]]]
+            for branch, resource in enumerate(branch_resources):
+                visit = 0 if resource == index else 1 if index == 0 else None
+                if visit is not None:
+                    waits.append(branch_wait[branch, :, visit])
+                    services.append(sample.branch_service[branch, :, visit])
+
+            waits = numpy.concatenate([wait.ravel() for wait in waits])
+            services = numpy.concatenate([service.ravel() for service in services])
+            handled = ~numpy.isnan(waits)
+            waits = waits[handled]
+            busy = float(services[handled].sum())
+
+            resource_stats[name] = ResourceStats(
+                workers=workers[name],
+                messages=int(handled.sum()),
+                utilization=busy / (workers[name] * duration),
+                throughput_ceiling=workers[name] * sagas / busy if busy else math.inf,
+                mean_wait=float(waits.mean()) if len(waits) else 0.0,
+                p99_wait=float(numpy.percentile(waits, 99)) if len(waits) else 0.0,
+                max_wait=float(waits.max()) if len(waits) else 0.0,
+                mean_queue_length=float(waits.sum()) / duration,
+            )
+
+        bottleneck = min(resource_stats, key=lambda name: resource_stats[name].throughput_ceiling)
+        latencies = ends - sample.starts
+        return SimulationResult(
+            arrival_rate=arrival_rate,
+            workers=workers,
+            sagas=sagas,
+            failed_ratio=float(sample.failed.mean()),
+            throughput=sagas / float(ends.max() - sample.starts[0]),
+            throughput_ceiling=resource_stats[bottleneck].throughput_ceiling,
+            bottleneck=bottleneck,
+            latency_percentiles=dict(zip(percentiles,
+                                         numpy.percentile(latencies, list(percentiles)).tolist())),
+            resources=resource_stats,
+        )
+
+    def sweep(self, arrival_rate: float,
+              workers_options: typing.Iterable[typing.Dict[str, int]],
+              sagas: int = 100000) -> typing.List[SimulationResult]:
+        return [self.run(arrival_rate, workers, sagas) for workers in workers_options]
+
+    @staticmethod
+    def _simulate(sample: _Sample, resources: typing.List[str], workers: typing.Dict[str, int],
+                  route_resources: typing.List[int], branch_resources: typing.List[int]):
+        """
+        Event loop: messages are taken in the order they arrive to queues,
+         each one is given to worker that gets free first
+        """
+        n = len(sample.starts)
+        route_length = sample.route_length
+        branches = len(branch_resources)
+        main_size = n * route_length
+
+        starts = sample.starts.tolist()
+        # flat index of the last visit of every saga
+        last_visits = (numpy.arange(n) * route_length + sample.route_lengths - 1).tolist()
+        failed = sample.failed.tolist()
+        service = _to_array(sample.service.ravel())
+        latency = _to_array(sample.latency.ravel())
+        branch_service = _to_array(sample.branch_service.ravel())
+        branch_latency = _to_array(sample.branch_latency.ravel())
+
+        main_wait = _to_array(numpy.full(main_size, numpy.nan))
+        branch_wait = _to_array(numpy.full(branches * n * 2, numpy.nan))
+        ends = _to_array(numpy.zeros(n))
+
+        # free times of workers of each resource (heaps)
+        pools = [[0.0] * workers[name] for name in resources]
+        orchestrator_pool = pools[0]
+        route_pools = [pools[resource] for resource in route_resources]
+        branch_pools = [pools[resource] for resource in branch_resources]
+
+        heappush, heappop, heappushpop, heapreplace = \
+            heapq.heappush, heapq.heappop, heapq.heappushpop, heapq.heapreplace
+        # (arrival time, flat index of visit): main routes are indexed as
+        #  saga * route_length + visit, retriable steps' routes go after them
+        #  as main_size + (branch * n + saga) * 2 + visit.
+        # Saga start is scheduled when previous saga starts
+        event = (starts[0], 0) if n else None
+        events = []
+        branches_finished_at = 0.0
+
+        while event is not None:
+            at, index = event
+            next_event = None
+
+            if index < main_size:
+                saga, visit = divmod(index, route_length)
+                if not visit and saga + 1 < n:
+                    heappush(events, (starts[saga + 1], index + route_length))
+
+                pool = route_pools[visit]
+                started_at = pool[0]
+                if started_at < at:
+                    started_at = at
+                finished_at = started_at + service[index]
+                heapreplace(pool, finished_at)
+                main_wait[index] = started_at - at
+
+                if index < last_visits[saga]:
+                    next_event = (finished_at + latency[index], index + 1)
+                else:
+                    ends[saga] = finished_at
+                    if branches and not failed[saga]:
+                        for branch in range(branches):
+                            branch_index = (branch * n + saga) * 2
+                            heappush(events, (finished_at + branch_latency[branch_index],
+                                              main_size + branch_index))
+            else:
+                branch_index = index - main_size
+                visit = branch_index & 1
+                pool = orchestrator_pool if visit else branch_pools[branch_index // (2 * n)]
+                started_at = pool[0]
+                if started_at < at:
+                    started_at = at
+                finished_at = started_at + branch_service[branch_index]
+                heapreplace(pool, finished_at)
+                branch_wait[branch_index] = started_at - at
+
+                if not visit:
+                    next_event = (finished_at + branch_latency[branch_index + 1], index + 1)
+                elif finished_at > branches_finished_at:
+                    branches_finished_at = finished_at
+
+            if next_event is not None:
+                event = heappushpop(events, next_event)
+            elif events:
+                event = heappop(events)
+            else:
+                event = None
+
+        return (numpy.frombuffer(main_wait), numpy.frombuffer(branch_wait),
+                numpy.frombuffer(ends), branches_finished_at)
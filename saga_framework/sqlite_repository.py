@@ -0,0 +1,401 @@
+"""
+This module contains SQLite implementation of AbstractSagaStateRepository.
+
+It's a complete, dependency-free reference implementation
+ (for tests, small deployments and as an example for other databases):
+ * saga status is stored as separate indexed fields:
+   step index, step name and phase (see SagaPhase)
+ * every status transition is recorded to transitions table with a timestamp
+ * aggregate queries (counts per step and phase, oldest sagas, age percentiles)
+   are served from covering indexes, without reading saga state rows
+ * finished sagas can be exported and deleted in batches (see archive.py)
+"""
+
+__all__ = ['SQLiteSagaStateRepository']
+
+import contextlib
+import datetime
+import json
+import sqlite3
+import threading
+import typing
+
+from .base_saga import BaseStep
+from .stateful_saga import AbstractSagaStateRepository, SagaPhase
+
+
+def _to_timestamp(value: datetime.datetime) -> float:
+    # naive datetimes are assumed to be in UTC (like datetime.utcnow() returns)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.timezone.utc)
+    return value.timestamp()
+
+
+def _from_timestamp(value: float) -> datetime.datetime:
+    return datetime.datetime.fromtimestamp(value, datetime.timezone.utc).replace(tzinfo=None)
+
+
+class SQLiteSagaStateRepository(AbstractSagaStateRepository):
+    """
+    Saga states are stored in '{table_prefix}saga_state' table,
+     status transitions are stored in '{table_prefix}saga_transition' table,
+     saga context is stored in '{table_prefix}saga_context' table
+     (one JSON-encoded value per row).
+
+    extra_columns allow to keep saga-specific fields (like order_id)
+     in saga state table: {column name: SQL type}
+
+    Nothing is committed while repository is inside transaction()
+     (transactions can be nested), so use the same connection for outbox
+     to commit saga state and commands together.
+
+    Connection is used by one thread at a time, so repository can be shared
+     by threads of Orchestrator worker (open connection with check_same_thread=False)
+    """
+    def __init__(self, connection: sqlite3.Connection,
+                 saga_class_name: str = None,
+                 table_prefix: str = '',
+                 extra_columns: typing.Dict[str, str] = None):
+        self.connection = connection
+        self.saga_class_name = saga_class_name
+        self.state_table = f'{table_prefix}saga_state'
+        self.transition_table = f'{table_prefix}saga_transition'
+        self.context_table = f'{table_prefix}saga_context'
+        self.extra_columns = extra_columns or {}
+        self._transaction_depth = 0
+        self._lock = threading.RLock()
+
+    def create_tables(self):
+        extra_columns_sql = ''.join(f', {name} {type_}'
+                                    for name, type_ in self.extra_columns.items())
+        with self.transaction():
+            self.connection.execute(f'''
+                CREATE TABLE IF NOT EXISTS {self.state_table} (
+                    id INTEGER PRIMARY KEY,
+                    saga_class TEXT,
+                    status TEXT,
+                    step_index INTEGER,
+                    step_name TEXT,
+                    phase TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    failed_step TEXT,
+                    failed_at REAL,
+                    failure_details TEXT,
+                    compensation_checkpoint INTEGER
+                    {extra_columns_sql}
+                )
+            ''')
+            # covering index for all aggregate queries
+            self.connection.execute(f'''
+                CREATE INDEX IF NOT EXISTS ix_{self.state_table}_phase_step_updated_at
+                ON {self.state_table} (phase, step_name, updated_at)
+            ''')
+            self.connection.execute(f'''
+                CREATE TABLE IF NOT EXISTS {self.transition_table} (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    saga_id INTEGER NOT NULL,
+                    saga_class TEXT,
+                    step_index INTEGER,
+                    step_name TEXT,
+                    phase TEXT NOT NULL,
+                    at REAL NOT NULL
+                )
+            ''')
+            self.connection.execute(f'''
+                CREATE INDEX IF NOT EXISTS ix_{self.transition_table}_saga_id
+                ON {self.transition_table} (saga_id, id)
+            ''')
+            self.connection.execute(f'''
+                CREATE TABLE IF NOT EXISTS {self.context_table} (
+                    saga_id INTEGER NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    PRIMARY KEY (saga_id, key)
+                ) WITHOUT ROWID
+            ''')
+
+    @contextlib.contextmanager
+    def transaction(self):
+        with self._lock:
+            self._transaction_depth += 1
+            if self._transaction_depth == 1 and not self.connection.in_transaction:
+                # sqlite3 module opens transaction only before data-modifying statement,
+                #  so reads (like ones of export_sagas) wouldn't share a snapshot otherwise
+                self.connection.execute('BEGIN')
+            try:
+                yield
+            except BaseException:
+                self._transaction_depth -= 1
+                if not self._transaction_depth:
+                    self.connection.rollback()
+                raise
+            else:
+                self._transaction_depth -= 1
+                if not self._transaction_depth:
+                    self.connection.commit()
+
+    def create_saga_state(self, saga_id: int = None, **fields) -> int:
+        now = _to_timestamp(datetime.datetime.utcnow())
+        fields = dict(id=saga_id, saga_class=self.saga_class_name, status='not_started',
+                      created_at=now, updated_at=now, **fields)
+
+        with self.transaction():
+            cursor = self.connection.execute(
+                f'INSERT INTO {self.state_table} ({", ".join(fields)}) '
+                f'VALUES ({", ".join("?" * len(fields))})',
+                tuple(fields.values())
+            )
+
+        return cursor.lastrowid
+
+    def get_saga_state_by_id(self, saga_id: int) -> typing.Optional[dict]:
+        with self._lock:
+            cursor = self.connection.execute(
+                f'SELECT * FROM {self.state_table} WHERE id = ?', (saga_id,))
+            row = cursor.fetchone()
+        if row is None:
+            return None
+
+        return dict(zip([column[0] for column in cursor.description], row))
+
+    def update_status(self, saga_id: int, status: str) -> object:
+        return self.update(saga_id, status=status,
+                           updated_at=_to_timestamp(datetime.datetime.utcnow()))
+
+    def update(self, saga_id: int, **fields_to_update) -> object:
+        # updated_at is time of the last status change (see update_step_status),
+        #  other writes (like compensation checkpoints) don't touch it,
+        #  so saga ages stay correct and updated_at index isn't rewritten
+        with self.transaction():
+            self.connection.execute(
+                f'UPDATE {self.state_table} '
+                f'SET {", ".join(f"{name} = ?" for name in fields_to_update)} '
+                f'WHERE id = ?',
+                (*fields_to_update.values(), saga_id)
+            )
+
+    def on_step_failure(self, saga_id: int, failed_step: BaseStep, initial_failure_payload: dict) -> object:
+        return self.update(saga_id,
+                           failed_step=failed_step.name,
+                           failed_at=_to_timestamp(datetime.datetime.utcnow()),
+                           failure_details=json.dumps(initial_failure_payload))
+
+    def save_compensation_checkpoint(self, saga_id: int, step_index: int) -> object:
+        return self.update(saga_id, compensation_checkpoint=step_index)
+
+    def get_compensation_checkpoint(self, saga_id: int) -> typing.Optional[int]:
+        with self._lock:
+            row = self.connection.execute(
+                f'SELECT compensation_checkpoint FROM {self.state_table} WHERE id = ?',
+                (saga_id,)
+            ).fetchone()
+
+        return row[0] if row else None
+
+    def get_step_failure(self, saga_id: int) -> typing.Optional[typing.Tuple[str, dict]]:
+        with self._lock:
+            row = self.connection.execute(
+                f'SELECT failed_step, failure_details FROM {self.state_table} WHERE id = ?',
+                (saga_id,)
+            ).fetchone()
+
+        if row is None or row[0] is None:
+            return None
+
+        failed_step, failure_details = row
+        return failed_step, json.loads(failure_details)
+
+    def load_saga_context(self, saga_id: int,
+                          keys: typing.Optional[typing.List[str]] = None) -> dict:
+        query = f'SELECT key, value FROM {self.context_table} WHERE saga_id = ?'
+        params = [saga_id]
+        if keys is not None:
+            query += f' AND key IN ({", ".join("?" * len(keys))})'
+            params += keys
+
+        with self._lock:
+            rows = self.connection.execute(query, params).fetchall()
+
+        return {key: json.loads(value) for key, value in rows}
+
+    def save_saga_context(self, saga_id: int, changed: dict, deleted_keys: typing.Set[str]) -> object:
+        with self.transaction():
+            if changed:
+                self.connection.executemany(
+                    f'INSERT INTO {self.context_table} (saga_id, key, value) VALUES (?, ?, ?) '
+                    f'ON CONFLICT (saga_id, key) DO UPDATE SET value = excluded.value',
+                    [(saga_id, key, json.dumps(value)) for key, value in changed.items()]
+                )
+            if deleted_keys:
+                self.connection.executemany(
+                    f'DELETE FROM {self.context_table} WHERE saga_id = ? AND key = ?',
+                    [(saga_id, key) for key in deleted_keys]
+                )
+
+    def update_step_status(self, saga_id: int,
+                           step_index: typing.Optional[int],
+                           step_name: typing.Optional[str],
+                           phase: SagaPhase,
+                           at: datetime.datetime) -> object:
+        at = _to_timestamp(at)
+        status = f'{step_name}.{phase.value}' if step_name else phase.value
+
+        with self.transaction():
+            self.update(saga_id, status=status, step_index=step_index,
+                        step_name=step_name, phase=phase.value, updated_at=at)
+            self.connection.execute(
+                f'INSERT INTO {self.transition_table} '
+                f'(saga_id, saga_class, step_index, step_name, phase, at) '
+                f'VALUES (?, ?, ?, ?, ?, ?)',
+                (saga_id, self.saga_class_name, step_index, step_name, phase.value, at)
+            )
+
+    def get_transitions(self, saga_id: int) -> typing.List[dict]:
+        with self._lock:
+            rows = self.connection.execute(
+                f'SELECT step_index, step_name, phase, at FROM {self.transition_table} '
+                f'WHERE saga_id = ? ORDER BY id',
+                (saga_id,)
+            ).fetchall()
+
+        return [dict(step_index=step_index, step_name=step_name,
+                     phase=SagaPhase(phase), at=_from_timestamp(at))
+                for step_index, step_name, phase, at in rows]
+
+    def find_finished_saga_ids(self, finished_before: datetime.datetime,
+                               limit: int = 1000) -> typing.List[int]:
+        # finished sagas have no step, so it's a range scan of phase index
+        with self._lock:
+            rows = self.connection.execute(
+                f'SELECT id FROM {self.state_table} '
+                f'WHERE phase IN (?, ?) AND step_name IS NULL AND updated_at < ? '
+                f'LIMIT ?',
+                (SagaPhase.SUCCEEDED.value, SagaPhase.FAILED.value,
+                 _to_timestamp(finished_before), limit)
+            ).fetchall()
+
+        return [saga_id for saga_id, in rows]
+
+    def export_sagas(self, saga_ids: typing.List[int]) -> typing.List[dict]:
+        placeholders = ', '.join('?' * len(saga_ids))
+        records = {}
+
+        # all three tables should be read from the same snapshot
+        with self.transaction():
+            cursor = self.connection.execute(
+                f'SELECT * FROM {self.state_table} WHERE id IN ({placeholders})', saga_ids)
+            columns = [column[0] for column in cursor.description]
+            for row in cursor:
+                state = dict(zip(columns, row))
+                records[state['id']] = dict(saga_id=state['id'], state=state,
+                                            transitions=[], context={})
+
+            transitions = self.connection.execute(
+                f'SELECT saga_id, step_index, step_name, phase, at FROM {self.transition_table} '
+                f'WHERE saga_id IN ({placeholders}) ORDER BY saga_id, id', saga_ids)
+            for saga_id, step_index, step_name, phase, at in transitions:
+                records[saga_id]['transitions'].append(
+                    dict(step_index=step_index, step_name=step_name, phase=phase, at=at))
+
+            context = self.connection.execute(
+                f'SELECT saga_id, key, value FROM {self.context_table} '
+                f'WHERE saga_id IN ({placeholders})', saga_ids)
+            for saga_id, key, value in context:
+                records[saga_id]['context'][key] = json.loads(value)
+
+        return list(records.values())
+
+    def delete_sagas(self, saga_ids: typing.List[int]) -> object:
+        placeholders = ', '.join('?' * len(saga_ids))
+        with self.transaction():
+            for table, column in ((self.context_table, 'saga_id'),
+                                  (self.transition_table, 'saga_id'),
+                                  (self.state_table, 'id')):
+                self.connection.execute(
+                    f'DELETE FROM {table} WHERE {column} IN ({placeholders})', saga_ids)
+
+    def iter_transition_chunks(self, chunk_size: int = 100000) \
+            -> typing.Iterator[typing.List[tuple]]:
+        last_key = (-1, -1)
+        while True:
+            # keyset pagination over (saga_id, id) index
+            with self._lock:
+                rows = self.connection.execute(
+                    f'SELECT saga_id, id, saga_class, step_name, phase, at '
+                    f'FROM {self.transition_table} '
+                    f'WHERE (saga_id, id) > (?, ?) ORDER BY saga_id, id LIMIT ?',
+                    (*last_key, chunk_size)
+                ).fetchall()
+            if not rows:
+                return
+
+            last_key = rows[-1][:2]
+            yield [(saga_id, saga_class, step_name, phase, at)
+                   for saga_id, _, saga_class, step_name, phase, at in rows]
+
+    def count_by_step_and_phase(self) -> typing.Dict[typing.Tuple[typing.Optional[str], SagaPhase], int]:
+        with self._lock:
+            rows = self.connection.execute(
+                f'SELECT step_name, phase, COUNT(*) FROM {self.state_table} '
+                f'WHERE phase IS NOT NULL GROUP BY phase, step_name'
+            ).fetchall()
+
+        return {(step_name, SagaPhase(phase)): count
+                for step_name, phase, count in rows}
+
+    def oldest_by_step(self, phase: SagaPhase = SagaPhase.RUNNING) -> typing.Dict[str, datetime.datetime]:
+        with self._lock:
+            rows = self.connection.execute(
+                f'SELECT step_name, MIN(updated_at) FROM {self.state_table} '
+                f'WHERE phase = ? GROUP BY step_name',
+                (phase.value,)
+            ).fetchall()
+
+        return {step_name: _from_timestamp(updated_at)
+                for step_name, updated_at in rows}
+
+    def age_percentiles(self, step_name: str, phase: SagaPhase = SagaPhase.RUNNING,
+                        percentiles: typing.Iterable[float] = (50, 90, 99),
+                        now: datetime.datetime = None) -> typing.Dict[float, datetime.timedelta]:
+        now = _to_timestamp(now or datetime.datetime.utcnow())
+        where = f'FROM {self.state_table} WHERE phase = ? AND step_name = ?'
+
+        # count and offsets should be taken from the same snapshot
+        with self.transaction():
+            count, = self.connection.execute(f'SELECT COUNT(*) {where}',
+                                             (phase.value, step_name)).fetchone()
+            if not count:
+                return {}
+
+            # the older saga is, the bigger its age is,
+            #  so walk index from the newest sagas (nearest-rank method)
+            offsets = {percentile: max(0, min(count - 1,
+                                              int(round(percentile / 100 * count)) - 1))
+                       for percentile in percentiles}
+
+            # walk index once: each percentile continues from the previous one's row
+            #  (keyset on (updated_at, id)), so rows are skipped once in total
+            #  instead of skipping from the newest saga for every percentile
+            result = {}
+            row = None
+            position = -1
+            for percentile, offset in sorted(offsets.items(), key=lambda item: item[1]):
+                if offset != position:
+                    if row is None:
+                        row = self.connection.execute(
+                            f'SELECT updated_at, id {where} '
+                            f'ORDER BY updated_at DESC, id DESC LIMIT 1 OFFSET ?',
+                            (phase.value, step_name, offset)
+                        ).fetchone()
+                    else:
+                        row = self.connection.execute(
+                            f'SELECT updated_at, id {where} AND (updated_at, id) < (?, ?) '
+                            f'ORDER BY updated_at DESC, id DESC LIMIT 1 OFFSET ?',
+                            (phase.value, step_name, *row, offset - position - 1)
+                        ).fetchone()
+                    position = offset
+                result[percentile] = datetime.timedelta(seconds=now - row[0])
+
+        # in the order percentiles were given
+        return {percentile: result[percentile] for percentile in offsets}
@@ -1,12 +1,34 @@
-__all__ = ['AbstractSagaStateRepository', 'StatefulSaga']
+__all__ = ['SagaPhase', 'AbstractSagaStateRepository', 'StatefulSaga']
 
 import abc
+import contextlib
+import datetime
+import enum
+import functools
+import typing
 
-from celery import Celery, Task
+if typing.TYPE_CHECKING:
+    from celery import Celery, Task
 
-from .utils import success_task_name, failure_task_name
-from .base_saga import BaseSaga, BaseStep
-from .async_saga import AsyncSaga, AsyncStep
+from .utils import success_task_name, failure_task_name, \
+    batch_response_task_name, fused_response_task_name
+from .base_saga import BaseSaga, BaseStep, StepKind
+from .context import SagaContext
+from .async_saga import AsyncSaga, AsyncStep, _handle_batch_response, \
+    _capture_batch_response, _compensation_response_task_names
+
+
+class SagaPhase(str, enum.Enum):
+    """
+    Phase of a saga step.
+    When saga finishes, its phase is SUCCEEDED or FAILED with no step
+    """
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    COMPENSATING = 'compensating'
+    COMPENSATED = 'compensated'
+    COMPENSATION_FAILED = 'compensation_failed'
 
 
 class AbstractSagaStateRepository(abc.ABC):
@@ -26,62 +48,279 @@ class AbstractSagaStateRepository(abc.ABC):
     def on_step_failure(self, saga_id: int, failed_step: BaseStep, initial_failure_payload: dict) -> object:
         pass
 
+    def update_step_status(self, saga_id: int,
+                           step_index: typing.Optional[int],
+                           step_name: typing.Optional[str],
+                           phase: SagaPhase,
+                           at: datetime.datetime) -> object:
+        """
+        Records saga status as separate fields: step index, step name and phase
+         (step index and name are None when saga is finished),
+         so they can be indexed and aggregated (see aggregate query methods below).
+        Repositories are expected to keep a history of such transitions too.
+
+        By default, falls back to update_status with
+         free-form '{step_name}.{phase}' status
+        """
+        status = f'{step_name}.{phase.value}' if step_name else phase.value
+        return self.update_status(saga_id, status)
+
+    def save_compensation_checkpoint(self, saga_id: int, step_index: int) -> object:
+        """
+        Saves index of the last compensated step.
+        Implement it together with get_compensation_checkpoint
+         to make compensation resumable (see BaseSaga.resume_compensation)
+        """
+
+    def get_compensation_checkpoint(self, saga_id: int) -> typing.Optional[int]:
+        return None
+
+    def get_step_failure(self, saga_id: int) -> typing.Optional[typing.Tuple[str, dict]]:
+        """
+        Returns name of initially failed step and failure payload
+         saved by on_step_failure.
+        Implement it to continue compensation after remote compensation response
+         with correct failure details (see AsyncStep.remote_compensation)
+        """
+        return None
+
+    def load_saga_context(self, saga_id: int,
+                          keys: typing.Optional[typing.List[str]] = None) -> dict:
+        """
+        Returns {key: value} of saga context for existing keys among given ones
+         (or all saga context if keys is None).
+        Implement it together with save_saga_context to use StatefulSaga.context
+        """
+        raise NotImplementedError
+
+    def save_saga_context(self, saga_id: int, changed: dict, deleted_keys: typing.Set[str]) -> object:
+        """
+        Saves changed saga context values and deletes deleted keys
+        """
+        raise NotImplementedError
+
+    def count_by_step_and_phase(self) -> typing.Dict[typing.Tuple[typing.Optional[str], SagaPhase], int]:
+        """
+        Returns number of sagas per (step name, phase)
+        """
+        raise NotImplementedError
+
+    def oldest_by_step(self, phase: SagaPhase = SagaPhase.RUNNING) -> typing.Dict[str, datetime.datetime]:
+        """
+        Returns time when the oldest saga that is still in a given phase
+         entered it, per step name
+        """
+        raise NotImplementedError
+
+    def age_percentiles(self, step_name: str, phase: SagaPhase = SagaPhase.RUNNING,
+                        percentiles: typing.Iterable[float] = (50, 90, 99),
+                        now: datetime.datetime = None) -> typing.Dict[float, datetime.timedelta]:
+        """
+        Returns percentiles of time that sagas are in a given step and phase
+        """
+        raise NotImplementedError
+
+    def iter_transition_chunks(self, chunk_size: int = 100000) \
+            -> typing.Iterator[typing.List[tuple]]:
+        """
+        Yields transition history in chunks of (saga_id, saga_class, step_name, phase, at) rows
+         (at is POSIX timestamp), ordered by saga_id and then by time (see analytics.py)
+        """
+        raise NotImplementedError
+
+    def find_finished_saga_ids(self, finished_before: datetime.datetime,
+                               limit: int = 1000) -> typing.List[int]:
+        """
+        Returns ids of sagas that succeeded or failed before given time.
+        Implement it together with export_sagas and delete_sagas
+         to archive finished sagas (see archive.py)
+        """
+        raise NotImplementedError
+
+    def export_sagas(self, saga_ids: typing.List[int]) -> typing.List[dict]:
+        """
+        Returns JSON-serializable records of given sagas:
+         {'saga_id': ..., 'state': {...}, 'transitions': [...], 'context': {...}}
+        """
+        raise NotImplementedError
+
+    def delete_sagas(self, saga_ids: typing.List[int]) -> object:
+        """
+        Deletes given sagas with their transitions and context
+        """
+        raise NotImplementedError
+
+    def transaction(self) -> typing.ContextManager:
+        """
+        Context manager for DB transaction in which everything done
+         while handling one saga message is committed together
+         (saga state updates and outbox messages, see outbox.py).
+        Should support nesting (inner transactions are just parts of outer one).
+        By default, does nothing, i.e. every repository call commits on its own
+        """
+        return contextlib.nullcontext()
+
 
 class StatefulSaga(AsyncSaga, abc.ABC):
     """
     Note this class assumes sqlalchemy-mixins library is used.
     Use it rather as an example
     """
-    saga_state_repository: AbstractSagaStateRepository = None
-    _saga_state = None  # cached SQLAlchemy instance
+    __slots__ = ('saga_state_repository', '_saga_state', '_context')
+
+    saga_state_repository: AbstractSagaStateRepository
 
-    def __init__(self, saga_state_repository: AbstractSagaStateRepository, celery_app: Celery, saga_id: int):
+    def __init__(self, saga_state_repository: AbstractSagaStateRepository, celery_app: 'Celery', saga_id: int):
         self.saga_state_repository = saga_state_repository
+        self._saga_state = None  # cached SQLAlchemy instance
+        self._context = None  # type: typing.Optional[SagaContext]
         super().__init__(celery_app, saga_id)
 
+    def handle_message(self, handler: typing.Callable, *args):
+        # take saga lock before transaction is started,
+        #  so transaction sees changes made while handling previous message
+        with self.saga_locks.lock_for(self.saga_id), \
+                self.saga_state_repository.transaction():
+            result = super().handle_message(handler, *args)
+            # persist context changes in one write
+            if self._context is not None:
+                with self.profile_phase('repository'):
+                    self._context.flush()
+            return result
+
+    def execute(self, starting_step: BaseStep = None):
+        # starting a saga is handled like a message: under saga lock and in one
+        #  transaction, so outbox commands are committed with saga state.
+        #  When called from message handler, it joins outer lock and transaction
+        return self.handle_message(super().execute, starting_step)
+
     @property
     def saga_state(self):
         if not self._saga_state:
-            self._saga_state = self.saga_state_repository.get_saga_state_by_id(self.saga_id)
+            with self.profile_phase('repository'):
+                self._saga_state = self.saga_state_repository.get_saga_state_by_id(self.saga_id)
 
         return self._saga_state
 
+    @property
+    def context(self) -> SagaContext:
+        """
+        Saga data shared between steps (see context.py).
+        Changes are persisted at the end of handle_message (execute runs within it too)
+        """
+        if self._context is None:
+            self._context = SagaContext(
+                load=lambda keys: self.saga_state_repository.load_saga_context(self.saga_id, keys),
+                save=lambda changed, deleted_keys: self.saga_state_repository.save_saga_context(
+                    self.saga_id, changed, deleted_keys)
+            )
+
+        return self._context
+
+    def update_step_status(self, step: typing.Optional[BaseStep], phase: SagaPhase):
+        with self.profile_phase('repository'):
+            self.saga_state_repository.update_step_status(
+                self.saga_id,
+                step_index=self._get_step_index(step) if step else None,
+                step_name=step.name if step else None,
+                phase=phase,
+                at=datetime.datetime.utcnow()
+            )
+
     def run_step(self, step: BaseStep):
-        self.saga_state_repository.update_status(self.saga_id, status=f'{step.name}.running')
+        self.update_step_status(step, SagaPhase.RUNNING)
         super().run_step(step)
 
     def compensate_step(self, step: BaseStep, initial_failure_payload: dict):
-        self.saga_state_repository.update_status(self.saga_id, status=f'{step.name}.compensating')
+        self.update_step_status(step, SagaPhase.COMPENSATING)
         super().compensate_step(step, initial_failure_payload)
-        self.saga_state_repository.update_status(self.saga_id, status=f'{step.name}.compensated')
 
+    def on_step_compensated(self, step: BaseStep):
+        self.update_step_status(step, SagaPhase.COMPENSATED)
+        super().on_step_compensated(step)
+
+    def on_async_step_success(self, step: AsyncStep, payload: dict):
+        # saga is already finished when retriable steps complete,
+        #  so don't overwrite its status
+        if step.kind != StepKind.RETRIABLE:
+            self.update_step_status(step, SagaPhase.SUCCEEDED)
+        super().on_async_step_success(step, payload)
+
+    def on_fused_step_success(self, step: AsyncStep, payload: dict):
+        self.update_step_status(step, SagaPhase.SUCCEEDED)
+        super().on_fused_step_success(step, payload)
+
+    def on_async_step_failure(self, step: AsyncStep, payload: dict):
+        if step.kind != StepKind.RETRIABLE:
+            self.update_step_status(step, SagaPhase.FAILED)
+        super().on_async_step_failure(step, payload)
+
+    # kept for backward compatibility
     def on_step_success(self, step: AsyncStep, *args, **kwargs):
-        self.saga_state_repository.update_status(self.saga_id, status=f'{step.name}.succeeded')
-        super().on_async_step_success(step, *args, **kwargs)
+        self.on_async_step_success(step, *args, **kwargs)
 
+    # kept for backward compatibility
     def on_step_failure(self, failed_step: AsyncStep, payload: dict):
-        self.saga_state_repository.update_status(self.saga_id, status=f'{failed_step.name}.failed')
-        super().on_async_step_failure(failed_step, payload)
+        self.on_async_step_failure(failed_step, payload)
 
     def on_saga_success(self):
         super().on_saga_success()
-        self.saga_state_repository.update_status(self.saga_id, 'succeeded')
+        self.update_step_status(None, SagaPhase.SUCCEEDED)
 
     def on_saga_failure(self, *args, **kwargs):
         super().on_saga_failure(*args, **kwargs)
-        self.saga_state_repository.update_status(self.saga_id, 'failed')
+        self.update_step_status(None, SagaPhase.FAILED)
 
     def compensate(self, failed_step: BaseStep,
                    initial_failure_payload: dict = None):
-        self.saga_state_repository.on_step_failure(self.saga_id, failed_step, initial_failure_payload)
+        recorded_failed_step, recorded_failure_payload = self.get_initial_failure()
+        if recorded_failed_step is not None and recorded_failed_step.name == failed_step.name:
+            # compensation is resumed (see resume_compensation), failure is already recorded
+            if initial_failure_payload is None:
+                initial_failure_payload = recorded_failure_payload
+        else:
+            with self.profile_phase('repository'):
+                self.saga_state_repository.on_step_failure(self.saga_id, failed_step,
+                                                           initial_failure_payload)
         super().compensate(failed_step, initial_failure_payload)
 
+    def get_compensation_checkpoint(self) -> typing.Optional[int]:
+        with self.profile_phase('repository'):
+            return self.saga_state_repository.get_compensation_checkpoint(self.saga_id)
+
+    def save_compensation_checkpoint(self, compensated_step: BaseStep):
+        with self.profile_phase('repository'):
+            self.saga_state_repository.save_compensation_checkpoint(
+                self.saga_id, self._get_step_index(compensated_step))
+
+    def get_initial_failure(self) -> typing.Tuple[typing.Optional[BaseStep],
+                                                   typing.Optional[dict]]:
+        with self.profile_phase('repository'):
+            step_failure = self.saga_state_repository.get_step_failure(self.saga_id)
+        if step_failure is None:
+            return None, None
+
+        step_name, initial_failure_payload = step_failure
+        return self.get_step_by_name(step_name), initial_failure_payload
+
+    def on_compensation_failure(self, *args, compensation_failed_step: BaseStep, **kwargs):
+        super().on_compensation_failure(*args, compensation_failed_step=compensation_failed_step,
+                                        **kwargs)
+        self.update_step_status(compensation_failed_step, SagaPhase.COMPENSATION_FAILED)
+
     @classmethod
     def register_async_step_handlers(cls,
                                      saga_state_repository: AbstractSagaStateRepository,
-                                     celery_app: Celery):
+                                     celery_app: 'Celery',
+                                     shards: typing.Iterable = None):
+        if shards is not None or cls.priority_lanes:
+            cls.add_consumed_response_queues(celery_app, shards)
+
         # noinspection PyTypeChecker
         dummy_saga_instance = cls(None, None, None)
+        dummy_saga_instance.validate_steps()
+        cls.declare_command_lane_queues(
+            celery_app, [step.queue for step in dummy_saga_instance.async_steps])
 
         for step in dummy_saga_instance.async_steps:
             cls.register_success_handler_for_step(saga_state_repository,
@@ -89,32 +328,110 @@ class StatefulSaga(AsyncSaga, abc.ABC):
             cls.register_failure_handler_for_step(saga_state_repository,
                                                   celery_app, step)
 
+            if len(dummy_saga_instance.get_fused_steps(step)) > 1:
+                cls.register_fused_response_handler_for_step(saga_state_repository,
+                                                             celery_app, step)
+
+            if step.remote_compensation:
+                cls.register_compensation_response_handlers_for_step(saga_state_repository,
+                                                                     celery_app, step)
+
+        if any(step.compensation_retry_policy for step in dummy_saga_instance.steps):
+            cls.register_compensation_retry_handler(saga_state_repository, celery_app)
+
+        if cls.response_queue is not None:
+            cls.register_batch_response_handler(saga_state_repository, celery_app)
+
     @classmethod
     def register_success_handler_for_step(cls,
                                           saga_state_repository: AbstractSagaStateRepository,
-                                          celery_app: Celery, step: AsyncStep):
-        def on_success_handler(celery_task: Task, saga_id: int, payload: dict):
-            saga = cls(saga_state_repository=saga_state_repository,
-                       celery_app=celery_app, saga_id=saga_id)
+                                          celery_app: 'Celery', step: AsyncStep):
+        def on_success_handler(celery_task: 'Task', saga_id: int, payload: dict):
+            with cls.profile_phase('construction'):
+                saga = cls(saga_state_repository=saga_state_repository,
+                           celery_app=celery_app, saga_id=saga_id)
 
-            step_ = saga.get_async_step_by_success_task_name(celery_task.name)
-            saga.on_async_step_success(step_, payload)
+            with cls.profile_phase('step_lookup'):
+                step_ = saga.get_async_step_by_success_task_name(celery_task.name)
+            saga.handle_message(saga.on_async_step_success, step_, payload)
 
         celery_app.task(
             name=success_task_name(step.base_task_name),
             bind=True
-        )(on_success_handler)
+        )(cls.wrap_response_handler(on_success_handler, step.name))
 
     @classmethod
-    def register_failure_handler_for_step(cls, saga_state_repository: AbstractSagaStateRepository, celery_app: Celery, step: AsyncStep):
+    def register_failure_handler_for_step(cls, saga_state_repository: AbstractSagaStateRepository, celery_app: 'Celery', step: AsyncStep):
 
-        def on_failure_handler(celery_task: Task, saga_id: int, payload: dict):
-            saga = cls(saga_state_repository, celery_app, saga_id)
+        def on_failure_handler(celery_task: 'Task', saga_id: int, payload: dict):
+            with cls.profile_phase('construction'):
+                saga = cls(saga_state_repository, celery_app, saga_id)
 
-            step_ = saga.get_async_step_by_failure_task_name(celery_task.name)
-            saga.on_async_step_failure(step_, payload)
+            with cls.profile_phase('step_lookup'):
+                step_ = saga.get_async_step_by_failure_task_name(celery_task.name)
+            saga.handle_message(saga.on_async_step_failure, step_, payload)
 
         celery_app.task(
             name=failure_task_name(step.base_task_name),
             bind=True
-        )(on_failure_handler)
+        )(cls.wrap_response_handler(on_failure_handler, step.name))
+
+    @classmethod
+    def register_fused_response_handler_for_step(cls,
+                                                 saga_state_repository: AbstractSagaStateRepository,
+                                                 celery_app: 'Celery', step: AsyncStep):
+        def on_fused_response_handler(celery_task: 'Task', saga_id: int, outcomes: list):
+            with cls.profile_phase('construction'):
+                saga = cls(saga_state_repository, celery_app, saga_id)
+            saga.handle_message(saga.on_fused_steps_response, outcomes)
+
+        celery_app.task(
+            name=fused_response_task_name(step.base_task_name),
+            bind=True
+        )(cls.wrap_response_handler(on_fused_response_handler, step.name))
+
+    @classmethod
+    def register_compensation_response_handlers_for_step(
+            cls, saga_state_repository: AbstractSagaStateRepository,
+            celery_app: 'Celery', step: AsyncStep):
+        def on_compensation_response_handler(celery_task: 'Task', saga_id: int, payload: dict):
+            with cls.profile_phase('construction'):
+                saga = cls(saga_state_repository, celery_app, saga_id)
+            saga.handle_message(saga.on_async_compensation_response, celery_task.name, payload)
+
+        for response_task_name in _compensation_response_task_names(step):
+            celery_app.task(
+                name=response_task_name,
+                bind=True
+            )(cls.wrap_response_handler(on_compensation_response_handler, step.name))
+
+    @classmethod
+    def register_compensation_retry_handler(cls,
+                                            saga_state_repository: AbstractSagaStateRepository,
+                                            celery_app: 'Celery'):
+        def on_compensation_retry_handler(celery_task: 'Task', saga_id: int, payload: dict):
+            with cls.profile_phase('construction'):
+                saga = cls(saga_state_repository, celery_app, saga_id)
+            saga.handle_message(saga.on_compensation_retry, payload)
+
+        celery_app.task(
+            name=cls.get_compensation_retry_task_name(),
+            bind=True
+        )(cls.wrap_response_handler(on_compensation_retry_handler))
+
+    @classmethod
+    def register_batch_response_handler(cls,
+                                        saga_state_repository: AbstractSagaStateRepository,
+                                        celery_app: 'Celery', response_queue: str = None):
+        def on_batch_response_handler(celery_task: 'Task', responses: list):
+            _handle_batch_response(
+                responses,
+                lambda saga_id: cls(saga_state_repository, celery_app, saga_id),
+                functools.partial(_capture_batch_response, cls, celery_task)
+            )
+
+        for queue in cls.batch_response_queues(response_queue):
+            celery_app.task(
+                name=batch_response_task_name(queue),
+                bind=True
+            )(cls.wrap_response_handler(on_batch_response_handler, capture_dead_letters=False))
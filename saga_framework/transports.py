@@ -0,0 +1,318 @@
+"""
+This module contains transports: they deliver messages (commands and responses)
+ to consumers registered for task names.
+
+Sagas and saga step handlers use a small part of Celery app interface:
+ send_task(name, args, kwargs, queue, **options) publishes a message
+ and task(name, bind) registers its consumer.
+AbstractTransport declares this interface, so any transport can be passed
+ where celery_app is expected (AsyncSaga, StatefulSaga, batchers, outbox relay etc.):
+ * CeleryTransport wraps Celery app
+ * ThreadedTransport delivers messages within process to a pool of threads
+ * AsyncioTransport delivers messages within process through asyncio queue,
+   consumers may be coroutine functions
+
+In-process transports run Orchestrator and Saga Handler services in one process,
+ e.g. for tests and benchmarks:
+
+    transport = ThreadedTransport(workers=8)
+    CreateOrderSaga.register_async_step_handlers(transport)
+    transport.task(name=create_ticket_message.TASK_NAME, bind=True)(create_ticket_task)
+
+    with transport:
+        CreateOrderSaga(transport, saga_id).execute()
+        transport.join()
+
+They keep messages in memory and don't retry:
+ if consumer raises, error is logged and message is dropped.
+Messages with higher priority option are delivered first.
+"""
+
+__all__ = ['SentMessage', 'AbstractTransport', 'CeleryTransport',
+           'ThreadedTransport', 'AsyncioTransport']
+
+import abc
+import asyncio
+import concurrent.futures
+import inspect
+import itertools
+import logging
+import queue as queue_module
+import threading
+import typing
+import uuid
+
+if typing.TYPE_CHECKING:
+    from celery import Celery
+
+logger = logging.getLogger(__name__)
+
+
+class SentMessage(typing.NamedTuple):
+    id: str
+
+
+class AbstractTransport(abc.ABC):
+    @abc.abstractmethod
+    def send_task(self, name: str, args: list = None, kwargs: dict = None,
+                  queue: str = None, **options) -> SentMessage:
+        """
+        Publishes message for consumer of task name to queue.
+        Options are transport-specific (like priority), unsupported ones are ignored.
+        Returned object has id of sent message
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def task(self, name: str, bind: bool = False, **options) -> typing.Callable:
+        """
+        Returns decorator that registers consumer of task name.
+        Bound consumer receives task as first argument;
+         task has name, app (this transport) and request (with id,
+         delivery_info and headers) attributes like Celery task does
+        """
+        raise NotImplementedError
+
+    def add_consumed_queues(self, queues: typing.Iterable[str], queue_arguments: dict = None):
+        """
+        Adds queues to ones consumed by this process,
+         queue_arguments are broker-specific (like x-max-priority).
+        In-process transports consume all queues
+        """
+
+
+class CeleryTransport(AbstractTransport):
+    """
+    Other attributes (like conf or control) are taken from Celery app
+    """
+    def __init__(self, celery_app: 'Celery'):
+        self.celery_app = celery_app
+
+    def send_task(self, name: str, args: list = None, kwargs: dict = None,
+                  queue: str = None, **options) -> SentMessage:
+        return self.celery_app.send_task(name, args=args, kwargs=kwargs, queue=queue, **options)
+
+    def task(self, name: str, bind: bool = False, **options) -> typing.Callable:
+        return self.celery_app.task(name=name, bind=bind, **options)
+
+    def add_consumed_queues(self, queues: typing.Iterable[str], queue_arguments: dict = None):
+        for queue in queues:
+            self.celery_app.amqp.queues.select_add(queue, queue_arguments=queue_arguments)
+
+    def __getattr__(self, name: str):
+        if name == 'celery_app':
+            raise AttributeError(name)
+        return getattr(self.celery_app, name)
+
+
+class _Message(typing.NamedTuple):
+    id: str
+    name: str
+    args: list
+    kwargs: dict
+    queue: typing.Optional[str]
+    priority: int
+    headers: dict
+
+
+class _Request:
+    __slots__ = ('id', 'retries', 'delivery_info', 'headers')
+
+    def __init__(self, message: _Message):
+        self.id = message.id
+        self.retries = 0
+        self.delivery_info = {'routing_key': message.queue, 'priority': message.priority}
+        self.headers = message.headers
+
+
+class _BoundTask:
+    __slots__ = ('name', 'app', 'request')
+
+    def __init__(self, name: str, app: AbstractTransport, request: _Request):
+        self.name = name
+        self.app = app
+        self.request = request
+
+
+class _InProcessTransport(AbstractTransport):
+    def __init__(self):
+        self._consumers = {}  # type: typing.Dict[str, typing.Tuple[typing.Callable, bool]]
+        # orders messages of the same priority
+        self._sequence = itertools.count()
+
+    def task(self, name: str, bind: bool = False, **options) -> typing.Callable:
+        def decorator(func: typing.Callable) -> typing.Callable:
+            self._consumers[name] = (func, bind)
+            return func
+
+        return decorator
+
+    def send_task(self, name: str, args: list = None, kwargs: dict = None,
+                  queue: str = None, **options) -> SentMessage:
+        message = _Message(id=str(uuid.uuid4()), name=name, args=list(args or ()),
+                           kwargs=dict(kwargs or {}), queue=queue,
+                           priority=options.get('priority') or 0,
+                           headers=dict(options.get('headers') or {}))
+        # higher priority goes first
+        self._put((-message.priority, next(self._sequence), message))
+        return SentMessage(message.id)
+
+    @abc.abstractmethod
+    def _put(self, item: tuple):
+        raise NotImplementedError
+
+    def _call_consumer(self, message: _Message):
+        consumer = self._consumers.get(message.name)
+        if consumer is None:
+            raise KeyError(f'no consumer registered for task {message.name}')
+
+        func, bind = consumer
+        if bind:
+            return func(_BoundTask(message.name, self, _Request(message)),
+                        *message.args, **message.kwargs)
+        return func(*message.args, **message.kwargs)
+
+    @staticmethod
+    def _on_consumer_failure(message: _Message, exc: BaseException):
+        logger.error('Task %s[%s] raised', message.name, message.id, exc_info=exc)
+
+
+class ThreadedTransport(_InProcessTransport):
+    """
+    Messages are consumed by a pool of worker threads
+    """
+    def __init__(self, workers: int = 4):
+        super().__init__()
+        self.workers = workers
+        self._queue = queue_module.PriorityQueue()
+        self._threads = []  # type: typing.List[threading.Thread]
+
+    def _put(self, item: tuple):
+        self._queue.put(item)
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f'transport-worker-{i}',
+                                      daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def join(self):
+        """
+        Waits until all sent messages (including ones sent by consumers) are consumed
+        """
+        self._queue.join()
+
+    def stop(self):
+        """
+        Stops workers after messages sent so far are consumed
+        """
+        for _ in self._threads:
+            # after all messages
+            self._queue.put((float('inf'), next(self._sequence), None))
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _work(self):
+        while True:
+            _, _, message = self._queue.get()
+            try:
+                if message is None:
+                    return
+                self._call_consumer(message)
+            except Exception as exc:
+                self._on_consumer_failure(message, exc)
+            finally:
+                self._queue.task_done()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class AsyncioTransport(_InProcessTransport):
+    """
+    Messages are consumed by concurrency consumer coroutines in event loop.
+    Coroutine function consumers are awaited, regular ones are called in event loop
+     or, if executor is given, in executor (so they don't block event loop).
+    Messages can be sent from any thread
+    """
+    def __init__(self, concurrency: int = 100,
+                 executor: concurrent.futures.Executor = None):
+        super().__init__()
+        self.concurrency = concurrency
+        self.executor = executor
+        self._loop = None  # type: typing.Optional[asyncio.AbstractEventLoop]
+        self._queue = None  # type: typing.Optional[asyncio.PriorityQueue]
+        self._consumer_tasks = []  # type: typing.List[asyncio.Task]
+        # messages sent before start
+        self._pending = []  # type: typing.List[tuple]
+
+    def _put(self, item: tuple):
+        if self._loop is None:
+            self._pending.append(item)
+        elif self._in_loop_thread():
+            self._queue.put_nowait(item)
+        else:
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, item)
+
+    def _in_loop_thread(self) -> bool:
+        try:
+            return asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            return False
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.PriorityQueue()
+        for item in self._pending:
+            self._queue.put_nowait(item)
+        self._pending = []
+        self._consumer_tasks = [self._loop.create_task(self._consume())
+                                for _ in range(self.concurrency)]
+
+    async def join(self):
+        """
+        Waits until all sent messages (including ones sent by consumers) are consumed
+        """
+        await self._queue.join()
+
+    async def stop(self):
+        """
+        Stops consumers after messages sent so far are consumed
+        """
+        await self.join()
+        for task in self._consumer_tasks:
+            task.cancel()
+        await asyncio.gather(*self._consumer_tasks, return_exceptions=True)
+        self._consumer_tasks = []
+        self._loop = None
+
+    async def _consume(self):
+        while True:
+            _, _, message = await self._queue.get()
+            try:
+                consumer = self._consumers.get(message.name)
+                if self.executor is not None and consumer is not None \
+                        and not inspect.iscoroutinefunction(consumer[0]):
+                    result = await self._loop.run_in_executor(self.executor,
+                                                              self._call_consumer, message)
+                else:
+                    result = self._call_consumer(message)
+                if inspect.isawaitable(result):
+                    await result
+            except Exception as exc:
+                self._on_consumer_failure(message, exc)
+            finally:
+                self._queue.task_done()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
@@ -1,6 +1,10 @@
 __all__ = ['success_task_name', 'failure_task_name', 'SagaErrorPayload',
            'format_exception_as_python_does', 'serialize_saga_error',
-           'NO_ACTION']
+           'NO_ACTION', 'batch_task_name', 'task_name_from_batch_task_name',
+           'batch_response_task_name', 'fused_task_name',
+           'fused_response_task_name', 'shard_queue_name',
+           'priority_lane_queue_name', 'compensation_task_name',
+           'compensation_retry_task_name']
 
 import traceback
 from dataclasses import dataclass
@@ -17,6 +21,46 @@ def failure_task_name(task_name: str):
     return f'{task_name}.response.failure'
 
 
+def compensation_task_name(task_name: str):
+    return f'{task_name}.compensation'
+
+
+def compensation_retry_task_name(saga_class_name: str):
+    return f'{saga_class_name}.compensation.retry'
+
+
+def batch_task_name(task_name: str):
+    return f'{task_name}.batch'
+
+
+def batch_response_task_name(response_queue: str):
+    return f'{response_queue}.responses.batch'
+
+
+def fused_task_name(queue: str):
+    return f'{queue}.fused'
+
+
+def fused_response_task_name(task_name: str):
+    return f'{task_name}.fused.response'
+
+
+def shard_queue_name(queue: str, shard):
+    return f'{queue}.shard.{shard}'
+
+
+def priority_lane_queue_name(queue: str, lane: str):
+    return f'{queue}.{lane}'
+
+
+def task_name_from_batch_task_name(batch_task_name_: str):
+    suffix = batch_task_name('')
+    if not batch_task_name_.endswith(suffix):
+        raise ValueError(f'{batch_task_name_} is not a batch task name')
+
+    return batch_task_name_[:-len(suffix)]
+
+
 @dataclass
 class SagaErrorPayload:
     type: str
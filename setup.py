@@ -1,10 +1,16 @@
 from setuptools import setup
 
 
-def requirements():
-    import os
-    filename = os.path.join(os.path.dirname(__file__), 'requirements.txt')
-    return [line.rstrip('\n') for line in open(filename).readlines()]
+# core (BaseSaga, AsyncSaga, StatefulSaga) has no dependencies,
+#  Celery and AsyncAPI integrations and simulator are optional extras
+EXTRAS_REQUIRE = {
+    'celery': ['celery'],
+    'asyncapi': ['asyncapi'],
+    'simulation': ['numpy'],
+}
+EXTRAS_REQUIRE['all'] = sorted({requirement
+                                for requirements in EXTRAS_REQUIRE.values()
+                                for requirement in requirements})
 
 
 setup(name='saga_framework',
@@ -16,7 +22,8 @@ setup(name='saga_framework',
       author_email='litvinenko1706@gmail.com',
       license='MIT',
       packages=['saga_framework'],
-      install_requires=requirements(),
+      install_requires=[],
+      extras_require=EXTRAS_REQUIRE,
       keywords=['microservices', 'saga'],
       classifiers=[
           'Development Status :: 4 - Beta',
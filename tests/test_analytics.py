@@ -0,0 +1,93 @@
+import datetime
+import sqlite3
+
+import pytest
+
+pytest.importorskip('numpy')
+
+from saga_framework.analytics import SagaAnalytics, analyze_archive, analyze_repository
+from saga_framework.archive import JSONLSagaArchive
+from saga_framework.sqlite_repository import SQLiteSagaStateRepository
+from saga_framework.stateful_saga import SagaPhase
+
+START = datetime.datetime(2021, 1, 10)
+
+
+def add_saga(repository, saga_id: int, create_ticket_time: float, fail: bool = False):
+    def at(seconds):
+        return START + datetime.timedelta(seconds=saga_id * 100 + seconds)
+
+    repository.create_saga_state(saga_id)
+    repository.update_step_status(saga_id, 0, 'create_order', SagaPhase.RUNNING, at(0))
+    repository.update_step_status(saga_id, 1, 'create_ticket', SagaPhase.RUNNING, at(0.1))
+    finished = 0.1 + create_ticket_time
+    if fail:
+        repository.update_step_status(saga_id, 1, 'create_ticket', SagaPhase.FAILED, at(finished))
+        repository.update_step_status(saga_id, 0, 'create_order', SagaPhase.COMPENSATING,
+                                      at(finished))
+        repository.update_step_status(saga_id, 0, 'create_order', SagaPhase.COMPENSATED,
+                                      at(finished + 0.5))
+        repository.update_step_status(saga_id, None, None, SagaPhase.FAILED, at(finished + 0.5))
+    else:
+        repository.update_step_status(saga_id, 1, 'create_ticket', SagaPhase.SUCCEEDED,
+                                      at(finished))
+        repository.update_step_status(saga_id, None, None, SagaPhase.SUCCEEDED, at(finished))
+
+
+@pytest.fixture
+def repository():
+    repository = SQLiteSagaStateRepository(sqlite3.connect(':memory:'),
+                                           saga_class_name='CreateOrderSaga')
+    repository.create_tables()
+    for saga_id in range(1, 100):
+        add_saga(repository, saga_id, create_ticket_time=0.001 * saga_id)
+    add_saga(repository, 100, create_ticket_time=2, fail=True)
+    # saga in progress
+    repository.create_saga_state(101)
+    repository.update_step_status(101, 0, 'create_order', SagaPhase.RUNNING, START)
+    return repository
+
+
+def test_repository_statistics(repository):
+    # chunks are smaller than sagas, so sagas are split between chunks
+    analytics = analyze_repository(repository, chunk_size=3, slowest=2)
+    stats = analytics.report()['CreateOrderSaga']
+
+    assert (stats.sagas, stats.succeeded, stats.failed, stats.compensated) == (101, 99, 1, 1)
+    assert stats.duration.count == 100
+    assert stats.duration.max == pytest.approx(2.6)
+
+    create_ticket = stats.steps['create_ticket']
+    assert (create_ticket.runs, create_ticket.failures) == (100, 1)
+    assert create_ticket.failure_rate == pytest.approx(0.01)
+    assert create_ticket.time_in_step.mean == pytest.approx((0.001 * 99 * 100 / 2 + 2) / 100, abs=1e-5)
+    assert create_ticket.time_in_step.percentiles[50] == pytest.approx(0.050, rel=0.05)
+    assert create_ticket.time_in_step.percentiles[99] == pytest.approx(0.099, rel=0.05)
+
+    create_order = stats.steps['create_order']
+    # step of saga in progress has no duration yet
+    assert (create_order.runs, create_order.time_in_step.count) == (101, 100)
+    assert create_order.compensations == 1
+    assert create_order.compensation_time.max == pytest.approx(0.5)
+
+    slowest = analytics.slowest_sagas()
+    assert [slow_saga.saga_id for slow_saga in slowest] == [100, 99]
+    assert slowest[0].breakdown == pytest.approx({'create_order': 0.1, 'create_ticket': 2,
+                                                  'create_order (compensation)': 0.5})
+    assert 'create_ticket' in analytics.format_report()
+
+
+def test_archive_gives_same_statistics(repository, tmp_path):
+    archive = JSONLSagaArchive(str(tmp_path))
+    archive.add(repository.export_sagas(list(range(1, 50))))
+    archive.add(repository.export_sagas(list(range(50, 102))))
+    # archiver died before deleting the batch, so it's archived again
+    archive.add(repository.export_sagas(list(range(50, 102))))
+
+    from_archive = analyze_archive(archive, chunk_size=10)
+    from_repository = SagaAnalytics()
+    for rows in repository.iter_transition_chunks(1000):
+        from_repository.add_chunk(rows)
+    from_repository.finish()
+
+    assert from_archive.report() == from_repository.report()
@@ -0,0 +1,73 @@
+import datetime
+import sqlite3
+
+import pytest
+
+from saga_framework.archive import JSONLSagaArchive, SagaArchiver
+from saga_framework.sqlite_repository import SQLiteSagaStateRepository
+from saga_framework.stateful_saga import SagaPhase
+
+NOW = datetime.datetime(2021, 1, 10)
+
+
+@pytest.fixture
+def repository():
+    repository = SQLiteSagaStateRepository(sqlite3.connect(':memory:'), saga_class_name='Saga')
+    repository.create_tables()
+    return repository
+
+
+def create_saga(repository, saga_id: int, phase: SagaPhase, finished_at: datetime.datetime,
+                step_name: str = None):
+    repository.create_saga_state(saga_id)
+    repository.update_step_status(saga_id, 0, 'step_1', SagaPhase.RUNNING,
+                                  finished_at - datetime.timedelta(minutes=1))
+    repository.update_step_status(saga_id, 0 if step_name else None, step_name, phase,
+                                  finished_at)
+    repository.save_saga_context(saga_id, {'ticket_id': saga_id * 10}, set())
+
+
+def test_finished_sagas_older_than_retention_are_archived(repository, tmp_path):
+    old = NOW - datetime.timedelta(days=30)
+    create_saga(repository, 1, SagaPhase.SUCCEEDED, old)
+    create_saga(repository, 2, SagaPhase.FAILED, old)
+    create_saga(repository, 3, SagaPhase.SUCCEEDED, NOW - datetime.timedelta(hours=1))
+    # step succeeded, but saga is still running
+    create_saga(repository, 4, SagaPhase.SUCCEEDED, old, step_name='step_1')
+    create_saga(repository, 5, SagaPhase.COMPENSATION_FAILED, old, step_name='step_1')
+
+    archive = JSONLSagaArchive(str(tmp_path))
+    archiver = SagaArchiver(repository, archive, retention=datetime.timedelta(days=7),
+                            batch_size=1)
+
+    assert archiver.run(now=NOW) == 2
+    assert len(list(tmp_path.glob('*.jsonl.gz'))) == 2
+
+    assert repository.get_saga_state_by_id(1) is None
+    assert repository.get_transitions(2) == []
+    assert repository.load_saga_context(2) == {}
+    for saga_id in (3, 4, 5):
+        assert repository.get_saga_state_by_id(saga_id) is not None
+
+    record = archive.get(2)
+    assert record['state']['phase'] == 'failed'
+    assert [transition['phase'] for transition in record['transitions']] == ['running', 'failed']
+    assert record['context'] == {'ticket_id': 20}
+    assert archive.get(3) is None
+
+    assert sorted(record['saga_id'] for record in archive.iter_records()) == [1, 2]
+
+
+def test_archive_returns_latest_copy(tmp_path):
+    archive = JSONLSagaArchive(str(tmp_path))
+    archive.add([{'saga_id': 1, 'state': {'phase': 'failed'}},
+                 {'saga_id': 2, 'state': {}}])
+    archive.add([{'saga_id': 1, 'state': {'phase': 'succeeded'}}])
+
+    assert archive.get(1)['state'] == {'phase': 'succeeded'}
+    assert archive.get(2)['saga_id'] == 2
+    assert sorted((record['saga_id'], record['state'].get('phase'))
+                  for record in archive.iter_records()) == [(1, 'succeeded'), (2, None)]
+
+    # index is persisted
+    assert JSONLSagaArchive(str(tmp_path)).get(1)['state'] == {'phase': 'succeeded'}
@@ -0,0 +1,378 @@
+import subprocess
+import sys
+import threading
+from unittest.mock import MagicMock, call
+
+import pytest
+
+from saga_framework.async_saga import AsyncSaga, AsyncStep
+from saga_framework.batching import CommandBatcher, MessageBatcher, \
+    ResponseBatcher
+from saga_framework.saga_handlers import batch_saga_step_handler, \
+    saga_step_handler
+from saga_framework.utils import serialize_saga_error
+from dataclasses import asdict
+from .common import FakeCeleryApp
+
+
+def test_message_batcher_flushes_when_batch_is_full():
+    flush_callback = MagicMock()
+    batcher = MessageBatcher(flush_callback, max_batch_size=2, max_delay=None)
+
+    batcher.add('key', 1)
+    flush_callback.assert_not_called()
+
+    batcher.add('key', 2)
+    flush_callback.assert_called_once_with('key', [1, 2])
+    assert batcher.pending_count() == 0
+
+
+def test_message_batcher_flushes_after_max_delay():
+    flushed = threading.Event()
+    flush_callback = MagicMock(side_effect=lambda *args: flushed.set())
+    batcher = MessageBatcher(flush_callback, max_batch_size=100, max_delay=0.001)
+
+    batcher.add('key', 1)
+
+    assert flushed.wait(timeout=5)
+    flush_callback.assert_called_once_with('key', [1])
+
+
+def test_closed_message_batcher_flushes_buffered_and_new_items():
+    flush_callback = MagicMock()
+    batcher = MessageBatcher(flush_callback, max_batch_size=100, max_delay=None)
+
+    batcher.add('key', 1)
+    batcher.add('other_key', 2)
+    batcher.close()
+    assert flush_callback.call_args_list == [call('key', [1]), call('other_key', [2])]
+
+    batcher.add('key', 3)
+    flush_callback.assert_called_with('key', [3])
+    assert batcher.pending_count() == 0
+
+
+def test_message_batcher_is_flushed_on_exit():
+    script = (
+        'from saga_framework.batching import MessageBatcher\n'
+        'batcher = MessageBatcher(lambda key, items: print(key, items), max_delay=60)\n'
+        'batcher.add("key", 1)\n'
+    )
+    output = subprocess.check_output([sys.executable, '-c', script], text=True)
+
+    assert output == "key [1]\n"
+
+
+def test_message_batcher_is_flushed_on_celery_worker_shutdown():
+    signals = pytest.importorskip('celery.signals')
+    from saga_framework.celery_utils import close_batchers_on_worker_shutdown
+
+    flush_callback = MagicMock()
+    batcher = MessageBatcher(flush_callback, max_batch_size=100, max_delay=None)
+    batcher.add('key', 1)
+
+    close_batchers_on_worker_shutdown()
+    signals.worker_process_shutdown.send(sender=None, pid=1, exitcode=0)
+
+    flush_callback.assert_called_once_with('key', [1])
+
+
+def test_saga_commands_are_coalesced_into_batch_task():
+    fake_celery_app = FakeCeleryApp()
+    fake_celery_app.send_task.reset_mock()
+
+    class Saga(AsyncSaga):
+        command_batcher = CommandBatcher(fake_celery_app, max_batch_size=100,
+                                         max_delay=None)
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+
+            self.steps = [
+                AsyncStep(
+                    name='step_1',
+                    action=self.send_command,
+
+                    queue='some_queue',
+                    base_task_name='step_1_task',
+                    batched=True
+                ),
+            ]
+
+        def send_command(self, step: AsyncStep):
+            self.send_message_to_other_service(step, {'saga': self.saga_id})
+
+    for saga_id in [1, 2, 3]:
+        Saga(fake_celery_app, saga_id).execute()
+
+    fake_celery_app.send_task.assert_not_called()
+
+    Saga.command_batcher.flush()
+    fake_celery_app.send_task.assert_called_once_with(
+        'step_1_task.batch',
+        args=[[
+            [1, {'saga': 1}],
+            [2, {'saga': 2}],
+            [3, {'saga': 3}],
+        ]],
+        queue='some_queue'
+    )
+
+
+def test_commands_of_different_priority_are_batched_separately():
+    fake_celery_app = FakeCeleryApp()
+    fake_celery_app.send_task.reset_mock()
+    command_batcher = CommandBatcher(fake_celery_app, max_batch_size=100, max_delay=None)
+
+    command_batcher.add_command('step_1_task', 'some_queue', 1, {}, priority=8)
+    command_batcher.add_command('step_1_task', 'some_queue', 2, {})
+    command_batcher.add_command('step_1_task', 'some_queue', 3, {}, priority=8)
+    command_batcher.flush()
+
+    assert fake_celery_app.send_task.call_args_list == [
+        call('step_1_task.batch', args=[[[1, {}], [3, {}]]], queue='some_queue',
+             priority=8, kwargs={'priority': 8}),
+        call('step_1_task.batch', args=[[[2, {}]]], queue='some_queue'),
+    ]
+
+
+def test_batch_saga_step_handler_responds_with_batch_priority():
+    fake_celery_app = FakeCeleryApp()
+    fake_celery_app.send_task.reset_mock()
+
+    @fake_celery_app.task(bind=True, name='step_1.batch')
+    @batch_saga_step_handler(response_queue='some_fake_queue')
+    def some_batch_task(self, commands: list) -> dict:
+        return {1: {}}
+
+    fake_celery_app.emulate_celery_task_launch('step_1.batch', commands=[[1, {}]],
+                                               priority=8)
+
+    fake_celery_app.send_task.assert_called_once_with(
+        'step_1.response.success', args=[1, {}], queue='some_fake_queue', priority=8)
+
+
+# noinspection PyPep8Naming
+def test_batch_saga_step_handler_fans_out_responses():
+    fake_celery_app = FakeCeleryApp()
+    fake_celery_app.send_task.reset_mock()
+    RESPONSE_QUEUE_NAME = 'some_fake_queue'
+    error = ValueError('saga 2 failed')
+
+    @fake_celery_app.task(bind=True, name='step_1.batch')
+    @batch_saga_step_handler(response_queue=RESPONSE_QUEUE_NAME)
+    def some_batch_task(self, commands: list) -> dict:
+        return {1: {'ok': 1}, 2: error}
+
+    fake_celery_app.emulate_celery_task_launch(
+        'step_1.batch',
+        commands=[[1, {}], [2, {}]]
+    )
+
+    assert fake_celery_app.send_task.call_args_list == [
+        call('step_1.response.success', args=[1, {'ok': 1}],
+             queue=RESPONSE_QUEUE_NAME),
+        call('step_1.response.failure',
+             args=[2, asdict(serialize_saga_error(error))],
+             queue=RESPONSE_QUEUE_NAME),
+    ]
+
+
+def test_batch_saga_step_handler_fails_sagas_without_response():
+    fake_celery_app = FakeCeleryApp()
+    fake_celery_app.send_task.reset_mock()
+
+    @fake_celery_app.task(bind=True, name='step_1.batch')
+    @batch_saga_step_handler(response_queue='some_fake_queue')
+    def some_batch_task(self, commands: list) -> dict:
+        return {1: None}
+
+    fake_celery_app.emulate_celery_task_launch(
+        'step_1.batch',
+        commands=[[1, {}], [2, {}]]
+    )
+
+    success_call, failure_call = fake_celery_app.send_task.call_args_list
+    assert success_call == call('step_1.response.success', args=[1, None],
+                                queue='some_fake_queue')
+    assert failure_call.args == ('step_1.response.failure',)
+    assert failure_call.kwargs['args'][0] == 2
+    assert failure_call.kwargs['args'][1]['type'] == 'KeyError'
+
+
+def test_batch_saga_step_handler_fails_whole_batch_if_handler_returns_not_dict():
+    fake_celery_app = FakeCeleryApp()
+    fake_celery_app.send_task.reset_mock()
+
+    @fake_celery_app.task(bind=True, name='step_1.batch')
+    @batch_saga_step_handler(response_queue='some_fake_queue')
+    def some_batch_task(self, commands: list) -> dict:
+        return [{} for _ in commands]
+
+    fake_celery_app.emulate_celery_task_launch(
+        'step_1.batch',
+        commands=[[1, {}], [2, {}]]
+    )
+
+    calls = fake_celery_app.send_task.call_args_list
+    assert [c.args[0] for c in calls] == ['step_1.response.failure'] * 2
+    assert [c.kwargs['args'][0] for c in calls] == [1, 2]
+    assert calls[0].kwargs['args'][1]['type'] == 'TypeError'
+
+
+# noinspection PyPep8Naming
+def test_batch_saga_step_handler_fails_whole_batch():
+    fake_celery_app = FakeCeleryApp()
+    fake_celery_app.send_task.reset_mock()
+    RESPONSE_QUEUE_NAME = 'some_fake_queue'
+
+    @fake_celery_app.task(bind=True, name='step_1.batch')
+    @batch_saga_step_handler(response_queue=RESPONSE_QUEUE_NAME)
+    def some_batch_task(self, commands: list) -> dict:
+        raise EnvironmentError('DB is down')
+
+    fake_celery_app.emulate_celery_task_launch(
+        'step_1.batch',
+        commands=[[1, {}], [2, {}]]
+    )
+
+    sent_task_names = [c.args[0] for c in fake_celery_app.send_task.call_args_list]
+    assert sent_task_names == ['step_1.response.failure'] * 2
+
+
+# noinspection PyPep8Naming
+def test_saga_step_handler_buffers_responses_in_response_batcher():
+    fake_celery_app = FakeCeleryApp()
+    fake_celery_app.send_task.reset_mock()
+    RESPONSE_QUEUE_NAME = 'some_fake_queue'
+    response_batcher = ResponseBatcher(fake_celery_app, max_batch_size=100,
+                                       max_delay=None)
+
+    @fake_celery_app.task(bind=True, name='step_1')
+    @saga_step_handler(response_queue=RESPONSE_QUEUE_NAME,
+                       response_batcher=response_batcher)
+    def some_celery_task(self, saga_id: int, payload: dict) -> dict:
+        return {'saga': saga_id}
+
+    for saga_id in [1, 2]:
+        fake_celery_app.emulate_celery_task_launch('step_1', saga_id=saga_id,
+                                                   payload={})
+
+    fake_celery_app.send_task.assert_not_called()
+
+    response_batcher.flush()
+    fake_celery_app.send_task.assert_called_once_with(
+        'some_fake_queue.responses.batch',
+        args=[[
+            ['step_1.response.success', 1, {'saga': 1}],
+            ['step_1.response.success', 2, {'saga': 2}],
+        ]],
+        queue=RESPONSE_QUEUE_NAME
+    )
+
+
+def test_response_batcher_keeps_priority_and_is_flushed_on_close():
+    fake_celery_app = FakeCeleryApp()
+    fake_celery_app.send_task.reset_mock()
+    response_batcher = ResponseBatcher(fake_celery_app, max_batch_size=100,
+                                       max_delay=None)
+
+    @fake_celery_app.task(bind=True, name='step_1')
+    @saga_step_handler(response_queue='some_fake_queue',
+                       response_batcher=response_batcher)
+    def some_celery_task(self, saga_id: int, payload: dict) -> dict:
+        return {}
+
+    fake_celery_app.emulate_celery_task_launch('step_1', saga_id=1, payload={},
+                                               priority=8)
+    fake_celery_app.emulate_celery_task_launch('step_1', saga_id=2, payload={})
+    response_batcher.close()
+
+    assert fake_celery_app.send_task.call_args_list == [
+        call('some_fake_queue.responses.batch',
+             args=[[['step_1.response.success', 1, {}]]],
+             queue='some_fake_queue', priority=8),
+        call('some_fake_queue.responses.batch',
+             args=[[['step_1.response.success', 2, {}]]],
+             queue='some_fake_queue'),
+    ]
+
+
+def test_saga_handles_batch_response_in_order():
+    step_1_on_success_mock = MagicMock()
+    step_2_on_failure_mock = MagicMock()
+    on_saga_success_mock = MagicMock()
+    on_saga_failure_mock = MagicMock()
+
+    class Saga(AsyncSaga):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+
+            self.steps = [
+                AsyncStep(
+                    name='step_1',
+                    queue='some_queue',
+                    base_task_name='step_1_task',
+                    on_success=step_1_on_success_mock
+                ),
+                AsyncStep(
+                    name='step_2',
+                    queue='some_queue',
+                    base_task_name='step_2_task',
+                    on_failure=step_2_on_failure_mock
+                ),
+            ]
+
+        on_saga_success = on_saga_success_mock
+        on_saga_failure = on_saga_failure_mock
+
+    fake_celery_app = FakeCeleryApp()
+    # noinspection PyTypeChecker
+    Saga.register_batch_response_handler(fake_celery_app, 'response_queue')
+
+    fake_celery_app.emulate_celery_task_launch(
+        'response_queue.responses.batch',
+        responses=[
+            ['step_1_task.response.success', 1, {'ticket_id': 1}],
+            ['step_2_task.response.failure', 1, {'error': 'some'}],
+            ['step_1_task.response.success', 2, {'ticket_id': 2}],
+        ]
+    )
+
+    assert [c.args[1] for c in step_1_on_success_mock.call_args_list] == \
+           [{'ticket_id': 1}, {'ticket_id': 2}]
+    step_2_on_failure_mock.assert_called_once()
+    on_saga_failure_mock.assert_called_once()
+    on_saga_success_mock.assert_not_called()
+
+
+def test_batch_response_skips_saga_after_its_failed_response():
+    class Saga(AsyncSaga):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+
+            self.steps = [
+                AsyncStep(
+                    name='step_1',
+                    queue='some_queue',
+                    base_task_name='step_1_task',
+                ),
+            ]
+
+        on_async_step_success = MagicMock()
+
+    fake_celery_app = FakeCeleryApp()
+    # noinspection PyTypeChecker
+    Saga.register_batch_response_handler(fake_celery_app, 'response_queue')
+
+    with pytest.raises(KeyError):
+        fake_celery_app.emulate_celery_task_launch(
+            'response_queue.responses.batch',
+            responses=[
+                ['unknown_task.response.success', 1, {}],
+                ['step_1_task.response.success', 1, {}],
+                ['step_1_task.response.success', 2, {}],
+            ]
+        )
+
+    assert Saga.on_async_step_success.call_count == 1
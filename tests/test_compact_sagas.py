@@ -0,0 +1,129 @@
+import tracemalloc
+from unittest.mock import MagicMock
+
+import pytest
+
+from saga_framework.async_saga import AsyncSaga, AsyncStep
+from saga_framework.base_saga import BaseSaga, SyncStep
+from .common import FakeCeleryApp
+
+
+def test_steps_are_frozen_and_have_no_dict():
+    step = AsyncStep(name='step_1', queue='some_queue', base_task_name='step_1_task')
+
+    assert not hasattr(step, '__dict__')
+    with pytest.raises(AttributeError):
+        step.queue = 'other_queue'
+
+
+def test_class_level_steps_are_shared_and_callables_are_bound():
+    calls = []
+
+    class Saga(BaseSaga):
+        __slots__ = ()
+
+        def step_1_action(self, step):
+            calls.append((self.saga_id, step.name))
+
+        steps = [
+            SyncStep(name='step_1', action=step_1_action),
+            SyncStep(name='step_2'),
+        ]
+
+        on_saga_success = MagicMock()
+
+    saga_1, saga_2 = Saga(1), Saga(2)
+    saga_1.execute()
+    saga_2.execute()
+
+    assert not hasattr(saga_1, '__dict__')
+    assert saga_1.steps is saga_2.steps
+    assert calls == [(1, 'step_1'), (2, 'step_1')]
+    assert Saga.on_saga_success.call_count == 2
+
+
+def log_step(step):
+    log_step.calls.append(step.name)
+
+
+def test_only_functions_from_class_body_are_bound():
+    log_step.calls = []
+
+    class BaseOrderSaga(BaseSaga):
+        __slots__ = ()
+
+        def reserve(self, step):
+            log_step.calls.append((self.saga_id, step.name))
+
+    class Saga(BaseOrderSaga):
+        __slots__ = ()
+
+        steps = [
+            SyncStep(name='reserve', action=BaseOrderSaga.reserve),
+            SyncStep(name='notify', action=log_step),
+        ]
+
+    Saga(1).execute()
+
+    assert log_step.calls == [(1, 'reserve'), 'notify']
+
+
+def test_class_level_async_steps_handle_responses():
+    on_success_calls = []
+
+    class Saga(AsyncSaga):
+        __slots__ = ()
+
+        def step_1_on_success(self, step, payload):
+            on_success_calls.append((self.saga_id, step.name, payload))
+
+        steps = [
+            AsyncStep(name='step_1', queue='some_queue',
+                      base_task_name='step_1_task',
+                      on_success=step_1_on_success),
+        ]
+
+        on_saga_success = MagicMock()
+
+    fake_celery_app = FakeCeleryApp()
+    # noinspection PyTypeChecker
+    Saga.register_async_step_handlers(fake_celery_app)
+
+    fake_celery_app.emulate_celery_task_launch('step_1_task.response.success',
+                                               saga_id=123, payload={'a': 1})
+
+    assert on_success_calls == [(123, 'step_1', {'a': 1})]
+    Saga.on_saga_success.assert_called_once()
+
+
+def test_compact_saga_takes_less_memory():
+    action = MagicMock()
+
+    class LegacySaga(AsyncSaga):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+
+            self.steps = [
+                SyncStep(name='step_1', action=action),
+                AsyncStep(name='step_2', queue='some_queue',
+                          base_task_name='step_2_task'),
+            ]
+
+    class CompactSaga(AsyncSaga):
+        __slots__ = ()
+
+        steps = [
+            SyncStep(name='step_1', action=action),
+            AsyncStep(name='step_2', queue='some_queue',
+                      base_task_name='step_2_task'),
+        ]
+
+    def allocated_bytes(saga_class):
+        tracemalloc.start()
+        sagas = [saga_class(None, saga_id) for saga_id in range(1000)]
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        assert len(sagas) == 1000
+        return size
+
+    assert allocated_bytes(CompactSaga) * 2 < allocated_bytes(LegacySaga)
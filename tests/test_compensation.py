@@ -0,0 +1,156 @@
+import sqlite3
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from saga_framework.async_saga import AsyncSaga
+from saga_framework.base_saga import BaseSaga, SyncStep, RetryPolicy
+from saga_framework.sqlite_repository import SQLiteSagaStateRepository
+from saga_framework.stateful_saga import StatefulSaga, SagaPhase
+from saga_framework.utils import compensation_retry_task_name
+from .common import FakeCeleryApp
+
+
+def make_steps(compensation_mocks, **step_kwargs):
+    def fail(step):
+        raise RuntimeError('step failed')
+
+    return [SyncStep(name=f'step_{i}', compensation=compensation_mock, **step_kwargs)
+            for i, compensation_mock in enumerate(compensation_mocks)] + \
+           [SyncStep(name='failing_step', action=fail)]
+
+
+def test_compensation_failure_reports_step_which_compensation_failed():
+    compensation_mocks = [MagicMock(), MagicMock(side_effect=KeyError), MagicMock()]
+    on_compensation_failure_mock = MagicMock()
+
+    class Saga(BaseSaga):
+        on_compensation_failure = on_compensation_failure_mock
+
+    saga = Saga(123)
+    saga.steps = make_steps(compensation_mocks)
+    saga.execute()
+
+    kwargs = on_compensation_failure_mock.call_args.kwargs
+    assert kwargs['initially_failed_step'].name == 'failing_step'
+    assert kwargs['compensation_failed_step'].name == 'step_1'
+    compensation_mocks[0].assert_not_called()
+    compensation_mocks[2].assert_called_once()
+
+
+def test_compensation_is_retried_with_policy():
+    compensation_mock = MagicMock(side_effect=[ConnectionError, ConnectionError, None])
+    retry_policy = RetryPolicy(max_attempts=3, delay=1, backoff=2, max_delay=1.5)
+
+    on_saga_failure_mock = MagicMock()
+
+    class Saga(BaseSaga):
+        on_saga_failure = on_saga_failure_mock
+
+    saga = Saga(123)
+    saga.steps = make_steps([compensation_mock], compensation_retry_policy=retry_policy)
+
+    with patch('saga_framework.base_saga.time.sleep') as sleep_mock:
+        saga.execute()
+
+    assert compensation_mock.call_count == 3
+    assert [call.args[0] for call in sleep_mock.call_args_list] == [1, 1.5]
+    on_saga_failure_mock.assert_called_once()
+
+
+def test_async_saga_schedules_compensation_retry_instead_of_sleeping():
+    compensation_mocks = [MagicMock(), MagicMock(side_effect=[ConnectionError, None])]
+    on_saga_failure_mock = MagicMock()
+
+    class Saga(AsyncSaga):
+        __slots__ = ()
+        response_queue = 'saga_responses'
+        steps = make_steps(compensation_mocks,
+                           compensation_retry_policy=RetryPolicy(delay=5))
+        on_saga_failure = on_saga_failure_mock
+
+    fake_celery_app = FakeCeleryApp()
+    fake_celery_app.send_task.reset_mock()
+    Saga.register_async_step_handlers(fake_celery_app)
+
+    with patch('saga_framework.base_saga.time.sleep') as sleep_mock:
+        Saga(fake_celery_app, 123).execute()
+
+    sleep_mock.assert_not_called()
+    task_name = compensation_retry_task_name(f'{__name__}.{Saga.__qualname__}')
+    fake_celery_app.send_task.assert_called_once_with(
+        task_name,
+        args=[123, {
+            'step': 'step_1',
+            'retry_number': 1,
+            'failed_step': 'failing_step',
+            'initial_failure_payload': fake_celery_app.send_task.call_args.kwargs['args'][1][
+                'initial_failure_payload'],
+        }],
+        queue='saga_responses',
+        countdown=5
+    )
+    compensation_mocks[0].assert_not_called()
+    on_saga_failure_mock.assert_not_called()
+
+    fake_celery_app.emulate_celery_task_launch(
+        task_name, *fake_celery_app.send_task.call_args.kwargs['args'])
+
+    assert [mock.call_count for mock in compensation_mocks] == [1, 2]
+    failed_step, initial_failure_payload = on_saga_failure_mock.call_args.args
+    assert failed_step.name == 'failing_step'
+    assert initial_failure_payload['type'] == 'RuntimeError'
+
+
+def test_compensation_retry_policy_requires_response_queue():
+    class Saga(AsyncSaga):
+        __slots__ = ()
+        steps = make_steps([MagicMock()], compensation_retry_policy=RetryPolicy())
+
+    with pytest.raises(ValueError):
+        Saga.register_async_step_handlers(FakeCeleryApp())
+
+
+def test_compensation_is_not_retried_on_other_errors():
+    compensation_mock = MagicMock(side_effect=KeyError)
+
+    on_compensation_failure_mock = MagicMock()
+
+    class Saga(BaseSaga):
+        on_compensation_failure = on_compensation_failure_mock
+
+    saga = Saga(123)
+    saga.steps = make_steps([compensation_mock],
+                            compensation_retry_policy=RetryPolicy(retry_on=(ConnectionError,)))
+    saga.execute()
+
+    compensation_mock.assert_called_once()
+    on_compensation_failure_mock.assert_called_once()
+
+
+def test_compensation_is_resumed_from_checkpoint():
+    compensation_mocks = [MagicMock(), MagicMock(side_effect=[KeyError, None]), MagicMock()]
+
+    class Saga(StatefulSaga):
+        __slots__ = ()
+        steps = make_steps(compensation_mocks)
+
+    repository = SQLiteSagaStateRepository(sqlite3.connect(':memory:'))
+    repository.create_tables()
+    saga_id = repository.create_saga_state()
+
+    saga = Saga(repository, FakeCeleryApp(), saga_id)
+    saga.handle_message(saga.execute)
+
+    state = repository.get_saga_state_by_id(saga_id)
+    assert (state['step_name'], state['phase']) == ('step_1', SagaPhase.COMPENSATION_FAILED)
+    assert state['compensation_checkpoint'] == 2
+
+    # e.g. after the issue was fixed by hand
+    saga = Saga(repository, FakeCeleryApp(), saga_id)
+    saga.handle_message(saga.resume_compensation, saga.get_step_by_name(state['failed_step']))
+
+    assert [mock.call_count for mock in compensation_mocks] == [1, 2, 1]
+    assert repository.get_saga_state_by_id(saga_id)['status'] == 'failed'
+    # failure recorded when saga failed is kept
+    assert repository.get_step_failure(saga_id)[1]['type'] == 'RuntimeError'
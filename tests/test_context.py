@@ -0,0 +1,141 @@
+import sqlite3
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from saga_framework.async_saga import AsyncStep
+from saga_framework.base_saga import SyncStep
+from saga_framework.context import SagaContext
+from saga_framework.sqlite_repository import SQLiteSagaStateRepository
+from saga_framework.stateful_saga import StatefulSaga
+from saga_framework.utils import success_task_name, failure_task_name
+from .common import FakeCeleryApp
+
+
+def make_context(stored: dict):
+    load = MagicMock(side_effect=lambda keys: {key: value for key, value in stored.items()
+                                               if keys is None or key in keys})
+    save = MagicMock()
+    return SagaContext(load, save), load, save
+
+
+def test_values_are_loaded_lazily_key_by_key():
+    context, load, save = make_context({'a': 1, 'b': 2})
+
+    assert context['a'] == 1
+    assert context['a'] == 1
+    assert 'c' not in context
+    assert 'c' not in context
+    assert [call.args[0] for call in load.call_args_list] == [['a'], ['c']]
+
+    assert dict(context) == {'a': 1, 'b': 2}
+    assert load.call_args.args[0] is None
+
+    context.flush()
+    save.assert_not_called()
+
+
+def test_only_changes_are_saved():
+    context, load, save = make_context({'a': 1, 'b': 2, 'c': [3]})
+
+    context['a'] = 10
+    context['d'] = 4
+    del context['b']
+    context['c'].append(4)
+    context.mark_changed('c')
+    with pytest.raises(KeyError):
+        del context['e']
+
+    assert dict(context) == {'a': 10, 'c': [3, 4], 'd': 4}
+    context.flush()
+    save.assert_called_once_with({'a': 10, 'c': [3, 4], 'd': 4}, {'b'})
+
+    context.flush()
+    save.assert_called_once()
+
+
+class Saga(StatefulSaga):
+    __slots__ = ()
+
+    def create_ticket(self, step: AsyncStep):
+        self.send_message_to_other_service(step, {'order_id': self.context['order_id']})
+
+    def on_ticket_created(self, step: AsyncStep, payload: dict):
+        self.context['ticket_id'] = payload['ticket_id']
+
+    def reject_ticket(self, step: AsyncStep):
+        self.send_message_to_other_service(step, {'ticket_id': self.context['ticket_id']},
+                                           task_name='reject_ticket')
+
+    def authorize_card(self, step: AsyncStep):
+        self.send_message_to_other_service(step, {})
+
+    steps = [
+        AsyncStep(
+            name='create_ticket',
+            action=create_ticket,
+            compensation=reject_ticket,
+            on_success=on_ticket_created,
+
+            queue='restaurant_service',
+            base_task_name='create_ticket',
+        ),
+        AsyncStep(
+            name='authorize_card',
+            action=authorize_card,
+
+            queue='accounting_service',
+            base_task_name='authorize_card',
+        ),
+        SyncStep(name='approve_order'),
+    ]
+
+
+def test_steps_share_data_via_context():
+    repository = SQLiteSagaStateRepository(sqlite3.connect(':memory:'))
+    repository.create_tables()
+    saga_id = repository.create_saga_state()
+    repository.save_saga_context(saga_id, {'order_id': 7}, set())
+
+    fake_celery_app = FakeCeleryApp()
+    fake_celery_app.send_task.reset_mock()
+    Saga.register_async_step_handlers(repository, fake_celery_app)
+
+    saga = Saga(repository, fake_celery_app, saga_id)
+    saga.handle_message(saga.execute)
+    assert fake_celery_app.send_task.call_args.kwargs['args'] == [saga_id, {'order_id': 7}]
+
+    with patch.object(repository, 'save_saga_context',
+                      wraps=repository.save_saga_context) as save_mock:
+        fake_celery_app.emulate_celery_task_launch(success_task_name('create_ticket'),
+                                                   saga_id, {'ticket_id': 'ticket-1'})
+        fake_celery_app.emulate_celery_task_launch(failure_task_name('authorize_card'),
+                                                   saga_id, {})
+
+    # one write per handled message, and only if context changed
+    save_mock.assert_called_once_with(saga_id, {'ticket_id': 'ticket-1'}, set())
+    assert fake_celery_app.send_task.call_args.args == ('reject_ticket',)
+    assert fake_celery_app.send_task.call_args.kwargs['args'] == [saga_id, {'ticket_id': 'ticket-1'}]
+    assert repository.load_saga_context(saga_id) == {'order_id': 7, 'ticket_id': 'ticket-1'}
+
+
+class StartingSaga(Saga):
+    __slots__ = ()
+
+    def reserve_order(self, step: SyncStep):
+        self.context['reserved'] = True
+
+    steps = [SyncStep(name='reserve_order', action=reserve_order)] + Saga.steps
+
+
+def test_context_changed_while_starting_saga_is_saved():
+    connection = sqlite3.connect(':memory:')
+    repository = SQLiteSagaStateRepository(connection)
+    repository.create_tables()
+    saga_id = repository.create_saga_state()
+    repository.save_saga_context(saga_id, {'order_id': 7}, set())
+
+    StartingSaga(repository, FakeCeleryApp(), saga_id).execute()
+
+    assert SQLiteSagaStateRepository(connection).load_saga_context(saga_id) == \
+           {'order_id': 7, 'reserved': True}
@@ -0,0 +1,137 @@
+import datetime
+import sqlite3
+import types
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from saga_framework.async_saga import AsyncSaga, AsyncStep
+from saga_framework.dead_letters import SQLiteDeadLetterStore, DeadLetterReplayer, \
+    DeadLetter
+from saga_framework.utils import success_task_name, batch_response_task_name
+from .common import FakeCeleryApp
+
+
+@pytest.fixture
+def store():
+    store = SQLiteDeadLetterStore(sqlite3.connect(':memory:'))
+    store.create_table()
+    return store
+
+
+def make_saga_class(store: SQLiteDeadLetterStore):
+    class Saga(AsyncSaga):
+        dead_letter_store = store
+
+        def on_success(self, step: AsyncStep, payload: dict):
+            if payload.get('fail'):
+                raise ConnectionError('repository is down')
+
+        steps = [
+            AsyncStep(
+                name='create_ticket',
+                queue='some_queue',
+                base_task_name='create_ticket',
+                on_success=on_success,
+            ),
+        ]
+
+    return Saga
+
+
+def test_failed_responses_are_captured(store):
+    Saga = make_saga_class(store)
+    fake_celery_app = FakeCeleryApp()
+    Saga.register_async_step_handlers(fake_celery_app)
+
+    task_name = success_task_name('create_ticket')
+    fake_celery_app._tasks_handlers[task_name].request = types.SimpleNamespace(
+        id='message-1', retries=0, headers={'trace_id': 'abc'},
+        delivery_info={'routing_key': 'create_order_saga_responses'})
+
+    fake_celery_app.emulate_celery_task_launch(task_name, 123, {'fail': False})
+    for _ in range(2):  # redelivered message is captured once
+        with pytest.raises(ConnectionError):
+            fake_celery_app.emulate_celery_task_launch(task_name, 123, {'fail': True})
+
+    dead_letter, = store.find()
+    assert (dead_letter.saga_class, dead_letter.step_name, dead_letter.task_name) == \
+           (Saga.__qualname__, 'create_ticket', task_name)
+    assert (dead_letter.saga_id, dead_letter.args) == (123, [123, {'fail': True}])
+    assert dead_letter.queue == 'create_order_saga_responses'
+    assert dead_letter.headers == {'trace_id': 'abc'}
+    assert dead_letter.error['type'] == 'ConnectionError'
+
+
+def test_failed_responses_of_batch_are_captured_one_by_one(store):
+    Saga = make_saga_class(store)
+    fake_celery_app = FakeCeleryApp()
+    Saga.register_batch_response_handler(fake_celery_app, 'responses')
+
+    task_name = success_task_name('create_ticket')
+    with pytest.raises(ConnectionError):
+        fake_celery_app.emulate_celery_task_launch(batch_response_task_name('responses'), [
+            [task_name, 1, {'fail': False}],
+            [task_name, 2, {'fail': True}],
+            [task_name, 2, {'fail': False}],  # skipped after previous failure
+        ])
+
+    assert [(d.saga_id, d.step_name, d.args) for d in store.find()] == [
+        (2, 'create_ticket', [2, {'fail': True}]),
+        (2, None, [2, {'fail': False}]),
+    ]
+
+
+def add_dead_letters(store: SQLiteDeadLetterStore):
+    failed_at = datetime.datetime(2020, 1, 1)
+    for i in range(5):
+        store.add(DeadLetter(saga_class='Saga', step_name='create_ticket',
+                             task_name='create_ticket.response.success',
+                             saga_id=i, args=[i, {}], queue='responses',
+                             failed_at=failed_at + datetime.timedelta(minutes=i)))
+    # duplicate of the first one
+    store.add(DeadLetter(saga_class='Saga', step_name='create_ticket',
+                         task_name='create_ticket.response.success',
+                         saga_id=0, args=[0, {}], queue='responses',
+                         failed_at=failed_at + datetime.timedelta(minutes=5)))
+    store.add(DeadLetter(saga_class='Saga', step_name='authorize_card',
+                         task_name='authorize_card.response.success',
+                         saga_id=10, args=[10, {}], queue='responses',
+                         failed_at=failed_at))
+
+
+def test_replay_in_batches_with_filters_and_deduplication(store):
+    add_dead_letters(store)
+    celery_app = MagicMock()
+    replayer = DeadLetterReplayer(store, celery_app, batch_size=2)
+
+    sent = replayer.replay(saga_class='Saga', step_name='create_ticket',
+                           since=datetime.datetime(2020, 1, 1, 0, 0))
+
+    assert sent == 5
+    assert [call.kwargs['args'][0] for call in celery_app.send_task.call_args_list] == \
+           [0, 1, 2, 3, 4]
+    assert celery_app.send_task.call_args.kwargs['queue'] == 'responses'
+    assert celery_app.producer_or_acquire.call_count == 3
+
+    # replayed dead letters aren't replayed again
+    assert [d.step_name for d in store.find()] == ['authorize_card']
+
+
+def test_replay_with_time_window_and_rate_limit(store):
+    add_dead_letters(store)
+    celery_app = MagicMock()
+    replayer = DeadLetterReplayer(store, celery_app, rate_limit=1)
+
+    with patch('saga_framework.dead_letters.time.sleep') as sleep_mock:
+        sent = replayer.replay(step_name='create_ticket',
+                               since=datetime.datetime(2020, 1, 1, 0, 1),
+                               until=datetime.datetime(2020, 1, 1, 0, 3),
+                               queue='other_queue')
+
+    assert sent == 2
+    assert [call.kwargs['queue'] for call in celery_app.send_task.call_args_list] == \
+           ['other_queue'] * 2
+    # second message waits for about a second
+    assert sleep_mock.call_count == 1
+    assert 0.9 < sleep_mock.call_args.args[0] <= 1
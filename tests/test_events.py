@@ -0,0 +1,111 @@
+import logging
+import threading
+from unittest.mock import MagicMock, patch
+
+from saga_framework.base_saga import BaseSaga, SyncStep
+from saga_framework.events import SagaEvent, SagaEventType, emit_saga_event, \
+    start_queue_logging
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+        self.threads = []
+
+    def emit(self, record):
+        self.format(record)
+        self.records.append(record)
+        self.threads.append(threading.current_thread())
+
+
+def make_logger(name: str, level: int):
+    event_logger = logging.getLogger(name)
+    event_logger.setLevel(level)
+    event_logger.propagate = False
+    handler = RecordingHandler()
+    event_logger.handlers = [handler]
+    return event_logger, handler
+
+
+def test_disabled_event_does_no_work():
+    event_logger, handler = make_logger('tests.events.disabled', logging.WARNING)
+
+    with patch('saga_framework.events.SagaEvent') as event_mock:
+        emit_saga_event(event_logger, logging.INFO, SagaEventType.STEP_STARTED, 123, 'step')
+
+    event_mock.assert_not_called()
+    assert handler.records == []
+
+
+def test_saga_events_are_structured():
+    event_logger, handler = make_logger('tests.events.saga', logging.INFO)
+
+    class Saga(BaseSaga):
+        def fail(self, step):
+            raise RuntimeError('step failed')
+
+        steps = [SyncStep(name='step_1', compensation=MagicMock()),
+                 SyncStep(name='failing_step', action=fail)]
+
+    Saga.event_logger = event_logger
+    Saga(123).execute()
+
+    events = [record.saga_event for record in handler.records]
+    assert [(event.type, event.step_name) for event in events] == [
+        (SagaEventType.STEP_STARTED, 'step_1'),
+        (SagaEventType.STEP_STARTED, 'failing_step'),
+        (SagaEventType.STEP_COMPENSATING, 'step_1'),
+        (SagaEventType.SAGA_FAILED, 'failing_step'),
+    ]
+    assert all(event.saga_id == 123 for event in events)
+    assert events[-1].details['failure_details']['type'] == 'RuntimeError'
+    assert handler.records[0].getMessage() == 'Saga 123: running "step_1" step'
+
+
+def test_compensation_failure_traceback_is_formatted_by_handler():
+    event_logger, handler = make_logger('tests.events.compensation', logging.INFO)
+
+    class Saga(BaseSaga):
+        def fail(self, step):
+            raise RuntimeError('step failed')
+
+        steps = [SyncStep(name='step_1', compensation=MagicMock(side_effect=KeyError('key'))),
+                 SyncStep(name='failing_step', action=fail)]
+
+    Saga.event_logger = event_logger
+    Saga(123).execute()
+
+    record = handler.records[-1]
+    assert record.saga_event.type == SagaEventType.COMPENSATION_FAILED
+    assert record.saga_event.step_name == 'step_1'
+    assert isinstance(record.exc_info[1], KeyError)
+    assert 'KeyError' in logging.Formatter().format(record)
+
+
+def test_queue_logging_formats_and_writes_in_listener_thread():
+    logger_name = 'tests.events.queue'
+    event_logger = logging.getLogger(logger_name)
+    event_logger.setLevel(logging.INFO)
+    handler = RecordingHandler()
+    formatting_threads = []
+
+    def event_str(event):
+        formatting_threads.append(threading.current_thread())
+        return 'event'
+
+    listener = start_queue_logging(handler, logger_name=logger_name)
+    try:
+        with patch.object(SagaEvent, '__str__', event_str):
+            emit_saga_event(event_logger, logging.INFO, SagaEventType.SAGA_SUCCEEDED, 123)
+            listener.stop()
+    finally:
+        event_logger.handlers = []
+
+    # message isn't formatted on the hot path
+    assert formatting_threads
+    assert threading.current_thread() not in formatting_threads
+
+    assert len(handler.records) == 1
+    assert handler.records[0].saga_event.type == SagaEventType.SAGA_SUCCEEDED
+    assert handler.threads[0] is not threading.current_thread()
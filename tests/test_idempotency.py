@@ -0,0 +1,85 @@
+import sqlite3
+from dataclasses import dataclass
+from unittest.mock import MagicMock
+
+import pytest
+
+from saga_framework.idempotency import InMemoryIdempotencyStore, SQLiteIdempotencyStore, \
+    StoredResponse
+from saga_framework.saga_handlers import saga_step_handler
+from .common import FakeCeleryApp
+
+
+@dataclass
+class TicketCreated:
+    ticket_id: int
+
+
+def make_sqlite_store():
+    store = SQLiteIdempotencyStore(sqlite3.connect(':memory:', check_same_thread=False))
+    store.create_table()
+    return store
+
+
+@pytest.mark.parametrize('store_factory', [InMemoryIdempotencyStore, make_sqlite_store])
+def test_repeated_command_is_not_handled_again(store_factory):
+    fake_celery_app = FakeCeleryApp()
+    fake_celery_app.send_task.reset_mock()
+    handler_mock = MagicMock(side_effect=[{'ticket_id': 1}, {'ticket_id': 2}])
+
+    @fake_celery_app.task(bind=True, name='create_ticket')
+    @saga_step_handler(response_queue='response_queue', idempotency_store=store_factory())
+    def create_ticket(self, saga_id: int, payload: dict) -> dict:
+        return handler_mock(saga_id, payload)
+
+    for saga_id in (123, 123, 456):
+        fake_celery_app.emulate_celery_task_launch('create_ticket', saga_id=saga_id, payload={})
+
+    assert handler_mock.call_count == 2
+    assert [call.kwargs['args'] for call in fake_celery_app.send_task.call_args_list] == [
+        [123, {'ticket_id': 1}],
+        [123, {'ticket_id': 1}],
+        [456, {'ticket_id': 2}],
+    ]
+
+
+def test_failure_response_is_stored_too():
+    fake_celery_app = FakeCeleryApp()
+    fake_celery_app.send_task.reset_mock()
+    handler_mock = MagicMock(side_effect=[ValueError('no such consumer'), {}])
+
+    @fake_celery_app.task(bind=True, name='verify_consumer')
+    @saga_step_handler(response_queue='response_queue',
+                       idempotency_store=InMemoryIdempotencyStore())
+    def verify_consumer(self, saga_id: int, payload: dict) -> dict:
+        return handler_mock()
+
+    for _ in range(2):
+        fake_celery_app.emulate_celery_task_launch('verify_consumer', saga_id=123, payload={})
+
+    handler_mock.assert_called_once()
+    task_names = [call.args[0] for call in fake_celery_app.send_task.call_args_list]
+    assert task_names == ['verify_consumer.response.failure'] * 2
+
+
+def test_in_memory_store_evicts_least_recently_used():
+    store = InMemoryIdempotencyStore(max_size=2)
+    for saga_id in (1, 2):
+        store.save('task', saga_id, StoredResponse('task.response.success', saga_id))
+
+    store.get('task', 1)
+    store.save('task', 3, StoredResponse('task.response.success', 3))
+
+    assert store.get('task', 1) is not None
+    assert store.get('task', 2) is None
+    assert store.get('task', 3) is not None
+
+
+def test_sqlite_store_serializes_dataclass_payloads():
+    store = make_sqlite_store()
+    store.save('create_ticket', 123, StoredResponse('create_ticket.response.success',
+                                                    TicketCreated(ticket_id=7)))
+
+    assert store.get('create_ticket', 123) == \
+        StoredResponse('create_ticket.response.success', {'ticket_id': 7})
+    assert store.get('create_ticket', 456) is None
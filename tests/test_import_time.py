@@ -0,0 +1,79 @@
+import importlib
+import os
+import subprocess
+import sys
+
+import saga_framework
+
+# generous budget for `import saga_framework` in a fresh interpreter
+#  (without interpreter startup). Celery import alone takes longer than that
+IMPORT_TIME_BUDGET_SECONDS = 0.1
+
+
+def run_python(code: str, *options: str, env: dict = None) -> str:
+    return subprocess.run([sys.executable, *options, '-c', code], check=True,
+                          capture_output=True, text=True, env=env).stdout.strip()
+
+
+def test_import_doesnt_load_optional_backends():
+    output = run_python(
+        'import sys, saga_framework; '
+        'print(sorted({"celery", "asyncapi", "numpy"} & set(sys.modules)))'
+    )
+
+    assert output == '[]'
+
+
+def test_star_import_doesnt_load_optional_backends():
+    # except for Celery: star import always exported some of celery_utils names
+    output = run_python(
+        'import sys; '
+        'from saga_framework import *; '
+        'print(auto_retry_then_reraise.__name__, '
+        'close_sqlalchemy_db_connection_after_celery_task_ends.__name__, '
+        'sorted({"asyncapi", "numpy"} & set(sys.modules)))'
+    )
+
+    assert output == 'auto_retry_then_reraise ' \
+                     'close_sqlalchemy_db_connection_after_celery_task_ends []'
+
+
+def test_lazy_names_match_modules():
+    for module_name, names in saga_framework._LAZY_MODULES.items():
+        module = importlib.import_module(f'saga_framework.{module_name}')
+        assert names == module.__all__
+
+
+def test_optional_backends_are_loaded_on_access():
+    output = run_python(
+        'import sys; '
+        'from saga_framework import auto_retry_then_reraise; '
+        'print("celery" in sys.modules)'
+    )
+
+    assert output == 'True'
+
+
+def test_import_time_is_within_budget(tmp_path):
+    # measure import of installed package, i.e. with compiled bytecode
+    #  (kept out of source tree). Test runners may set PYTHONDONTWRITEBYTECODE,
+    #  then every run would compile all modules from source, which takes
+    #  several times longer than import itself and isn't what users pay for
+    env = {key: value for key, value in os.environ.items()
+           if key != 'PYTHONDONTWRITEBYTECODE'}
+    options = ['-X', f'pycache_prefix={tmp_path}']
+    run_python('import saga_framework', *options, env=env)
+
+    # take best of few runs to make benchmark less noisy
+    import_times = [
+        float(run_python(
+            'import time; '
+            'started_at = time.perf_counter(); '
+            'import saga_framework; '
+            'print(time.perf_counter() - started_at)',
+            *options, env=env
+        ))
+        for _ in range(3)
+    ]
+
+    assert min(import_times) < IMPORT_TIME_BUDGET_SECONDS
@@ -0,0 +1,99 @@
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from saga_framework.async_saga import AsyncSaga, AsyncStep
+from saga_framework.base_saga import StepKind
+from saga_framework.locking import StripedLock
+from saga_framework.sqlite_repository import SQLiteSagaStateRepository
+from saga_framework.stateful_saga import StatefulSaga, SagaPhase
+from saga_framework.utils import success_task_name
+from .common import FakeCeleryApp
+
+SAGAS_COUNT = 50
+RESPONSES_PER_SAGA = 20
+
+
+def test_striped_lock_maps_key_to_the_same_lock():
+    locks = StripedLock(stripes=8)
+
+    assert locks.lock_for(123) is locks.lock_for(123)
+    assert len({id(locks.lock_for(saga_id)) for saga_id in range(100)}) == 8
+
+
+def test_responses_of_one_saga_are_handled_one_by_one():
+    counters = {}
+
+    class Saga(AsyncSaga):
+        __slots__ = ()
+        saga_locks = StripedLock(stripes=16)
+
+        def on_success(self, step: AsyncStep, payload: dict):
+            # read-modify-write with a thread switch in between
+            value = counters.get(self.saga_id, 0)
+            time.sleep(0)
+            counters[self.saga_id] = value + 1
+
+        steps = [
+            AsyncStep(
+                name='notify',
+                queue='some_queue',
+                base_task_name='notify',
+                on_success=on_success,
+                kind=StepKind.RETRIABLE,
+            ),
+        ]
+
+    fake_celery_app = FakeCeleryApp()
+    Saga.register_async_step_handlers(fake_celery_app)
+
+    with ThreadPoolExecutor(max_workers=64) as executor:
+        futures = [executor.submit(fake_celery_app.emulate_celery_task_launch,
+                                   success_task_name('notify'), saga_id, {})
+                   for _ in range(RESPONSES_PER_SAGA)
+                   for saga_id in range(SAGAS_COUNT)]
+        for future in futures:
+            future.result()
+
+    assert counters == {saga_id: RESPONSES_PER_SAGA for saga_id in range(SAGAS_COUNT)}
+
+
+def test_stateful_sagas_under_thread_pool():
+    class Saga(StatefulSaga):
+        __slots__ = ()
+
+        def send_command(self, step: AsyncStep):
+            self.send_message_to_other_service(step, {})
+
+        steps = [
+            AsyncStep(name='step_0', action=send_command,
+                      queue='some_queue', base_task_name='step_0_task'),
+            AsyncStep(name='step_1', action=send_command,
+                      queue='some_queue', base_task_name='step_1_task'),
+            AsyncStep(name='step_2', action=send_command,
+                      queue='some_queue', base_task_name='step_2_task'),
+        ]
+
+    repository = SQLiteSagaStateRepository(sqlite3.connect(':memory:', check_same_thread=False))
+    repository.create_tables()
+    saga_ids = [repository.create_saga_state() for _ in range(SAGAS_COUNT)]
+
+    fake_celery_app = FakeCeleryApp()
+    Saga.register_async_step_handlers(repository, fake_celery_app)
+
+    def run_saga(saga_id: int):
+        saga = Saga(repository, fake_celery_app, saga_id)
+        saga.handle_message(saga.execute)
+
+    def respond(saga_id: int, step_index: int):
+        fake_celery_app.emulate_celery_task_launch(
+            success_task_name(f'step_{step_index}_task'), saga_id, {})
+
+    with ThreadPoolExecutor(max_workers=64) as executor:
+        list(executor.map(run_saga, saga_ids))
+        for step_index in range(3):
+            list(executor.map(respond, saga_ids, [step_index] * len(saga_ids)))
+
+    assert repository.count_by_step_and_phase() == {(None, SagaPhase.SUCCEEDED): SAGAS_COUNT}
+    for saga_id in saga_ids:
+        assert len(repository.get_transitions(saga_id)) == 7
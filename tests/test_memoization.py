@@ -0,0 +1,130 @@
+from unittest.mock import MagicMock
+
+import pytest
+
+from saga_framework.async_saga import AsyncSaga, AsyncStep
+from saga_framework.base_saga import SyncStep
+from saga_framework.memoization import MemoizationPolicy, ResponseCache
+from .common import FakeCeleryApp
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_saga_class(response_cache: ResponseCache):
+    mocks = MagicMock()
+
+    class Saga(AsyncSaga):
+        response_queue = 'saga_responses'
+
+        def verify_consumer_details(self, step):
+            self.send_message_to_other_service(step, {'consumer_id': 42})
+
+        steps = [
+            AsyncStep(
+                name='verify_consumer_details',
+                action=verify_consumer_details,
+                base_task_name='verify_consumer_details',
+                queue='consumer_service',
+                on_success=mocks.on_success,
+                memoize=MemoizationPolicy(ttl=60),
+            ),
+            SyncStep(name='approve_order', action=mocks.approve_order),
+        ]
+
+        on_saga_success = mocks.on_saga_success
+
+    Saga.response_cache = response_cache
+    return Saga, mocks
+
+
+def test_cached_response_skips_command():
+    clock = FakeClock()
+    Saga, mocks = make_saga_class(ResponseCache(clock=clock))
+    fake_celery_app = FakeCeleryApp()
+    fake_celery_app.send_task.reset_mock()
+    # noinspection PyTypeChecker
+    Saga.register_async_step_handlers(fake_celery_app)
+
+    Saga(fake_celery_app, 1).execute()
+    fake_celery_app.emulate_celery_task_launch('verify_consumer_details.response.success',
+                                               saga_id=1, payload={'valid': True})
+    assert fake_celery_app.send_task.call_count == 1
+    mocks.on_saga_success.assert_called_once()
+
+    # the same payload: no command, cached response is sent to saga instead
+    Saga(fake_celery_app, 2).execute()
+    fake_celery_app.send_task.assert_called_with(
+        'verify_consumer_details.response.success',
+        args=[2, {'valid': True}],
+        queue='saga_responses'
+    )
+    # and is handled like the real one, not while step action runs
+    assert mocks.on_success.call_count == 1
+    fake_celery_app.emulate_celery_task_launch(
+        'verify_consumer_details.response.success',
+        *fake_celery_app.send_task.call_args.kwargs['args'])
+    assert mocks.on_saga_success.call_count == 2
+    assert mocks.on_success.call_args.args[-1] == {'valid': True}
+    assert mocks.approve_order.call_count == 2
+
+    # response expired
+    clock.now = 61
+    Saga(fake_celery_app, 3).execute()
+    assert fake_celery_app.send_task.call_args.args[0] == 'verify_consumer_details'
+
+    assert Saga.response_cache.stats()['hits'] == 1
+    assert Saga.response_cache.stats()['misses'] == 2
+    assert Saga.response_cache.stats()['expirations'] == 1
+
+
+def test_failure_response_is_not_cached():
+    Saga, mocks = make_saga_class(ResponseCache())
+    fake_celery_app = FakeCeleryApp()
+    fake_celery_app.send_task.reset_mock()
+    # noinspection PyTypeChecker
+    Saga.register_async_step_handlers(fake_celery_app)
+
+    Saga(fake_celery_app, 1).execute()
+    fake_celery_app.emulate_celery_task_launch('verify_consumer_details.response.failure',
+                                               saga_id=1, payload={})
+    Saga(fake_celery_app, 2).execute()
+
+    assert fake_celery_app.send_task.call_count == 2
+    assert Saga.response_cache.stats()['pending'] == 1
+
+
+def test_response_cache_evicts_least_recently_used():
+    cache = ResponseCache(max_size=2)
+    cache.put('a', 1, ttl=60)
+    cache.put('b', 2, ttl=60)
+    cache.get('a')
+    cache.put('c', 3, ttl=60)
+
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.stats()['evictions'] == 1
+
+
+def test_cached_payload_is_copied():
+    cache = ResponseCache()
+    payload = {'items': [1]}
+    cache.put('a', payload, ttl=60)
+    payload['items'].append(2)
+    cache.get('a')['items'].append(3)
+
+    assert cache.get('a') == {'items': [1]}
+
+
+def test_memoized_steps_require_response_queue():
+    Saga, _ = make_saga_class(ResponseCache())
+    Saga.response_queue = None
+
+    with pytest.raises(ValueError):
+        # noinspection PyTypeChecker
+        Saga.register_async_step_handlers(FakeCeleryApp())
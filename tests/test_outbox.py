@@ -0,0 +1,218 @@
+import contextlib
+import sqlite3
+from unittest.mock import MagicMock
+
+import pytest
+
+from saga_framework.async_saga import AsyncStep
+from saga_framework.base_saga import SyncStep
+from saga_framework.outbox import SQLiteOutbox, OutboxRelay
+from saga_framework.saga_handlers import saga_step_handler
+from saga_framework.stateful_saga import StatefulSaga, \
+    AbstractSagaStateRepository
+from saga_framework.transports import ThreadedTransport
+from .common import FakeCeleryApp
+
+
+class SQLiteRepository(AbstractSagaStateRepository):
+    def __init__(self, connection: sqlite3.Connection):
+        self.connection = connection
+        self._transaction_depth = 0
+
+    @contextlib.contextmanager
+    def transaction(self):
+        self._transaction_depth += 1
+        try:
+            yield
+        except BaseException:
+            self._transaction_depth -= 1
+            if not self._transaction_depth:
+                self.connection.rollback()
+            raise
+        else:
+            self._transaction_depth -= 1
+            if not self._transaction_depth:
+                self.connection.commit()
+
+    def get_saga_state_by_id(self, saga_id: int) -> object:
+        return self.connection.execute('SELECT id, status FROM saga_state WHERE id = ?',
+                                       (saga_id,)).fetchone()
+
+    def update_status(self, saga_id: int, status: str) -> object:
+        with self.transaction():
+            self.connection.execute('UPDATE saga_state SET status = ? WHERE id = ?',
+                                    (status, saga_id))
+
+    def update(self, saga_id: int, **fields_to_update: str) -> object:
+        raise NotImplementedError
+
+    def on_step_failure(self, saga_id: int, failed_step, initial_failure_payload: dict) -> object:
+        pass
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    db_path = str(tmp_path / 'saga.db')
+
+    connection = sqlite3.connect(db_path)
+    connection.execute('CREATE TABLE saga_state (id INTEGER PRIMARY KEY, status TEXT)')
+    connection.execute("INSERT INTO saga_state VALUES (123, 'not_started')")
+    connection.commit()
+    SQLiteOutbox(connection).create_table()
+    connection.close()
+
+    return db_path
+
+
+def make_saga_class(outbox: SQLiteOutbox):
+    class Saga(StatefulSaga):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+
+            self.steps = [
+                SyncStep(name='step_1'),
+                AsyncStep(
+                    name='step_2',
+                    action=self.send_command,
+
+                    queue='some_queue',
+                    base_task_name='step_2_task',
+                ),
+            ]
+
+        def send_command(self, step: AsyncStep):
+            self.send_message_to_other_service(step, {'a': 1})
+
+    Saga.outbox = outbox
+    return Saga
+
+
+def get_status(db_path: str) -> str:
+    return sqlite3.connect(db_path).execute(
+        'SELECT status FROM saga_state WHERE id = 123').fetchone()[0]
+
+
+def test_commands_are_committed_with_saga_state_and_relayed(db_path):
+    connection = sqlite3.connect(db_path)
+    Saga = make_saga_class(SQLiteOutbox(connection))
+    fake_celery_app = FakeCeleryApp()
+    fake_celery_app.send_task.reset_mock()
+
+    saga = Saga(SQLiteRepository(connection), fake_celery_app, 123)
+    saga.handle_message(saga.execute)
+
+    # command isn't sent directly, it's only written to outbox
+    fake_celery_app.send_task.assert_not_called()
+    assert get_status(db_path) == 'step_2.running'
+
+    # relay works in another process (with its own DB connection)
+    relay = OutboxRelay(SQLiteOutbox(sqlite3.connect(db_path)), fake_celery_app)
+    assert relay.relay_batch() == 1
+
+    fake_celery_app.send_task.assert_called_once_with(
+        'step_2_task',
+        args=[123, {'a': 1}],
+        queue='some_queue',
+        task_id=fake_celery_app.send_task.call_args.kwargs['task_id'],
+        producer=None
+    )
+    assert relay.relay_batch() == 0
+
+
+def test_direct_execute_commits_saga_state_and_commands(db_path):
+    connection = sqlite3.connect(db_path)
+    Saga = make_saga_class(SQLiteOutbox(connection))
+
+    Saga(SQLiteRepository(connection), FakeCeleryApp(), 123).execute()
+
+    assert not connection.in_transaction
+    # relay and other processes see committed changes
+    assert get_status(db_path) == 'step_2.running'
+    assert [message.task_name for message in
+            SQLiteOutbox(sqlite3.connect(db_path)).get_unpublished(100)] == ['step_2_task']
+
+
+def test_relay_delivers_commands_over_transport_exactly_once_after_commit(db_path):
+    # responses are handled in transport worker thread
+    connection = sqlite3.connect(db_path, check_same_thread=False)
+    Saga = make_saga_class(SQLiteOutbox(connection))
+    Saga.response_queue = 'saga_responses'
+    repository = SQLiteRepository(connection)
+    transport = ThreadedTransport(workers=1)
+    Saga.register_async_step_handlers(repository, transport)
+    delivered = []
+
+    @transport.task(name='step_2_task', bind=True)
+    @saga_step_handler(response_queue='saga_responses')
+    def step_2_task(self, saga_id: int, payload: dict) -> dict:
+        delivered.append((saga_id, payload))
+        return {}
+
+    # relay works in another process (with its own DB connection)
+    relay = OutboxRelay(SQLiteOutbox(sqlite3.connect(db_path)), transport)
+
+    with transport:
+        with repository.transaction():
+            Saga(repository, transport, 123).execute()
+            # command isn't visible to relay until saga state is committed
+            assert relay.relay_all() == 0
+
+        assert relay.relay_all() == 1
+        transport.join()
+        assert relay.relay_all() == 0
+        transport.join()
+
+    assert delivered == [(123, {'a': 1})]
+    assert get_status(db_path) == 'succeeded'
+
+
+def test_crash_rolls_back_saga_state_and_commands(db_path):
+    connection = sqlite3.connect(db_path)
+    Saga = make_saga_class(SQLiteOutbox(connection))
+    repository = SQLiteRepository(connection)
+    saga = Saga(repository, FakeCeleryApp(), 123)
+
+    with pytest.raises(RuntimeError):
+        with repository.transaction():
+            saga.execute()
+            raise RuntimeError('process crashed')
+
+    assert get_status(db_path) == 'not_started'
+    assert SQLiteOutbox(sqlite3.connect(db_path)).get_unpublished(100) == []
+
+
+def test_relay_publishes_in_order_in_batches(db_path):
+    connection = sqlite3.connect(db_path)
+    outbox = SQLiteOutbox(connection)
+    for i in range(5):
+        outbox.add(saga_id=i % 2, task_name=f'task_{i}', queue='q', args=[i % 2, {}],
+                   options={})
+    connection.commit()
+
+    celery_app = MagicMock()
+    relay = OutboxRelay(outbox, celery_app, batch_size=2)
+
+    assert relay.relay_all() == 5
+    assert [c.args[0] for c in celery_app.send_task.call_args_list] == \
+           [f'task_{i}' for i in range(5)]
+    # one broker connection per batch
+    assert celery_app.producer_or_acquire.call_count == 3
+
+
+def test_relay_keeps_unpublished_messages_after_broker_failure(db_path):
+    connection = sqlite3.connect(db_path)
+    outbox = SQLiteOutbox(connection)
+    for i in range(3):
+        outbox.add(saga_id=1, task_name=f'task_{i}', queue='q', args=[1, {}],
+                   options={})
+    connection.commit()
+
+    celery_app = MagicMock()
+    celery_app.send_task.side_effect = [MagicMock(), ConnectionError('broker is down')]
+    relay = OutboxRelay(outbox, celery_app)
+
+    with pytest.raises(ConnectionError):
+        relay.relay_batch()
+
+    assert [message.task_name for message in outbox.get_unpublished(100)] == \
+           ['task_1', 'task_2']
@@ -0,0 +1,178 @@
+import dataclasses
+import enum
+import timeit
+import types
+import typing
+from unittest.mock import MagicMock
+
+import pytest
+
+from saga_framework.async_saga import AsyncSaga, AsyncStep
+from saga_framework.payloads import compile_decoder, PayloadRegistry, \
+    PayloadValidationError
+from saga_framework.saga_handlers import saga_step_handler
+from saga_framework.utils import success_task_name, failure_task_name
+from .common import FakeCeleryApp
+
+
+class Currency(enum.Enum):
+    USD = 'USD'
+    EUR = 'EUR'
+
+
+@dataclasses.dataclass
+class Item:
+    name: str
+    quantity: int
+
+
+@dataclasses.dataclass
+class CreateOrderPayload:
+    order_id: int
+    amount: float
+    currency: Currency
+    items: typing.List[Item]
+    comment: typing.Optional[str] = None
+    tags: typing.Dict[str, str] = dataclasses.field(default_factory=dict)
+
+
+VALID_PAYLOAD = {
+    'order_id': 1,
+    'amount': 10,
+    'currency': 'USD',
+    'items': [{'name': 'pizza', 'quantity': 2}],
+    'unknown_field': 'is ignored',
+}
+
+
+def test_decoder_builds_dataclass():
+    decode = compile_decoder(CreateOrderPayload)
+
+    assert decode(VALID_PAYLOAD) == CreateOrderPayload(
+        order_id=1,
+        amount=10,
+        currency=Currency.USD,
+        items=[Item(name='pizza', quantity=2)],
+    )
+    assert compile_decoder(CreateOrderPayload) is decode
+
+
+@pytest.mark.parametrize('changes, error', [
+    ({'order_id': '1'}, 'payload.order_id: expected int, got str'),
+    ({'order_id': True}, 'payload.order_id: expected int, got bool'),
+    ({'currency': 'UAH'}, 'payload.currency: expected Currency, got str'),
+    ({'items': [{'name': 'pizza', 'quantity': None}]},
+     'payload.items[].quantity: expected int, got NoneType'),
+    ({'items': [{'name': 'pizza'}]}, 'payload.items[]: "quantity" field is required'),
+    ({'tags': {'a': 1}}, 'payload.tags[]: expected str, got int'),
+    ({'comment': 1}, 'payload.comment: expected str, got int'),
+])
+def test_decoder_validates_payload(changes, error):
+    with pytest.raises(PayloadValidationError) as exc_info:
+        compile_decoder(CreateOrderPayload)({**VALID_PAYLOAD, **changes})
+
+    assert str(exc_info.value) == error
+
+
+def test_registry_from_messages():
+    # any objects with name and payload, like asyncapi.Message
+    registry = PayloadRegistry()
+    registry.register_messages([
+        types.SimpleNamespace(name=success_task_name('create_order'), payload=Item),
+        types.SimpleNamespace(name='no_payload_dataclass', payload=None),
+    ])
+
+    assert registry.decode(success_task_name('create_order'), {'name': 'a', 'quantity': 1}) == \
+           Item(name='a', quantity=1)
+    assert registry.decode('no_payload_dataclass', {'a': 1}) == {'a': 1}
+
+
+def test_saga_step_handler_decodes_command_payload():
+    fake_celery_app = FakeCeleryApp()
+    fake_celery_app.send_task.reset_mock()
+    registry = PayloadRegistry()
+    registry.register('create_order', CreateOrderPayload)
+    handled_payloads = []
+
+    @fake_celery_app.task(bind=True, name='create_order')
+    @saga_step_handler(response_queue='responses', payload_registry=registry)
+    def create_order(self, saga_id: int, payload: CreateOrderPayload) -> dict:
+        handled_payloads.append(payload)
+        return {}
+
+    fake_celery_app.emulate_celery_task_launch('create_order', 123, VALID_PAYLOAD)
+    assert isinstance(handled_payloads[0], CreateOrderPayload)
+
+    # invalid payload is reported to Orchestrator as step failure
+    fake_celery_app.emulate_celery_task_launch('create_order', 123, {'order_id': 1})
+    assert len(handled_payloads) == 1
+    response_task_name, = fake_celery_app.send_task.call_args.args
+    assert response_task_name == failure_task_name('create_order')
+    assert fake_celery_app.send_task.call_args.kwargs['args'][1]['type'] == \
+           'PayloadValidationError'
+
+
+def test_saga_callbacks_receive_decoded_response_payload():
+    on_success_mock = MagicMock()
+    registry = PayloadRegistry()
+    registry.register(success_task_name('create_order'), Item)
+
+    class Saga(AsyncSaga):
+        payload_registry = registry
+
+        steps = [
+            AsyncStep(
+                name='create_order',
+                queue='some_queue',
+                base_task_name='create_order',
+                on_success=on_success_mock,
+            ),
+        ]
+
+    fake_celery_app = FakeCeleryApp()
+    Saga.register_async_step_handlers(fake_celery_app)
+    fake_celery_app.emulate_celery_task_launch(success_task_name('create_order'), 123,
+                                               {'name': 'a', 'quantity': 1})
+
+    on_success_mock.assert_called_once_with(Saga.steps[0], Item(name='a', quantity=1))
+
+
+def test_decoder_is_as_fast_as_hand_written_validation():
+    """
+    Compiled decoder is generated code, so it should cost about as much
+     as validation written by hand for this dataclass
+     (bound is loose to not fail on noisy machines)
+    """
+    @dataclasses.dataclass
+    class Payload:
+        order_id: int
+        customer_id: int
+        amount: float
+        currency: str
+        comment: typing.Optional[str] = None
+
+    def decode_by_hand(payload: dict) -> Payload:
+        if type(payload) is not dict:
+            raise PayloadValidationError('payload: expected dict')
+        order_id, customer_id = payload['order_id'], payload['customer_id']
+        amount, currency = payload['amount'], payload['currency']
+        if type(order_id) is not int or type(customer_id) is not int \
+                or type(amount) not in (float, int) or type(currency) is not str:
+            raise PayloadValidationError('payload: invalid field')
+        kwargs = {}
+        comment = payload.get('comment')
+        if comment is not None:
+            if type(comment) is not str:
+                raise PayloadValidationError('payload.comment: expected str')
+            kwargs['comment'] = comment
+        return Payload(order_id=order_id, customer_id=customer_id, amount=amount,
+                       currency=currency, **kwargs)
+
+    payload = {'order_id': 1, 'customer_id': 2, 'amount': 10.5, 'currency': 'USD'}
+    decode = compile_decoder(Payload)
+    assert decode(payload) == decode_by_hand(payload)
+
+    by_hand = min(timeit.repeat(lambda: decode_by_hand(payload), number=20000, repeat=5))
+    compiled = min(timeit.repeat(lambda: decode(payload), number=20000, repeat=5))
+
+    assert compiled < by_hand * 1.5
@@ -0,0 +1,171 @@
+import pytest
+
+from saga_framework.async_saga import AsyncSaga, AsyncStep
+from saga_framework.priority import PriorityLanes
+from saga_framework.saga_handlers import saga_step_handler
+from saga_framework.transports import ThreadedTransport
+from .common import FakeCeleryApp
+
+
+def test_priority_lanes():
+    lanes = PriorityLanes({'high': 7, 'default': 3, 'low': 0})
+
+    assert lanes.lane_for(9) == 'high'
+    assert lanes.lane_for(7) == 'high'
+    assert lanes.lane_for(5) == 'default'
+    assert lanes.lane_for(0) == 'low'
+    assert lanes.lane_for(None) == 'low'
+
+    assert lanes.queues('q') == ['q.high', 'q.default', 'q.low']
+    assert lanes.queues('q', min_lane='default') == ['q.high', 'q.default']
+
+
+def test_priority_lanes_route_sagas_without_priority_to_default_lane():
+    lanes = PriorityLanes({'high': 7, 'default': 3, 'low': 0}, default_lane='default')
+
+    assert lanes.lane_for(None) == 'default'
+    assert lanes.lane_for(0) == 'low'
+
+    with pytest.raises(ValueError):
+        PriorityLanes({'high': 7, 'low': 0}, default_lane='default')
+
+
+def make_saga_class(**class_attributes):
+    class Saga(AsyncSaga):
+        response_queue = 'saga_responses'
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+
+            self.steps = [
+                AsyncStep(
+                    name='step_1',
+                    action=self.send_command,
+
+                    queue='some_queue',
+                    base_task_name='step_1_task',
+                ),
+            ]
+
+        def send_command(self, step: AsyncStep):
+            self.send_message_to_other_service(step, {})
+
+    for name, value in class_attributes.items():
+        setattr(Saga, name, value)
+
+    return Saga
+
+
+def test_saga_priority_is_propagated_to_commands():
+    Saga = make_saga_class(priority=8)
+    fake_celery_app = FakeCeleryApp()
+    fake_celery_app.send_task.reset_mock()
+
+    Saga(fake_celery_app, 123).execute()
+
+    fake_celery_app.send_task.assert_called_once_with(
+        'step_1_task',
+        args=[123, {}],
+        queue='some_queue',
+        priority=8,
+        kwargs={'priority': 8}
+    )
+
+
+def test_saga_with_priority_lanes_routes_commands_and_responses_to_lanes():
+    Saga = make_saga_class(priority=8, priority_lanes=PriorityLanes({'high': 5, 'low': 0}))
+    fake_celery_app = FakeCeleryApp()
+    fake_celery_app.send_task.reset_mock()
+
+    Saga(fake_celery_app, 123).execute()
+
+    fake_celery_app.send_task.assert_called_once_with(
+        'step_1_task',
+        args=[123, {}],
+        queue='some_queue.high',
+        priority=8,
+        kwargs={'priority': 8, 'response_queue': 'saga_responses.high'}
+    )
+
+
+def test_worker_consumes_all_response_lanes_of_every_saga_class():
+    celery = pytest.importorskip('celery')
+    celery_app = celery.Celery()
+    celery_app.amqp.queues.select(['celery'])
+
+    lanes = PriorityLanes({'high': 5, 'low': 0})
+    make_saga_class(priority_lanes=lanes).register_async_step_handlers(celery_app)
+    make_saga_class(priority_lanes=lanes, response_queue='other_saga_responses') \
+        .register_async_step_handlers(celery_app)
+
+    assert sorted(celery_app.amqp.queues.consume_from) == [
+        'celery', 'other_saga_responses.high', 'other_saga_responses.low',
+        'saga_responses.high', 'saga_responses.low']
+
+
+def test_lane_queues_are_declared_with_priority_support():
+    celery = pytest.importorskip('celery')
+    from saga_framework.celery_utils import add_consumed_priority_lanes
+
+    lanes = PriorityLanes({'high': 5, 'low': 0}, max_priority=5)
+    orchestrator_app = celery.Celery()
+    orchestrator_app.amqp.queues.select(['celery'])
+    make_saga_class(priority_lanes=lanes).register_async_step_handlers(orchestrator_app)
+
+    queues = orchestrator_app.amqp.queues
+    for queue in ['saga_responses.high', 'saga_responses.low',
+                  'some_queue.high', 'some_queue.low']:
+        assert queues[queue].queue_arguments == {'x-max-priority': 5}
+    # Orchestrator doesn't consume command queues
+    assert 'some_queue.high' not in queues.consume_from
+
+    handler_app = celery.Celery()
+    handler_app.amqp.queues.select(['celery'])
+    assert add_consumed_priority_lanes(handler_app, lanes, 'some_queue') == \
+        ['some_queue.high', 'some_queue.low']
+    assert handler_app.amqp.queues.consume_from['some_queue.high'].queue_arguments == \
+        {'x-max-priority': 5}
+
+    with pytest.raises(ValueError):
+        PriorityLanes({'high': 7, 'low': 0}, max_priority=5)
+
+
+def test_messages_in_lane_queue_are_consumed_by_priority():
+    lanes = PriorityLanes({'high': 5, 'low': 0})
+    consumed = []
+    transport = ThreadedTransport(workers=1)
+
+    @transport.task(name='step_1_task')
+    def step_1_task(saga_id: int, payload: dict, **kwargs):
+        consumed.append((saga_id, kwargs['priority']))
+
+    # sagas sending to the same lane
+    for saga_id, priority in enumerate([5, 9, 7]):
+        make_saga_class(priority=priority, priority_lanes=lanes)(transport, saga_id).execute()
+
+    with transport:
+        transport.join()
+
+    assert consumed == [(1, 9), (2, 7), (0, 5)]
+
+
+def test_handler_responds_with_command_priority():
+    fake_celery_app = FakeCeleryApp()
+    fake_celery_app.send_task.reset_mock()
+
+    @fake_celery_app.task(bind=True, name='step_1_task')
+    @saga_step_handler(response_queue='saga_responses')
+    def some_celery_task(self, saga_id: int, payload: dict) -> dict:
+        return {}
+
+    fake_celery_app.emulate_celery_task_launch(
+        'step_1_task', saga_id=123, payload={},
+        priority=8, response_queue='saga_responses.high'
+    )
+
+    fake_celery_app.send_task.assert_called_once_with(
+        'step_1_task.response.success',
+        args=[123, {}],
+        queue='saga_responses.high',
+        priority=8
+    )
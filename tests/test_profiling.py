@@ -0,0 +1,97 @@
+import io
+import signal
+import os
+
+import pytest
+
+from saga_framework.async_saga import AsyncSaga, AsyncStep
+from saga_framework.base_saga import SyncStep
+from saga_framework.profiling import SagaProfiler
+from saga_framework.utils import success_task_name
+from .common import FakeCeleryApp
+
+
+def make_saga_class(profiler: SagaProfiler):
+    class Saga(AsyncSaga):
+        __slots__ = ()
+
+        def send_command(self, step: AsyncStep):
+            self.send_message_to_other_service(step, {})
+
+        steps = [
+            SyncStep(name='step_1'),
+            AsyncStep(
+                name='step_2',
+                action=send_command,
+
+                queue='some_queue',
+                base_task_name='step_2_task',
+            ),
+            SyncStep(name='step_3'),
+        ]
+
+    Saga.profiler = profiler
+    return Saga
+
+
+def test_phases_are_measured_per_saga_class():
+    profiler = SagaProfiler()
+    Saga = make_saga_class(profiler)
+    fake_celery_app = FakeCeleryApp()
+    Saga.register_async_step_handlers(fake_celery_app)
+
+    Saga(fake_celery_app, 123).execute()
+    fake_celery_app.emulate_celery_task_launch(success_task_name('step_2_task'), 123, {})
+
+    stats = profiler.report()[Saga.__qualname__]
+    assert {phase: s.count for phase, s in stats.items()} == {
+        'execute': 2,
+        'action': 3,
+        'send_task': 1,
+        'logging': 4,
+        'handler': 1,
+        'construction': 1,
+        'step_lookup': 1,
+        'on_async_step_success': 1,
+        'callback': 1,
+    }
+    assert stats['handler'].total >= stats['on_async_step_success'].total > 0
+
+    report = profiler.format_report()
+    assert Saga.__qualname__ in report
+    assert 'send_task' in report
+
+
+def test_sampling_skips_whole_messages():
+    profiler = SagaProfiler(sample_rate=0)
+    Saga = make_saga_class(profiler)
+    fake_celery_app = FakeCeleryApp()
+    Saga.register_async_step_handlers(fake_celery_app)
+
+    fake_celery_app.emulate_celery_task_launch(success_task_name('step_2_task'), 123, {})
+
+    assert profiler.report() == {}
+
+
+def test_profiling_is_off_by_default():
+    Saga = make_saga_class(None)
+
+    assert Saga.profile_phase('execute') is Saga.profile_phase('action')
+    Saga(FakeCeleryApp(), 123).execute()
+
+
+@pytest.mark.skipif(not hasattr(signal, 'SIGUSR1'), reason='no SIGUSR1 on this platform')
+def test_report_is_dumped_on_signal():
+    profiler = SagaProfiler()
+    profiler.record('Saga', 'handler', 0.5)
+    stream = io.StringIO()
+
+    previous_handler = signal.getsignal(signal.SIGUSR1)
+    try:
+        profiler.dump_on_signal(stream=stream)
+        os.kill(os.getpid(), signal.SIGUSR1)
+    finally:
+        signal.signal(signal.SIGUSR1, previous_handler)
+
+    assert 'handler' in stream.getvalue()
+    assert '500.00' in stream.getvalue()
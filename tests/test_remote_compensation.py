@@ -0,0 +1,146 @@
+import sqlite3
+from unittest.mock import MagicMock
+
+import pytest
+
+from saga_framework.async_saga import AsyncSaga, AsyncStep, RemoteCompensationError
+from saga_framework.base_saga import SyncStep
+from saga_framework.sqlite_repository import SQLiteSagaStateRepository
+from saga_framework.stateful_saga import StatefulSaga, SagaPhase
+from .common import FakeCeleryApp
+
+create_order_compensation_mock = MagicMock()
+
+
+class CreateOrderSteps:
+    """
+    Steps shared by saga classes below
+    """
+    __slots__ = ()
+
+    def send_command(self, step):
+        self.send_message_to_other_service(step, {})
+
+    def reject_ticket(self, step):
+        self.send_compensation_command(step, {'ticket_id': self.saga_id * 10})
+
+    steps = [
+        SyncStep(name='create_order', compensation=create_order_compensation_mock),
+        AsyncStep(name='create_ticket', base_task_name='create_ticket', queue='restaurant_service',
+                  action=send_command, compensation=reject_ticket, remote_compensation=True),
+        AsyncStep(name='authorize_card', base_task_name='authorize_card',
+                  queue='accounting_service', action=send_command),
+    ]
+
+
+class Saga(CreateOrderSteps, StatefulSaga):
+    __slots__ = ()
+    on_saga_failure_mock = MagicMock()
+    on_compensation_failure_mock = MagicMock()
+
+    def on_saga_failure(self, *args, **kwargs):
+        self.on_saga_failure_mock(*args, **kwargs)
+        super().on_saga_failure(*args, **kwargs)
+
+    def on_compensation_failure(self, *args, **kwargs):
+        self.on_compensation_failure_mock(*args, **kwargs)
+        super().on_compensation_failure(*args, **kwargs)
+
+
+@pytest.fixture
+def repository():
+    repository = SQLiteSagaStateRepository(sqlite3.connect(':memory:'))
+    repository.create_tables()
+    return repository
+
+
+def start_failed_saga(repository, celery_app) -> int:
+    for mock in (create_order_compensation_mock, Saga.on_saga_failure_mock,
+                 Saga.on_compensation_failure_mock, FakeCeleryApp.send_task):
+        mock.reset_mock()
+
+    Saga.register_async_step_handlers(repository, celery_app)
+    saga_id = repository.create_saga_state()
+    saga = Saga(repository, celery_app, saga_id)
+    saga.handle_message(saga.execute)
+    celery_app.emulate_celery_task_launch('create_ticket.response.success', saga_id, {})
+    celery_app.emulate_celery_task_launch('authorize_card.response.failure', saga_id,
+                                          {'message': 'card declined'})
+    return saga_id
+
+
+def test_remote_compensation_continues_on_response(repository):
+    celery_app = FakeCeleryApp()
+    saga_id = start_failed_saga(repository, celery_app)
+
+    # compensation command is sent, but saga doesn't wait for its response
+    task_name, = FakeCeleryApp.send_task.call_args.args
+    assert task_name == 'create_ticket.compensation'
+    assert FakeCeleryApp.send_task.call_args.kwargs['args'] == [saga_id, {'ticket_id': saga_id * 10}]
+    assert FakeCeleryApp.send_task.call_args.kwargs['queue'] == 'restaurant_service'
+    state = repository.get_saga_state_by_id(saga_id)
+    assert (state['step_name'], state['phase']) == ('create_ticket', SagaPhase.COMPENSATING)
+    create_order_compensation_mock.assert_not_called()
+
+    celery_app.emulate_celery_task_launch('create_ticket.compensation.response.success',
+                                          saga_id, {})
+
+    create_order_compensation_mock.assert_called_once()
+    failed_step, initial_failure_payload = Saga.on_saga_failure_mock.call_args.args
+    assert failed_step.name == 'authorize_card'
+    assert initial_failure_payload == {'message': 'card declined'}
+    assert [(transition['step_name'], transition['phase'])
+            for transition in repository.get_transitions(saga_id)][-5:] == [
+        ('create_ticket', SagaPhase.COMPENSATING),
+        ('create_ticket', SagaPhase.COMPENSATED),
+        ('create_order', SagaPhase.COMPENSATING),
+        ('create_order', SagaPhase.COMPENSATED),
+        (None, SagaPhase.FAILED),
+    ]
+
+
+def test_remote_compensation_failure_can_be_resumed(repository):
+    celery_app = FakeCeleryApp()
+    saga_id = start_failed_saga(repository, celery_app)
+
+    celery_app.emulate_celery_task_launch('create_ticket.compensation.response.failure',
+                                          saga_id, {'message': 'ticket not found'})
+
+    kwargs = Saga.on_compensation_failure_mock.call_args.kwargs
+    assert kwargs['initially_failed_step'].name == 'authorize_card'
+    assert kwargs['compensation_failed_step'].name == 'create_ticket'
+    assert isinstance(kwargs['compensation_exception'], RemoteCompensationError)
+    assert kwargs['compensation_exception'].payload == {'message': 'ticket not found'}
+    state = repository.get_saga_state_by_id(saga_id)
+    assert (state['step_name'], state['phase']) == ('create_ticket',
+                                                    SagaPhase.COMPENSATION_FAILED)
+
+    FakeCeleryApp.send_task.reset_mock()
+    saga = Saga(repository, celery_app, saga_id)
+    saga.handle_message(saga.resume_compensation, saga.get_step_by_name(state['failed_step']))
+    assert FakeCeleryApp.send_task.call_args.args == ('create_ticket.compensation',)
+    create_order_compensation_mock.assert_not_called()
+
+
+def test_stateless_saga_handles_batched_compensation_response():
+    compensation_mock = MagicMock()
+
+    class StatelessSaga(CreateOrderSteps, AsyncSaga):
+        __slots__ = ()
+        steps = [SyncStep(name='create_order', compensation=compensation_mock)] + \
+            CreateOrderSteps.steps[1:]
+
+    saga = StatelessSaga(FakeCeleryApp(), 123)
+    saga.on_async_step_response('create_ticket.compensation.response.success', {})
+    compensation_mock.assert_called_once()
+
+
+
+def test_remote_compensation_requires_compensation_that_sends_command():
+    class InvalidSaga(AsyncSaga):
+        __slots__ = ()
+        steps = [AsyncStep(name='step', base_task_name='step', queue='queue',
+                           remote_compensation=True)]
+
+    with pytest.raises(ValueError, match='remote compensation'):
+        InvalidSaga.register_async_step_handlers(FakeCeleryApp())
@@ -0,0 +1,158 @@
+from unittest.mock import MagicMock
+
+import pytest
+
+from saga_framework.async_saga import AsyncSaga, AsyncStep
+from saga_framework.batching import ResponseBatcher
+from saga_framework.celery_utils import rebalance_worker_queues
+from saga_framework.saga_handlers import saga_step_handler
+from saga_framework.sharding import ConsistentHashRing, assign_shards
+from .common import FakeCeleryApp
+
+
+def test_hash_ring_moves_few_keys_when_node_is_added():
+    ring = ConsistentHashRing(range(4))
+    before = {saga_id: ring.get_node(saga_id) for saga_id in range(1000)}
+
+    assert set(before.values()) == {0, 1, 2, 3}
+
+    ring.add_node(4)
+    after = {saga_id: ring.get_node(saga_id) for saga_id in range(1000)}
+    moved = [saga_id for saga_id in before if before[saga_id] != after[saga_id]]
+
+    # only keys that moved to new node change their node
+    assert all(after[saga_id] == 4 for saga_id in moved)
+    assert 100 < len(moved) < 350
+
+    ring.remove_node(4)
+    assert before == {saga_id: ring.get_node(saga_id) for saga_id in range(1000)}
+
+
+def test_assign_shards():
+    assignment = assign_shards(range(16), ['worker1', 'worker2'])
+    assert sorted(assignment['worker1'] + assignment['worker2']) == list(range(16))
+
+    new_assignment = assign_shards(range(16), ['worker1', 'worker2', 'worker3'])
+    # shards are moved only to new worker
+    assert set(new_assignment['worker1']) <= set(assignment['worker1'])
+    assert set(new_assignment['worker2']) <= set(assignment['worker2'])
+
+
+def make_saga_class(response_queue_name: str = 'saga_responses'):
+    class Saga(AsyncSaga):
+        response_queue = response_queue_name
+        shard_ring = ConsistentHashRing(range(4))
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+
+            self.steps = [
+                AsyncStep(
+                    name='step_1',
+                    action=self.send_command,
+
+                    queue='some_queue',
+                    base_task_name='step_1_task',
+                ),
+            ]
+
+        def send_command(self, step: AsyncStep):
+            self.send_message_to_other_service(step, {})
+
+    return Saga
+
+
+def test_sharded_saga_asks_handler_to_respond_to_shard_queue():
+    Saga = make_saga_class()
+    fake_celery_app = FakeCeleryApp()
+    fake_celery_app.send_task.reset_mock()
+
+    Saga(fake_celery_app, 123).execute()
+
+    shard = Saga.shard_ring.get_node(123)
+    fake_celery_app.send_task.assert_called_once_with(
+        'step_1_task',
+        args=[123, {}],
+        queue='some_queue',
+        kwargs={'response_queue': f'saga_responses.shard.{shard}'}
+    )
+
+
+def test_handler_responds_to_queue_requested_by_orchestrator():
+    fake_celery_app = FakeCeleryApp()
+    fake_celery_app.send_task.reset_mock()
+
+    @fake_celery_app.task(bind=True, name='step_1_task')
+    @saga_step_handler(response_queue='saga_responses')
+    def some_celery_task(self, saga_id: int, payload: dict) -> dict:
+        return {}
+
+    fake_celery_app.emulate_celery_task_launch(
+        'step_1_task', saga_id=123, payload={},
+        response_queue='saga_responses.shard.2'
+    )
+
+    fake_celery_app.send_task.assert_called_once_with(
+        'step_1_task.response.success',
+        args=[123, {}],
+        queue='saga_responses.shard.2'
+    )
+
+
+def test_batched_responses_to_shard_queues_are_handled():
+    Saga = make_saga_class()
+    Saga.on_async_step_success = MagicMock()
+    fake_celery_app = FakeCeleryApp()
+    fake_celery_app.send_task.reset_mock()
+    # noinspection PyTypeChecker
+    Saga.register_async_step_handlers(fake_celery_app)
+
+    response_batcher = ResponseBatcher(fake_celery_app, max_batch_size=100, max_delay=None)
+
+    @fake_celery_app.task(bind=True, name='step_1_task')
+    @saga_step_handler(response_queue='saga_responses', response_batcher=response_batcher)
+    def some_celery_task(self, saga_id: int, payload: dict) -> dict:
+        return {'saga': saga_id}
+
+    saga_ids = range(20)
+    for saga_id in saga_ids:
+        fake_celery_app.emulate_celery_task_launch(
+            'step_1_task', saga_id=saga_id, payload={},
+            response_queue=Saga(fake_celery_app, saga_id).get_response_queue()
+        )
+    response_batcher.close()
+
+    batches = fake_celery_app.send_task.call_args_list
+    # responses are batched per shard queue
+    assert len(batches) == 4
+    for batch in batches:
+        fake_celery_app.emulate_celery_task_launch(batch.args[0], *batch.kwargs['args'])
+
+    assert sorted(c.args[1]['saga'] for c in Saga.on_async_step_success.call_args_list) == \
+           list(saga_ids)
+
+
+def test_worker_consumes_its_shard_queues_of_every_saga_class():
+    celery = pytest.importorskip('celery')
+    celery_app = celery.Celery()
+    # like worker started with -Q celery
+    celery_app.amqp.queues.select(['celery'])
+
+    make_saga_class('a_responses').register_async_step_handlers(celery_app, shards=[0, 2])
+    make_saga_class('b_responses').register_async_step_handlers(celery_app, shards=[1])
+
+    assert sorted(celery_app.amqp.queues.consume_from) == [
+        'a_responses.shard.0', 'a_responses.shard.2', 'b_responses.shard.1', 'celery']
+
+
+def test_rebalance_worker_queues():
+    celery_app = MagicMock()
+
+    rebalance_worker_queues(celery_app, 'worker1',
+                            current_queues=['q.shard.0', 'q.shard.1'],
+                            new_queues=['q.shard.1', 'q.shard.2'])
+
+    celery_app.control.add_consumer.assert_called_once_with(
+        'q.shard.2', destination=['worker1'])
+    celery_app.control.cancel_consumer.assert_called_once_with(
+        'q.shard.0', destination=['worker1'])
@@ -0,0 +1,89 @@
+import pytest
+
+numpy = pytest.importorskip('numpy')
+
+from saga_framework.async_saga import AsyncSaga, AsyncStep
+from saga_framework.base_saga import SyncStep, StepKind
+from saga_framework.simulation import SagaSimulator, StepProfile, exponential, ORCHESTRATOR
+
+
+def compensate(saga, step):
+    pass
+
+
+class Saga(AsyncSaga):
+    steps = [
+        SyncStep(name='create_order', compensation=compensate),
+        AsyncStep(name='verify_consumer', base_task_name='verify_consumer',
+                  queue='consumer_service'),
+        AsyncStep(name='create_ticket', base_task_name='create_ticket',
+                  queue='restaurant_service', compensation=compensate),
+        AsyncStep(name='authorize_card', base_task_name='authorize_card',
+                  queue='accounting_service', kind=StepKind.PIVOT),
+        AsyncStep(name='approve_ticket', base_task_name='approve_ticket',
+                  queue='restaurant_service', kind=StepKind.RETRIABLE),
+    ]
+
+
+def test_single_worker_queue_matches_queueing_theory():
+    # M/M/1 queue: mean wait = utilization / (service rate - arrival rate)
+    simulator = SagaSimulator([AsyncStep(name='step', base_task_name='step', queue='queue')],
+                              {'step': StepProfile(exponential(0.01))},
+                              broker_latency=0, orchestrator_time=0)
+
+    result = simulator.run(arrival_rate=50, workers={'queue': 1}, sagas=200000)
+
+    assert result.resources['queue'].mean_wait == pytest.approx(0.5 / 50, rel=0.1)
+    assert result.resources['queue'].utilization == pytest.approx(0.5, rel=0.05)
+    assert result.latency_percentiles[50] == pytest.approx(
+        numpy.log(2) / 50, rel=0.1)  # M/M/1 sojourn time is exponential
+
+
+def test_throughput_ceiling_and_bottleneck():
+    simulator = SagaSimulator(Saga, {
+        'verify_consumer': StepProfile(0.010),
+        'create_ticket': StepProfile(0.020),
+        'authorize_card': StepProfile(0.012),
+        'approve_ticket': StepProfile(0.020),
+    }, orchestrator_time=0.001)
+
+    results = simulator.sweep(arrival_rate=300, sagas=20000, workers_options=[
+        {ORCHESTRATOR: 2, 'consumer_service': 4, 'restaurant_service': 8,
+         'accounting_service': 4},
+        {ORCHESTRATOR: 2, 'consumer_service': 4, 'restaurant_service': 16,
+         'accounting_service': 4},
+    ])
+
+    # restaurant service handles 2 commands per saga, 40 ms in total
+    assert results[0].bottleneck == 'restaurant_service'
+    assert results[0].throughput_ceiling == pytest.approx(8 / 0.040)
+    assert results[0].resources['restaurant_service'].messages == 40000
+    # overloaded: queue grows, restaurant service is busy all the time
+    assert results[0].resources['restaurant_service'].utilization == pytest.approx(1, rel=0.01)
+    assert results[0].throughput < 250
+    assert results[0].resources['restaurant_service'].max_wait > 10
+
+    assert results[1].bottleneck == 'accounting_service'
+    assert results[1].throughput == pytest.approx(300, rel=0.05)
+    assert results[1].latency_percentiles[99] < 0.2
+    assert 'restaurant_service' in results[1].format_report()
+
+
+def test_failed_sagas_are_compensated_and_stop():
+    simulator = SagaSimulator(Saga, {
+        'create_order': StepProfile(compensation_time=0.010),
+        'create_ticket': StepProfile(0.001, failure_probability=0.5),
+    }, orchestrator_time=0)
+
+    result = simulator.run(arrival_rate=10, workers={}, sagas=10000)
+
+    assert result.failed_ratio == pytest.approx(0.5, abs=0.02)
+    messages = {name: stats.messages for name, stats in result.resources.items()}
+    succeeded = round(10000 * (1 - result.failed_ratio))
+    assert messages['consumer_service'] == 10000
+    assert messages['accounting_service'] == succeeded
+    # create_ticket for every saga, approve_ticket for succeeded ones
+    assert messages['restaurant_service'] == 10000 + succeeded
+    # failed step itself isn't compensated
+    assert result.resources[ORCHESTRATOR].throughput_ceiling == \
+        pytest.approx(10000 / (0.010 * (10000 - succeeded)))
@@ -0,0 +1,163 @@
+import datetime
+import sqlite3
+
+import pytest
+
+from saga_framework.async_saga import AsyncStep
+from saga_framework.base_saga import SyncStep
+from saga_framework.sqlite_repository import SQLiteSagaStateRepository
+from saga_framework.stateful_saga import StatefulSaga, SagaPhase
+from saga_framework.utils import success_task_name, failure_task_name
+from .common import FakeCeleryApp
+
+
+class Saga(StatefulSaga):
+    __slots__ = ()
+
+    def send_command(self, step: AsyncStep):
+        self.send_message_to_other_service(step, {})
+
+    steps = [
+        SyncStep(name='step_1'),
+        AsyncStep(
+            name='step_2',
+            action=send_command,
+
+            queue='some_queue',
+            base_task_name='step_2_task',
+        ),
+        SyncStep(name='step_3'),
+    ]
+
+
+@pytest.fixture
+def repository():
+    repository = SQLiteSagaStateRepository(sqlite3.connect(':memory:'),
+                                           saga_class_name='Saga',
+                                           extra_columns={'order_id': 'INTEGER'})
+    repository.create_tables()
+    return repository
+
+
+def test_transitions_are_recorded(repository):
+    saga_id = repository.create_saga_state(order_id=7)
+    fake_celery_app = FakeCeleryApp()
+    Saga.register_async_step_handlers(repository, fake_celery_app)
+
+    saga = Saga(repository, fake_celery_app, saga_id)
+    saga.handle_message(saga.execute)
+    state = repository.get_saga_state_by_id(saga_id)
+    assert (state['status'], state['step_index'], state['step_name'], state['phase']) == \
+           ('step_2.running', 1, 'step_2', 'running')
+    assert state['order_id'] == 7
+
+    fake_celery_app.emulate_celery_task_launch(success_task_name('step_2_task'), saga_id, {})
+    assert repository.get_saga_state_by_id(saga_id)['status'] == 'succeeded'
+
+    assert [(t['step_name'], t['phase']) for t in repository.get_transitions(saga_id)] == [
+        ('step_1', SagaPhase.RUNNING),
+        ('step_2', SagaPhase.RUNNING),
+        ('step_2', SagaPhase.SUCCEEDED),
+        ('step_3', SagaPhase.RUNNING),
+        (None, SagaPhase.SUCCEEDED),
+    ]
+
+
+def test_failure_is_recorded(repository):
+    saga_id = repository.create_saga_state()
+    fake_celery_app = FakeCeleryApp()
+    Saga.register_async_step_handlers(repository, fake_celery_app)
+
+    Saga(repository, fake_celery_app, saga_id).execute()
+    fake_celery_app.emulate_celery_task_launch(failure_task_name('step_2_task'), saga_id,
+                                               {'message': 'oops'})
+
+    state = repository.get_saga_state_by_id(saga_id)
+    assert (state['status'], state['failed_step']) == ('failed', 'step_2')
+    assert [(t['step_name'], t['phase']) for t in repository.get_transitions(saga_id)][-4:] == [
+        ('step_2', SagaPhase.FAILED),
+        ('step_1', SagaPhase.COMPENSATING),
+        ('step_1', SagaPhase.COMPENSATED),
+        (None, SagaPhase.FAILED),
+    ]
+
+
+def test_only_status_changes_touch_updated_at(repository):
+    saga_id = repository.create_saga_state()
+    at = datetime.datetime(2020, 1, 1, 12)
+    repository.update_step_status(saga_id, 1, 'step_2', SagaPhase.COMPENSATING, at=at)
+
+    repository.save_compensation_checkpoint(saga_id, 1)
+    repository.on_step_failure(saga_id, Saga.steps[1], {'message': 'oops'})
+    repository.update(saga_id, order_id=7)
+
+    assert repository.oldest_by_step(SagaPhase.COMPENSATING) == {'step_2': at}
+
+
+def test_aggregate_queries(repository):
+    now = datetime.datetime(2020, 1, 1, 12)
+    for age_in_minutes in range(1, 11):
+        saga_id = repository.create_saga_state()
+        repository.update_step_status(saga_id, 1, 'step_2', SagaPhase.RUNNING,
+                                      at=now - datetime.timedelta(minutes=age_in_minutes))
+    saga_id = repository.create_saga_state()
+    repository.update_step_status(saga_id, None, None, SagaPhase.SUCCEEDED, at=now)
+
+    assert repository.count_by_step_and_phase() == {
+        ('step_2', SagaPhase.RUNNING): 10,
+        (None, SagaPhase.SUCCEEDED): 1,
+    }
+    assert repository.oldest_by_step() == {
+        'step_2': now - datetime.timedelta(minutes=10)
+    }
+    assert repository.age_percentiles('step_2', percentiles=(50, 90, 100), now=now) == {
+        50: datetime.timedelta(minutes=5),
+        90: datetime.timedelta(minutes=9),
+        100: datetime.timedelta(minutes=10),
+    }
+    assert repository.age_percentiles('step_1', now=now) == {}
+
+
+def test_age_percentiles_with_equal_ages(repository):
+    now = datetime.datetime(2020, 1, 1, 12)
+    ages_in_minutes = [1, 2, 2, 2, 3, 5, 5, 8, 9, 9, 9, 10]
+    for age_in_minutes in ages_in_minutes:
+        saga_id = repository.create_saga_state()
+        repository.update_step_status(saga_id, 1, 'step_2', SagaPhase.RUNNING,
+                                      at=now - datetime.timedelta(minutes=age_in_minutes))
+
+    percentiles = (1, 10, 25, 50, 51, 75, 90, 99, 100)
+    # nearest-rank method
+    assert repository.age_percentiles('step_2', percentiles=percentiles, now=now) == {
+        percentile: datetime.timedelta(minutes=ages_in_minutes[
+            max(0, round(percentile / 100 * len(ages_in_minutes)) - 1)])
+        for percentile in percentiles
+    }
+
+
+def test_transaction_reads_share_snapshot(repository):
+    with repository.transaction():
+        # transaction is open before anything is written
+        assert repository.connection.in_transaction
+        repository.export_sagas([1])
+
+    assert not repository.connection.in_transaction
+
+
+@pytest.mark.parametrize('query, params', [
+    ('SELECT step_name, phase, COUNT(*) FROM saga_state '
+     'WHERE phase IS NOT NULL GROUP BY phase, step_name', ()),
+    ('SELECT step_name, MIN(updated_at) FROM saga_state '
+     'WHERE phase = ? GROUP BY step_name', ('running',)),
+    ('SELECT updated_at, id FROM saga_state WHERE phase = ? AND step_name = ? '
+     'ORDER BY updated_at DESC, id DESC LIMIT 1 OFFSET ?', ('running', 'step_2', 5)),
+    ('SELECT updated_at, id FROM saga_state WHERE phase = ? AND step_name = ? '
+     'AND (updated_at, id) < (?, ?) ORDER BY updated_at DESC, id DESC LIMIT 1 OFFSET ?',
+     ('running', 'step_2', 1.0, 5, 5)),
+])
+def test_aggregate_queries_use_covering_index(repository, query, params):
+    plan = ' '.join(row[-1] for row in repository.connection.execute(
+        f'EXPLAIN QUERY PLAN {query}', params))
+
+    assert 'COVERING INDEX ix_saga_state_phase_step_updated_at' in plan
+    assert 'TEMP B-TREE' not in plan
@@ -0,0 +1,176 @@
+from unittest.mock import MagicMock
+
+from saga_framework.async_saga import AsyncSaga, AsyncStep
+from saga_framework.base_saga import SyncStep
+from saga_framework.saga_handlers import fused_saga_step_handler
+from .common import FakeCeleryApp
+
+
+def make_saga_class():
+    mocks = MagicMock()
+
+    class Saga(AsyncSaga):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+
+            self.steps = [
+                SyncStep(
+                    name='step_1',
+                    compensation=mocks.step_1_compensation
+                ),
+                AsyncStep(
+                    name='step_2',
+                    action=self.send_command,
+                    compensation=mocks.step_2_compensation,
+
+                    queue='some_queue',
+                    base_task_name='step_2_task',
+                    on_success=mocks.step_2_on_success,
+                    fuse_with_next=True
+                ),
+                AsyncStep(
+                    name='step_3',
+                    action=self.send_command,
+                    compensation=mocks.step_3_compensation,
+
+                    queue='some_queue',
+                    base_task_name='step_3_task',
+                    on_success=mocks.step_3_on_success,
+                    on_failure=mocks.step_3_on_failure
+                ),
+                SyncStep(
+                    name='step_4',
+                    action=mocks.step_4_action
+                ),
+            ]
+
+        def send_command(self, step: AsyncStep):
+            self.send_message_to_other_service(step, {'step': step.name})
+
+        on_saga_success = mocks.on_saga_success
+        on_saga_failure = mocks.on_saga_failure
+
+    return Saga, mocks
+
+
+def test_fused_steps_are_sent_as_one_command():
+    Saga, mocks = make_saga_class()
+    fake_celery_app = FakeCeleryApp()
+    fake_celery_app.send_task.reset_mock()
+
+    Saga(fake_celery_app, 123).execute()
+
+    fake_celery_app.send_task.assert_called_once_with(
+        'some_queue.fused',
+        args=[
+            123,
+            [
+                ['step_2_task', {'step': 'step_2'}],
+                ['step_3_task', {'step': 'step_3'}],
+            ]
+        ],
+        queue='some_queue'
+    )
+    mocks.step_4_action.assert_not_called()
+
+
+def test_fused_steps_success():
+    Saga, mocks = make_saga_class()
+    fake_celery_app = FakeCeleryApp()
+    # noinspection PyTypeChecker
+    Saga.register_async_step_handlers(fake_celery_app)
+
+    fake_celery_app.emulate_celery_task_launch(
+        'step_2_task.fused.response',
+        saga_id=123,
+        outcomes=[
+            ['step_2_task.response.success', {'ticket_id': 1}],
+            ['step_3_task.response.success', None],
+        ]
+    )
+
+    mocks.step_2_on_success.assert_called_once()
+    mocks.step_3_on_success.assert_called_once()
+    mocks.step_4_action.assert_called_once()
+    mocks.on_saga_success.assert_called_once()
+
+
+def test_fused_steps_failure_compensates_succeeded_fused_steps():
+    Saga, mocks = make_saga_class()
+    fake_celery_app = FakeCeleryApp()
+    # noinspection PyTypeChecker
+    Saga.register_async_step_handlers(fake_celery_app)
+
+    fake_celery_app.emulate_celery_task_launch(
+        'step_2_task.fused.response',
+        saga_id=123,
+        outcomes=[
+            ['step_2_task.response.success', {'ticket_id': 1}],
+            ['step_3_task.response.failure', {'message': 'some error'}],
+        ]
+    )
+
+    mocks.step_2_on_success.assert_called_once()
+    mocks.step_3_on_failure.assert_called_once()
+    mocks.step_3_compensation.assert_not_called()
+    mocks.step_2_compensation.assert_called_once()
+    mocks.step_1_compensation.assert_called_once()
+    mocks.on_saga_failure.assert_called_once()
+    mocks.step_4_action.assert_not_called()
+
+
+def test_fused_saga_step_handler_stops_on_first_failure():
+    fake_celery_app = FakeCeleryApp()
+    fake_celery_app.send_task.reset_mock()
+    step_3_handler = MagicMock()
+
+    def step_1_handler(celery_task, saga_id: int, payload: dict):
+        return {'handled': payload}
+
+    def step_2_handler(celery_task, saga_id: int, payload: dict):
+        raise ValueError('some error')
+
+    fake_celery_app.task(bind=True, name='some_queue.fused')(
+        fused_saga_step_handler('response_queue', handlers={
+            'step_1_task': step_1_handler,
+            'step_2_task': step_2_handler,
+            'step_3_task': step_3_handler,
+        })
+    )
+
+    fake_celery_app.emulate_celery_task_launch(
+        'some_queue.fused',
+        saga_id=123,
+        commands=[['step_1_task', 1], ['step_2_task', 2], ['step_3_task', 3]]
+    )
+
+    step_3_handler.assert_not_called()
+
+    response_task_name = fake_celery_app.send_task.call_args.args[0]
+    saga_id, outcomes = fake_celery_app.send_task.call_args.kwargs['args']
+    assert response_task_name == 'step_1_task.fused.response'
+    assert saga_id == 123
+    assert outcomes[0] == ['step_1_task.response.success', {'handled': 1}]
+    assert outcomes[1][0] == 'step_2_task.response.failure'
+    assert outcomes[1][1]['message'] == 'some error'
+    assert len(outcomes) == 2
+
+
+def test_failure_of_later_fused_step_action_is_reported_for_this_step():
+    Saga, mocks = make_saga_class()
+    fake_celery_app = FakeCeleryApp()
+    fake_celery_app.send_task.reset_mock()
+
+    saga = Saga(fake_celery_app, 123)
+    saga.steps[2] = AsyncStep(name='step_3', action=MagicMock(side_effect=KeyError('step_3')),
+                              queue='some_queue', base_task_name='step_3_task')
+    saga.execute()
+
+    fake_celery_app.send_task.assert_not_called()
+    failed_step, failure_payload = mocks.on_saga_failure.call_args.args
+    # command of step_2 wasn't sent, so saga fails on it
+    assert failed_step.name == 'step_2'
+    assert failure_payload['type'] == 'KeyError'
+    assert failure_payload['failed_step'] == 'step_3'
+    mocks.step_2_compensation.assert_not_called()
+    mocks.step_1_compensation.assert_called_once()
@@ -0,0 +1,165 @@
+from unittest.mock import MagicMock
+
+import pytest
+
+from saga_framework.async_saga import AsyncSaga, AsyncStep
+from saga_framework.base_saga import BaseSaga, SyncStep, StepKind
+from .common import FakeCeleryApp
+
+
+def make_saga_class():
+    mocks = MagicMock()
+
+    class Saga(AsyncSaga):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+
+            self.steps = [
+                SyncStep(
+                    name='step_1',
+                    compensation=mocks.step_1_compensation
+                ),
+                AsyncStep(
+                    name='pivot_step',
+                    action=mocks.pivot_step_action,
+                    kind=StepKind.PIVOT,
+
+                    queue='some_queue',
+                    base_task_name='pivot_task',
+                ),
+                AsyncStep(
+                    name='retriable_step_1',
+                    action=mocks.retriable_step_1_action,
+                    kind=StepKind.RETRIABLE,
+
+                    queue='some_queue',
+                    base_task_name='retriable_1_task',
+                    on_success=mocks.retriable_step_1_on_success
+                ),
+                AsyncStep(
+                    name='retriable_step_2',
+                    action=mocks.retriable_step_2_action,
+                    kind=StepKind.RETRIABLE,
+
+                    queue='some_queue',
+                    base_task_name='retriable_2_task',
+                ),
+            ]
+
+        on_saga_success = mocks.on_saga_success
+        on_saga_failure = mocks.on_saga_failure
+        on_retriable_step_success = mocks.on_retriable_step_success
+        on_retriable_step_failure = mocks.on_retriable_step_failure
+
+    return Saga, mocks
+
+
+def test_retriable_steps_are_dispatched_together_after_pivot():
+    Saga, mocks = make_saga_class()
+    fake_celery_app = FakeCeleryApp()
+    # noinspection PyTypeChecker
+    Saga.register_async_step_handlers(fake_celery_app)
+
+    Saga(fake_celery_app, 123).execute()
+    mocks.pivot_step_action.assert_called_once()
+    mocks.retriable_step_1_action.assert_not_called()
+
+    fake_celery_app.emulate_celery_task_launch('pivot_task.response.success',
+                                               saga_id=123, payload={})
+
+    # both retriable steps are dispatched and saga succeeded without waiting for them
+    mocks.retriable_step_1_action.assert_called_once()
+    mocks.retriable_step_2_action.assert_called_once()
+    mocks.on_saga_success.assert_called_once()
+
+    fake_celery_app.emulate_celery_task_launch('retriable_1_task.response.success',
+                                               saga_id=123, payload={'a': 1})
+
+    mocks.retriable_step_1_on_success.assert_called_once()
+    mocks.on_retriable_step_success.assert_called_once()
+    # saga isn't continued second time
+    mocks.on_saga_success.assert_called_once()
+
+
+def test_retriable_step_failure_isnt_compensated():
+    Saga, mocks = make_saga_class()
+    fake_celery_app = FakeCeleryApp()
+    # noinspection PyTypeChecker
+    Saga.register_async_step_handlers(fake_celery_app)
+
+    fake_celery_app.emulate_celery_task_launch('retriable_2_task.response.failure',
+                                               saga_id=123, payload={'message': 'error'})
+
+    mocks.on_retriable_step_failure.assert_called_once()
+    mocks.step_1_compensation.assert_not_called()
+    mocks.on_saga_failure.assert_not_called()
+
+
+def test_pivot_failure_is_compensated():
+    Saga, mocks = make_saga_class()
+    fake_celery_app = FakeCeleryApp()
+    # noinspection PyTypeChecker
+    Saga.register_async_step_handlers(fake_celery_app)
+
+    fake_celery_app.emulate_celery_task_launch('pivot_task.response.failure',
+                                               saga_id=123, payload={'message': 'error'})
+
+    mocks.step_1_compensation.assert_called_once()
+    mocks.on_saga_failure.assert_called_once()
+    mocks.retriable_step_1_action.assert_not_called()
+
+
+def test_failing_retriable_sync_step_doesnt_stop_saga():
+    on_retriable_step_failure_mock = MagicMock()
+    on_saga_success_mock = MagicMock()
+    step_3_action_mock = MagicMock()
+
+    class Saga(BaseSaga):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+
+            self.steps = [
+                SyncStep(name='step_1', kind=StepKind.PIVOT),
+                SyncStep(name='step_2', kind=StepKind.RETRIABLE,
+                         action=MagicMock(side_effect=EnvironmentError('some error'))),
+                SyncStep(name='step_3', kind=StepKind.RETRIABLE,
+                         action=step_3_action_mock),
+            ]
+
+        on_saga_success = on_saga_success_mock
+        on_retriable_step_failure = on_retriable_step_failure_mock
+
+    Saga(123).execute()
+
+    on_retriable_step_failure_mock.assert_called_once()
+    step_3_action_mock.assert_called_once()
+    on_saga_success_mock.assert_called_once()
+
+
+@pytest.mark.parametrize('kinds', [
+    [StepKind.PIVOT, StepKind.PIVOT],
+    [StepKind.RETRIABLE, StepKind.COMPENSATABLE],
+    [StepKind.RETRIABLE, StepKind.PIVOT],
+])
+def test_validate_steps(kinds):
+    class Saga(BaseSaga):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+
+            self.steps = [SyncStep(name=f'step_{i}', kind=kind)
+                          for i, kind in enumerate(kinds)]
+
+    with pytest.raises(ValueError):
+        Saga(123).validate_steps()
+
+
+def test_retriable_step_cant_have_compensation():
+    class Saga(BaseSaga):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+
+            self.steps = [SyncStep(name='step_1', kind=StepKind.RETRIABLE,
+                                   compensation=MagicMock())]
+
+    with pytest.raises(ValueError):
+        Saga(123).validate_steps()
@@ -0,0 +1,235 @@
+"""
+Conformance tests: every transport runs the same saga system
+ (Orchestrator and Saga Handler service) in process
+"""
+import asyncio
+import itertools
+import threading
+import time
+
+import pytest
+
+from saga_framework.async_saga import AsyncSaga, AsyncStep
+from saga_framework.saga_handlers import saga_step_handler
+from saga_framework.transports import AbstractTransport, AsyncioTransport, \
+    CeleryTransport, ThreadedTransport
+from saga_framework.utils import compensation_task_name
+
+COMMANDS_QUEUE = 'restaurant_service'
+RESPONSE_QUEUE = 'create_order_saga_responses'
+
+saga_ids = itertools.count(1)
+saga_outcomes = {}
+rejected_tickets = set()
+received = []
+
+
+class CreateOrderSaga(AsyncSaga):
+    __slots__ = ()
+
+    def create_ticket(self, step):
+        self.send_message_to_other_service(step, {'order_id': self.saga_id})
+
+    def reject_ticket(self, step):
+        self.send_compensation_command(step, {'order_id': self.saga_id})
+
+    def authorize_card(self, step):
+        # cards of even orders are declined
+        self.send_message_to_other_service(step, {'order_id': self.saga_id,
+                                                  'declined': self.saga_id % 2 == 0})
+
+    steps = [
+        AsyncStep(name='create_ticket', base_task_name='create_ticket', queue=COMMANDS_QUEUE,
+                  action=create_ticket, compensation=reject_ticket, remote_compensation=True),
+        AsyncStep(name='authorize_card', base_task_name='authorize_card', queue=COMMANDS_QUEUE,
+                  action=authorize_card),
+    ]
+
+    def on_saga_success(self):
+        super().on_saga_success()
+        saga_outcomes[self.saga_id] = 'succeeded'
+
+    def on_saga_failure(self, *args, **kwargs):
+        super().on_saga_failure(*args, **kwargs)
+        saga_outcomes[self.saga_id] = 'failed'
+
+
+def create_ticket_task(task, saga_id: int, payload: dict) -> dict:
+    return {'ticket_id': payload['order_id'] * 10}
+
+
+def reject_ticket_task(task, saga_id: int, payload: dict):
+    rejected_tickets.add(saga_id)
+
+
+def authorize_card_task(task, saga_id: int, payload: dict):
+    if payload['declined']:
+        raise ValueError('card declined')
+
+
+def echo_task(task, *args, **kwargs):
+    received.append((task.name, task.request.delivery_info['routing_key'], args, kwargs))
+
+
+def failing_task(task):
+    raise RuntimeError('consumer failed')
+
+
+def register_consumers(transport: AbstractTransport):
+    CreateOrderSaga.register_async_step_handlers(transport)
+    for name, func in [('create_ticket', create_ticket_task),
+                       (compensation_task_name('create_ticket'), reject_ticket_task),
+                       ('authorize_card', authorize_card_task)]:
+        transport.task(name=name, bind=True)(saga_step_handler(RESPONSE_QUEUE)(func))
+    transport.task(name='echo', bind=True)(echo_task)
+    transport.task(name='failing', bind=True)(failing_task)
+
+
+class ThreadedHarness:
+    def __init__(self):
+        self.transport = ThreadedTransport(workers=4)
+
+    def start(self):
+        self.transport.start()
+
+    def stop(self):
+        self.transport.stop()
+
+    def run(self, func, *args):
+        func(*args)
+
+
+class AsyncioHarness:
+    """
+    Runs event loop in background thread
+    """
+    def __init__(self):
+        self.transport = AsyncioTransport(concurrency=4)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.transport.start(), self.loop).result()
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.transport.stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def run(self, func, *args):
+        # like any consumer does
+        async def run():
+            func(*args)
+
+        asyncio.run_coroutine_threadsafe(run(), self.loop).result()
+
+
+class CeleryHarness:
+    """
+    Runs Celery worker with in-memory broker
+    """
+    def __init__(self):
+        celery = pytest.importorskip('celery')
+        from celery.contrib.testing.worker import start_worker
+
+        celery_app = celery.Celery('test_transports', broker='memory://',
+                                   backend='cache+memory://')
+        celery_app.conf.broker_transport_options = {'polling_interval': 0.01}
+        self.transport = CeleryTransport(celery_app)
+        self.worker = start_worker(celery_app, pool='solo',
+                                   queues=[COMMANDS_QUEUE, RESPONSE_QUEUE],
+                                   perform_ping_check=False, shutdown_timeout=30)
+
+    def start(self):
+        self.worker.__enter__()
+
+    def stop(self):
+        self.worker.__exit__(None, None, None)
+
+    def run(self, func, *args):
+        func(*args)
+
+
+@pytest.fixture(scope='module', params=[ThreadedHarness, AsyncioHarness, CeleryHarness],
+                ids=['threaded', 'asyncio', 'celery'])
+def harness(request):
+    harness = request.param()
+    register_consumers(harness.transport)
+    harness.start()
+    yield harness
+    harness.stop()
+
+
+def wait_until(predicate, timeout: float = 10):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise TimeoutError('condition not met')
+        time.sleep(0.005)
+
+
+def test_message_is_delivered_to_registered_consumer(harness):
+    received.clear()
+    sent_message = harness.transport.send_task('echo', args=[1, {'a': 'b'}], kwargs={'c': 2},
+                                               queue=COMMANDS_QUEUE, priority=5)
+
+    assert isinstance(sent_message.id, str)
+    wait_until(lambda: received)
+    assert received == [('echo', COMMANDS_QUEUE, (1, {'a': 'b'}), {'c': 2})]
+
+
+def test_consumer_failure_doesnt_stop_consuming(harness):
+    received.clear()
+    harness.transport.send_task('failing', queue=COMMANDS_QUEUE)
+    harness.transport.send_task('echo', queue=COMMANDS_QUEUE)
+
+    wait_until(lambda: received)
+
+
+def test_sagas_run_to_completion(harness):
+    ids = [next(saga_ids) for _ in range(20)]
+    for saga_id in ids:
+        saga = CreateOrderSaga(harness.transport, saga_id)
+        harness.run(saga.handle_message, saga.execute)
+
+    wait_until(lambda: all(saga_id in saga_outcomes for saga_id in ids))
+
+    assert {saga_id: saga_outcomes[saga_id] for saga_id in ids} == \
+        {saga_id: 'failed' if saga_id % 2 == 0 else 'succeeded' for saga_id in ids}
+    # tickets of failed sagas were rejected by remote compensation
+    assert {saga_id for saga_id in ids if saga_id in rejected_tickets} == \
+        {saga_id for saga_id in ids if saga_id % 2 == 0}
+
+
+def test_asyncio_transport_awaits_coroutine_consumers():
+    results = []
+
+    async def main():
+        transport = AsyncioTransport()
+
+        @transport.task(name='async_echo')
+        async def async_echo(value):
+            await asyncio.sleep(0)
+            results.append(value)
+
+        async with transport:
+            transport.send_task('async_echo', args=[1])
+            await transport.join()
+
+    asyncio.run(main())
+    assert results == [1]
+
+
+def test_in_process_transport_delivers_higher_priority_first():
+    transport = ThreadedTransport(workers=1)
+    results = []
+    transport.task(name='echo')(results.append)
+    for priority in (None, 9, 3):
+        transport.send_task('echo', args=[priority], priority=priority)
+
+    with transport:
+        transport.join()
+
+    assert results == [9, 3, None]